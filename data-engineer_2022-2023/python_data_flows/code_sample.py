@@ -4,24 +4,34 @@ Data request: name removed
 
 This workflow downloads data from models defined in the (name removed) repository.
 This workflow identifies all glue tables that have a certain prefix (which indicates that they are part of this data request)
-and then downloads the data locally as csv files and zips them into a zip file.
+and then downloads the data locally as csv files and zips each one into a part of the delivery.
 
 """
 import datetime
 import os
 import json
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import awswrangler as wr
 from loguru import logger
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
-from prefect import flow
+from prefect import flow, task
 import shutil
 
 # The following imports were functions we used frequently when
 # interacting with AWS Athena, Prefect, and Box.
 from dependencies.c2dp.aws.athena.identify_request_models import identify_request_models
 from dependencies.c2dp.aws.athena.download_data import download_data
-from dependencies.utils.box.read_file import (create_client, read_boxfile,
-                                              upload_files, list_folder_items)
+from dependencies.c2dp.aws.athena.unload_data import unload_data
+from dependencies.utils.box.read_file import create_client
+from dependencies.utils.box.storage import BoxStorage, is_transient_error
 from dependencies.utils.prefect.load_secret import load_secret
 
 BOX_CLIENT_SECRET = load_secret('box-client-secret')
@@ -37,7 +47,10 @@ model_configs = [
         'prefix': 'fake_prefix',
         'included_models': ['fake_prefix_included_model'],
         'folder_id': '0123456789',
-        'comparison_folder_id': '0123456789'
+        'comparison_folder_id': '0123456789',
+        'output_format': 'csv',
+        'chunksize': None, # set to a number of rows to stream large tables in chunks
+        'extraction': 'csv' # set to 'unload' to export tables from Athena as Parquet parts instead of CSV
 },
 ]
 
@@ -48,45 +61,267 @@ DOWNLOAD_PATH = today.strftime(f'%Y-%m-%d_fake_path')
 
 OUTPUT_FILE = today.strftime(f'%Y-%m-%d_fake_file')
 
-def remove_previous(user_client, config, df):
+# The delivered-keys index persists between runs, which may be on different Prefect workers, so it lives in S3.
+# A local directory can be set instead for local testing.
+KEY_INDEX_PATH = os.getenv('KEY_INDEX_PATH', default='s3://fake-bucket/delivered_keys')
+
+# Number of previous delivery files downloaded at once, and how many times to try each one
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', default=8))
+FETCH_RETRIES = int(os.getenv('FETCH_RETRIES', default=3))
+
+# File extension for each supported output_format. Compression is inferred by pandas from the extension.
+OUTPUT_FORMATS = {
+    'csv': '.csv',
+    'csv.gz': '.csv.gz',
+    'csv.zst': '.csv.zst',
+    'parquet': '.parquet'
+}
+
+# Database of the request models, used when streaming a table straight from Athena
+ATHENA_DATABASE = os.getenv('ATHENA_DATABASE', default='c2dp')
+
+# S3 prefix that Athena unloads tables to when a config's extraction is 'unload'
+UNLOAD_S3_PATH = os.getenv('UNLOAD_S3_PATH', default='s3://fake-bucket/unload')
+
+# Columns every delivery file is ordered by
+ORDER_BY = ['date_filed', 'case_number']
+
+# Rows written at once when merging the parts of an unloaded table
+OUTPUT_BATCH_ROWS = 65536
+
+# Every delivery is uploaded with a keys-only sidecar file, which is all update_key_index needs to read
+KEYS_SIDECAR_SUFFIX = '_keys.csv.gz'
+
+# Each table of a delivery is zipped and uploaded as its own part, named {delivery name}_part_{table}.zip
+DELIVERY_PART_SEPARATOR = '_part_'
+
+# Number of delivery parts uploaded at once, across every config
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', default=4))
+upload_slots = threading.BoundedSemaphore(UPLOAD_WORKERS)
+
+def get_delivery_name(config):
     '''
-    This function removes previously delivered data from the new data delivery.
+    Returns the name of a config's delivery, which its parts and keys sidecar are named after.
+    '''
+    return f"{OUTPUT_ZIP_FILE_NAME}_{config['prefix']}"
 
-    First it gathers all the surrogate keys from previous data deliveries.
 
-    After these have been deduplicated, it creates a boolean mask of if surrogate
-    keys in the new data appear in the df of previously delivered surrogate keys.
+def get_part_name(delivery_name, table):
+    '''
+    Returns the file name of the part of a delivery holding one table.
+    '''
+    return f'{delivery_name}{DELIVERY_PART_SEPARATOR}{table}.zip'
 
-    Based on this boolean mask, it only keeps new surrogate keys which do not appear
-    in the df of previously delivered surrogate keys.
 
-    The remaining data is saved, overwriting the new data delivery file pulled from Athena.
+def get_sidecar_name(delivery_name):
     '''
-    
-    previous_delivery_ids = list_folder_items(client = user_client, folder_id = config['comparison_folder_id'])
-    
-    number_of_prev_ids = len(previous_delivery_ids)
-    logger.info(f'Scanning {number_of_prev_ids} files')
+    Returns the file name of a delivery's keys sidecar.
+    '''
+    return f'{delivery_name}{KEYS_SIDECAR_SUFFIX}'
 
-    # Get the surrogate keys of the previously delivered data
-    previous_surrogate_keys = [] # TODO : Convert to DF
-    
-    for previous_delivery in previous_delivery_ids:
-        logger.info(f'Scanning file {previous_delivery}')
-        previous_df = read_boxfile(client = user_client, file = previous_delivery)
-        previous_surrogate_keys.extend(previous_df['Surrogate Key'])
-        new_row_count = len(previous_df['Surrogate Key'])
-        logger.info(f'Added {new_row_count} previously delivered surrogate keys')
-        logger.info(len(previous_surrogate_keys))
-
-    previous_surrogate_keys = pd.DataFrame(columns=['surrogate_key'], data=previous_surrogate_keys)
-    logger.info(previous_surrogate_keys)
-    previous_surrogate_keys['surrogate_key'] = previous_surrogate_keys['surrogate_key'].drop_duplicates()
-
-    logger.info(previous_surrogate_keys)
+
+def get_part_delivery(name, delivery_names):
+    '''
+    Returns the delivery in delivery_names that the file name is a part of (see get_part_name), or None.
+
+    The name is split at every DELIVERY_PART_SEPARATOR in turn rather than the first one,
+    so deliveries whose names contain the separator or dots are still matched.
+    '''
+    # the part name of an unnamed delivery and table is everything get_part_name adds around them
+    separator, extension = get_part_name('', '\0').split('\0')
+    if not name.endswith(extension):
+        return None
+
+    position = name.find(separator)
+    while position != -1:
+        if name[:position] in delivery_names:
+            return name[:position]
+        position = name.find(separator, position + 1)
+    return None
+
+
+def hash_keys(keys):
+    '''
+    This function hashes surrogate keys into unsigned 64-bit integers.
+
+    Keys are cast to strings first so that keys parsed as numbers from one file
+    and as text from another still hash to the same value. Whole numbers written as
+    floats (e.g. 1.0, from a key column with missing values) are written as integers (1).
+    '''
+    keys = pd.Series(keys).astype(str).str.replace(r'^(-?[0-9]+)\.0+$', r'\1', regex=True)
+    return pd.util.hash_array(keys.to_numpy(dtype=object))
+
+
+def load_key_index(config):
+    '''
+    This function loads the delivered-keys index for a comparison folder.
+
+    The index is a sorted, deduplicated array of hashed surrogate keys, saved as a .npy file,
+    plus a JSON manifest of the previously delivered files whose keys are already in the array.
+    The array is memory-mapped, so looking up new keys only touches the pages it needs.
+    If KEY_INDEX_PATH is in S3, the index is downloaded to DOWNLOAD_PATH first.
+
+    If no index exists yet, an empty index is returned and the next update builds it from scratch.
+    '''
+    index_file = f"{KEY_INDEX_PATH}/{config['comparison_folder_id']}"
+
+    if index_file.startswith('s3://'):
+        if not wr.s3.does_object_exist(f'{index_file}.npy'):
+            return np.array([], dtype=np.uint64), set()
+        local_index_file = f"{DOWNLOAD_PATH}/key_index/{config['comparison_folder_id']}"
+        os.makedirs(os.path.dirname(local_index_file), exist_ok=True)
+        for extension in ['.npy', '.json']:
+            wr.s3.download(path=f'{index_file}{extension}', local_file=f'{local_index_file}{extension}')
+        index_file = local_index_file
+
+    if not os.path.exists(f'{index_file}.npy'):
+        return np.array([], dtype=np.uint64), set()
+
+    keys = np.load(f'{index_file}.npy', mmap_mode='r')
+    with open(f'{index_file}.json') as f:
+        indexed_files = set(json.loads(f.read()))
+    return keys, indexed_files
+
+
+def save_key_index(config, keys, indexed_files):
+    '''
+    This function saves the delivered-keys index for a comparison folder.
+
+    The array is written to a temporary file and then renamed so a failed run never leaves
+    behind an index that is missing keys. If KEY_INDEX_PATH is in S3, the index is saved in
+    DOWNLOAD_PATH and uploaded, the array before the manifest: a run that fails in between
+    leaves an array with keys the manifest doesn't list yet, and those files are read again next time.
+    '''
+    index_path = f'{DOWNLOAD_PATH}/key_index' if KEY_INDEX_PATH.startswith('s3://') else KEY_INDEX_PATH
+    os.makedirs(index_path, exist_ok=True)
+    index_file = f"{index_path}/{config['comparison_folder_id']}"
+
+    with open(f'{index_file}.tmp.npy', 'wb') as f:
+        np.save(f, keys)
+    with open(f'{index_file}.tmp.json', 'w') as f:
+        f.write(json.dumps(sorted(indexed_files)))
+
+    os.replace(f'{index_file}.tmp.npy', f'{index_file}.npy')
+    os.replace(f'{index_file}.tmp.json', f'{index_file}.json')
+
+    if KEY_INDEX_PATH.startswith('s3://'):
+        for extension in ['.npy', '.json']:
+            wr.s3.upload(local_file=f'{index_file}{extension}', path=f"{KEY_INDEX_PATH}/{config['comparison_folder_id']}{extension}")
+
+
+def fetch_keys(storage, file_id, retries=FETCH_RETRIES):
+    '''
+    This function downloads a previous delivery file (or its keys sidecar) and returns its hashed surrogate keys.
+
+    Only the Surrogate Key column is parsed. Downloads that fail with a network or I/O error
+    (see is_transient_error) are retried with a growing wait between attempts before the error is raised.
+    A file that can't be parsed, or has no Surrogate Key column, raises its error right away.
+    '''
+    for attempt in range(1, retries + 1):
+        try:
+            previous_df = storage.read_table(file_id, usecols=['Surrogate Key'])
+            return hash_keys(previous_df['Surrogate Key'])
+        except Exception as e:
+            if attempt == retries or not is_transient_error(e):
+                raise
+            logger.warning(f'Attempt {attempt} to read {file_id} failed: {e}')
+            time.sleep(2 ** attempt)
+
+
+def update_key_index(storage, config):
+    '''
+    This function adds the surrogate keys of newly delivered files to the delivered-keys index.
+
+    Only files in the comparison folder that are not yet in the index manifest are read,
+    so each previous delivery is downloaded once, the first time it is seen.
+    When a delivery has a keys sidecar, only the sidecar is read. Older deliveries without
+    a sidecar are read in full.
+    New files are downloaded concurrently by up to config['fetch_workers'] (default FETCH_WORKERS)
+    threads, and their keys are hashed as each download finishes.
+
+    Returns the sorted array of hashed surrogate keys.
+    '''
+    keys, indexed_files = load_key_index(config)
+
+    previous_deliveries = storage.list_files(config['comparison_folder_id'])
+
+    # the parts of a delivery with a sidecar are skipped, since the sidecar holds their keys
+    sidecar_deliveries = {
+        name[:-len(KEYS_SIDECAR_SUFFIX)] for name in previous_deliveries.values()
+        if name.endswith(KEYS_SIDECAR_SUFFIX)
+    }
+    new_deliveries = [
+        file_id for file_id, name in previous_deliveries.items()
+        if file_id not in indexed_files and get_part_delivery(name, sidecar_deliveries) is None
+    ]
+
+    logger.info(f'{len(indexed_files)} files already indexed, scanning {len(new_deliveries)} new files')
+
+    if not new_deliveries:
+        return keys
+
+    new_keys = [keys]
+    with ThreadPoolExecutor(max_workers=config.get('fetch_workers', FETCH_WORKERS)) as executor:
+        futures = {executor.submit(fetch_keys, storage, file_id): file_id for file_id in new_deliveries}
+        for future in as_completed(futures):
+            hashed_keys = future.result()
+            new_keys.append(hashed_keys)
+            indexed_files.add(futures[future])
+            logger.info(f'Added {len(hashed_keys)} previously delivered surrogate keys from {futures[future]}')
+
+    # np.unique sorts and deduplicates in one pass
+    keys = np.unique(np.concatenate(new_keys))
+    logger.info(f'{len(keys)} unique previously delivered surrogate keys')
+
+    save_key_index(config, keys, indexed_files)
+    return keys
+
+
+def in_key_index(keys, index):
+    '''
+    Returns a boolean mask of which keys appear in the sorted delivered-keys index.
+    '''
+    hashed_keys = hash_keys(keys)
+
+    if len(index) == 0:
+        return np.zeros(len(hashed_keys), dtype=bool)
+
+    positions = np.searchsorted(index, hashed_keys)
+    positions[positions == len(index)] = 0 # keys larger than every indexed key
+    return np.asarray(index[positions] == hashed_keys)
+
+
+def write_output(df, output_file, output_format='csv'):
+    '''
+    Writes a delivery file in one of the OUTPUT_FORMATS.
+    '''
+    if output_format == 'parquet':
+        df.to_parquet(output_file, index=False)
+    else:
+        df.to_csv(output_file, index=False)
+
+
+def capitalize_columns(columns):
+    '''
+    Capitalizes column names the same way download_data(capitalize=True) does (e.g. surrogate_key becomes Surrogate Key).
+    '''
+    return [column.replace('_', ' ').title() for column in columns]
+
+
+def remove_previous(previous_surrogate_keys, df, output_file, output_format='csv'):
+    '''
+    This function removes previously delivered data from the new data delivery.
+
+    It creates a boolean mask of if surrogate keys in the new data appear in the
+    delivered-keys index (see update_key_index).
+
+    Based on this boolean mask, it only keeps new surrogate keys which do not appear
+    in the previously delivered data.
+
+    The remaining data is saved to output_file in output_format. Returns the surrogate keys of the remaining data.
+    '''
     # Remove previously delivered rows by surrogate keys from the current delivery
-    mask = df['Surrogate Key'].isin(previous_surrogate_keys['surrogate_key'])
-    logger.info(mask)
+    mask = in_key_index(df['Surrogate Key'], previous_surrogate_keys)
     
     df_size = df.shape[0]
     logger.info(f'Before removing previous keys, {df_size} rows in df')
@@ -97,54 +332,356 @@ def remove_previous(user_client, config, df):
     logger.info(f'After removing previous keys, {df_size} rows in df')
 
     # Resave the current delivery
-    output_file = f'{DOWNLOAD_PATH}/{OUTPUT_FILE}.csv'
-    df.to_csv(output_file, index=False)
+    write_output(df, output_file, output_format)
+    return df['Surrogate Key']
+
+
+def stream_table(table, chunksize):
+    '''
+    This function queries an Athena table and yields the results in chunks of chunksize rows,
+    ordered by date_filed and case_number.
+
+    The CTAS approach writes results to several Parquet files with no guaranteed order between
+    them, so the regular query results are read instead to keep the ordering.
+
+    Column names are capitalized with capitalize_columns.
+    '''
+    chunks = wr.athena.read_sql_query(
+        f"SELECT * FROM {table} ORDER BY {', '.join(ORDER_BY)}",
+        database=ATHENA_DATABASE,
+        ctas_approach=False,
+        chunksize=chunksize
+    )
+
+    for chunk in chunks:
+        chunk.columns = capitalize_columns(chunk.columns)
+        yield chunk
+
+
+def remove_previous_chunked(previous_surrogate_keys, chunks, output_file, output_format='csv'):
+    '''
+    This function removes previously delivered data from a delivery that arrives in chunks.
+
+    Each chunk is masked against the delivered-keys index the same way as in remove_previous and
+    then appended to output_file, so only one chunk is held in memory at a time.
+    CSV chunks (compressed or not) are appended to the file. Parquet chunks are written as row groups.
+
+    Returns the surrogate keys of the remaining data.
+    '''
+    delivered_keys = []
+    parquet_writer = None
+    before_size, after_size = 0, 0
+
+    try:
+        for chunk in chunks:
+            mask = in_key_index(chunk['Surrogate Key'], previous_surrogate_keys)
+            before_size += chunk.shape[0]
+
+            chunk = chunk[~mask]
+            after_size += chunk.shape[0]
+            delivered_keys.append(chunk['Surrogate Key'])
+
+            if output_format == 'parquet':
+                if parquet_writer is None:
+                    schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                    parquet_writer = pq.ParquetWriter(output_file, schema)
+                parquet_writer.write_table(pa.Table.from_pandas(chunk, schema=parquet_writer.schema, preserve_index=False))
+            else:
+                first_chunk = len(delivered_keys) == 1
+                chunk.to_csv(output_file, index=False, mode='w' if first_chunk else 'a', header=first_chunk)
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
+
+    logger.info(f'Before removing previous keys, {before_size} rows in table')
+    logger.info(f'After removing previous keys, {after_size} rows in table')
+
+    if not delivered_keys:
+        write_output(pd.DataFrame(columns=['Surrogate Key']), output_file, output_format)
+        return pd.Series([], name='Surrogate Key', dtype='str')
+
+    return pd.concat(delivered_keys, ignore_index=True)
+
+
+class PartReader():
+    '''
+    Reads rows of one Parquet part by position, for merging unloaded parts (see merge_batches).
+
+    If the rows are asked for in increasing positions, the part is read one record batch at a time and rows before the
+    last position asked for are dropped, so only the batches still needed are held in memory. Otherwise the whole
+    part is read the first time a row is asked for.
+    '''
+
+    def __init__(self, part_file, ordered=True):
+        self.part_file = part_file
+        self.ordered = ordered
+        self.batches = pq.ParquetFile(part_file).iter_batches() if ordered else None
+        self.buffer = None
+        self.start = 0 # position in the part of the first row of the buffer
+
+    def take(self, positions):
+        '''
+        Returns the rows of the part at positions as a table.
+        '''
+        if not self.ordered:
+            if self.buffer is None:
+                self.buffer = pq.read_table(self.part_file)
+            return self.buffer.take(positions)
+
+        while self.buffer is None or self.start + self.buffer.num_rows <= positions.max():
+            batch = pa.Table.from_batches([next(self.batches)])
+            self.buffer = batch if self.buffer is None else pa.concat_tables([self.buffer, batch])
+
+        rows = self.buffer.take(positions - self.start)
+        dropped = positions.max() + 1 - self.start
+        self.buffer = self.buffer.slice(dropped)
+        self.start += dropped
+        return rows
+
+
+def merge_batches(part_files, part_sizes, keep, batch_size=OUTPUT_BATCH_ROWS):
+    '''
+    Yields the rows of Parquet part files at the positions in keep (positions in the parts concatenated), in the order
+    of keep, as tables of up to batch_size rows.
+
+    This is a k-way merge of the parts: when every part's rows are asked for in increasing positions (each part is a
+    sorted run), each part is read one record batch at a time, so only about one batch per part is held in memory.
+    A part whose rows are out of order is read whole instead.
+    '''
+    part_starts = np.concatenate([[0], np.cumsum(part_sizes)])
+    parts = np.searchsorted(part_starts, keep, side='right') - 1
+    positions = keep - part_starts[parts]
+
+    readers = {}
+    for part in np.unique(parts):
+        part_positions = positions[parts == part]
+        readers[part] = PartReader(part_files[part], ordered=bool(np.all(np.diff(part_positions) > 0)))
+
+    for start in range(0, len(keep), batch_size):
+        batch_parts = parts[start:start + batch_size]
+        batch_positions = positions[start:start + batch_size]
+
+        # rows are taken part by part, then put back in the order of keep
+        part_order = np.argsort(batch_parts, kind='stable')
+        pieces = [
+            readers[part].take(batch_positions[part_order][batch_parts[part_order] == part])
+            for part in np.unique(batch_parts)
+        ]
+        yield pa.concat_tables(pieces).take(np.argsort(part_order))
+
+
+def filter_batches(part_files, keep_mask):
+    '''
+    Yields the record batches of Parquet part files in order as tables, keeping only the rows where keep_mask is True.
+    '''
+    offset = 0
+    for part_file in part_files:
+        for batch in pq.ParquetFile(part_file).iter_batches():
+            yield pa.Table.from_batches([batch.filter(pa.array(keep_mask[offset:offset + batch.num_rows]))])
+            offset += batch.num_rows
+
+
+def remove_previous_unloaded(previous_surrogate_keys, part_files, output_file, output_format='csv'):
+    '''
+    This function removes previously delivered data from a table unloaded as Parquet parts (see unload_data).
+
+    Only the surrogate_key and ORDER_BY columns of the parts are read to build the mask and the delivery order.
+    The rest of the columns are streamed from the parts to output_file without being held in memory:
+    - If the parts are already in ORDER_BY order, they are read one record batch at a time and filtered with the mask.
+    - Otherwise the parts are merged in ORDER_BY order (see merge_batches). Athena writes the parts of an unload in
+      parallel, so this is the usual case, but each part is sorted, so only about one batch per part is held at a time.
+    Parquet batches are written as they are. CSV batches are converted to DataFrames and appended to the file.
+
+    Columns are capitalized by renaming the schema of each batch, which does not copy its data.
+
+    Returns the surrogate keys of the remaining data.
+    '''
+    if not part_files:
+        logger.info('No rows in table')
+        write_output(pd.DataFrame(columns=['Surrogate Key']), output_file, output_format)
+        return pd.Series([], name='Surrogate Key', dtype='str')
+
+    index_tables = [pq.read_table(f, columns=['surrogate_key'] + ORDER_BY) for f in part_files]
+    index_table = pa.concat_tables(index_tables)
+    keys = index_table['surrogate_key'].to_pandas()
+    mask = in_key_index(keys, previous_surrogate_keys)
+
+    # sort_indices is stable, so rows already in order keep their positions
+    order = pc.sort_indices(index_table, sort_keys=[(column, 'ascending') for column in ORDER_BY]).to_numpy().astype(np.int64)
+    keep = order[~mask[order]]
+
+    logger.info(f'Before removing previous keys, {len(mask)} rows in table')
+    logger.info(f'After removing previous keys, {len(keep)} rows in table')
+
+    if np.array_equal(order, np.arange(len(order))):
+        batches = filter_batches(part_files, ~mask)
+    else:
+        logger.info(f'Merging {len(part_files)} unloaded parts')
+        batches = merge_batches(part_files, [t.num_rows for t in index_tables], keep)
+
+    schema = pq.read_schema(part_files[0])
+    schema = pa.schema([field.with_name(name) for field, name in zip(schema, capitalize_columns(schema.names))])
+
+    if output_format == 'parquet':
+        with pq.ParquetWriter(output_file, schema) as parquet_writer:
+            for batch in batches:
+                parquet_writer.write_table(batch.rename_columns(schema.names))
+    else:
+        pd.DataFrame(columns=schema.names).to_csv(output_file, index=False)
+        for batch in batches:
+            batch.rename_columns(schema.names).to_pandas().to_csv(output_file, index=False, mode='a', header=False)
+
+    return pd.Series(keys.to_numpy()[keep], name='Surrogate Key')
+
+
+@task
+def prepare_table(config, table, previous_surrogate_keys):
+    '''
+    This task downloads a single table and removes previously delivered data from it.
+
+    Each table is written to its own file in the config's download directory, in the config's output_format.
+    If the config sets a chunksize, the table is streamed through remove_previous_chunked instead of
+    being downloaded in full. If the config's extraction is 'unload', the table is unloaded as Parquet parts
+    and streamed through remove_previous_unloaded instead, whether or not a chunksize is set.
+    Returns the path of that file and the surrogate keys it contains.
+    '''
+    logger.info(table)
+
+    download_path = f"{DOWNLOAD_PATH}/{config['prefix']}"
+    file_name = f'{OUTPUT_FILE}_{table}'
+    output_format = config.get('output_format', 'csv')
+    output_file = f'{download_path}/{file_name}{OUTPUT_FORMATS[output_format]}'
+
+    if config.get('extraction') == 'unload':
+        unload_path = f'{download_path}/{file_name}_unload'
+        part_files = unload_data(table, unload_path, s3_path=UNLOAD_S3_PATH, database=ATHENA_DATABASE, order_by=', '.join(ORDER_BY))
+        delivered_keys = remove_previous_unloaded(previous_surrogate_keys, part_files, output_file, output_format)
+        shutil.rmtree(unload_path)
+        return output_file, delivered_keys
+
+    if config.get('chunksize'):
+        chunks = stream_table(table, config['chunksize'])
+        delivered_keys = remove_previous_chunked(previous_surrogate_keys, chunks, output_file, output_format)
+        return output_file, delivered_keys
+
+    df = download_data(
+        table, 
+        download_path=download_path,
+        file_name=file_name,
+        order_by=', '.join(ORDER_BY),
+        capitalize=True
+    )
+
+    delivered_keys = remove_previous(previous_surrogate_keys, df, output_file, output_format)
+
+    # the CSV from Athena is only kept when it is the delivery file itself
+    if output_file != f'{download_path}/{file_name}.csv':
+        os.remove(f'{download_path}/{file_name}.csv')
+
+    return output_file, delivered_keys
+
+
+@task
+def package_table(storage, config, table, prepared_table):
+    '''
+    This task zips one table's output file into its own part of the delivery and uploads it to the config's staging folder.
+
+    It runs as soon as its table is ready, so tables are compressed in parallel with each other and with the tables
+    still being downloaded, instead of all at once at the end. zlib releases the GIL while compressing, so parts
+    compress in parallel on separate cores. Up to UPLOAD_WORKERS parts are uploaded at once, each with
+    storage.upload_file, which uploads large parts in resumable chunks.
+
+    Returns the part's file name and the surrogate keys it contains.
+    '''
+    output_file, delivered_keys = prepared_table
+    part_file = f'{DOWNLOAD_PATH}/{get_part_name(get_delivery_name(config), table)}'
+
+    # Parquet and compressed CSVs are already compressed, so zip only stores them
+    if config.get('output_format', 'csv') == 'csv':
+        compression = zipfile.ZIP_DEFLATED
+    else:
+        compression = zipfile.ZIP_STORED
+
+    with zipfile.ZipFile(part_file, 'w', compression=compression) as z:
+        z.write(output_file, arcname=os.path.basename(output_file))
+
+    with upload_slots:
+        logger.info(f'Uploading {part_file} with {len(delivered_keys)} rows')
+        storage.upload_file(config['folder_id'], part_file)
+
+    return os.path.basename(part_file), delivered_keys
+
+
+@task
+def package_delivery(storage, config, packaged_tables):
+    '''
+    This task uploads a keys-only sidecar holding the surrogate keys of every table in a config's delivery,
+    once every part of the delivery has been uploaded (see package_table).
+
+    The sidecar is uploaded last, so a delivery with a sidecar in the staging folder is complete. It should be moved
+    into the comparison folder together with the delivery's parts.
+    '''
+    sidecar_file = f'{DOWNLOAD_PATH}/{get_sidecar_name(get_delivery_name(config))}'
+
+    delivered_keys = pd.concat([keys for _, keys in packaged_tables], ignore_index=True)
+    delivered_keys.to_frame('Surrogate Key').to_csv(sidecar_file, index=False)
+
+    logger.info(f'Uploading {sidecar_file} for {len(packaged_tables)} parts and {len(delivered_keys)} rows')
+    storage.upload(config['folder_id'], [sidecar_file])
+
 
 @flow(name=FLOW_CONFIG['flow_name'])
 def run_flow():
     '''
     This function prepares the data delivery for [name removed].
 
-    - Queries the relevant Athena table for this data delivery
-    - Saves data locally
+    - Queries the relevant Athena tables for this data delivery
+    - Saves data locally, one file per table
     - Removes previously delivered data
-    - Uploads to staging folder in Box
+    - Zips each table into a part of its config's delivery and uploads it to the config's staging folder in Box
+
+    Every table is prepared, zipped, and uploaded in its own tasks, so downloads, deduplication,
+    compression, and uploads of separate tables and models overlap. The delivered-keys index is updated once per comparison folder
+    before any of its tables are deduplicated.
     '''
-    user_client = create_client(
+    storage = BoxStorage(create_client(
         client_id=BOX_CLIENT_ID,
-        client_secret=BOX_CLIENT_SECRET)
+        client_secret=BOX_CLIENT_SECRET))
+
+    # if there is already a directory created, delete it (this mostly happens during local testing)
+    if os.path.exists(DOWNLOAD_PATH): shutil.rmtree(DOWNLOAD_PATH)
+    os.makedirs(DOWNLOAD_PATH)
+
+    key_index_futures = {}
+    table_futures = []
 
     for config in model_configs:
-        
-        # if there is already a directory created, delete it (this mostly happens during local testing)
-        if os.path.exists(DOWNLOAD_PATH): shutil.rmtree(DOWNLOAD_PATH)
-        os.makedirs(DOWNLOAD_PATH)
+        # configs that share a prefix share a download directory
+        os.makedirs(f"{DOWNLOAD_PATH}/{config['prefix']}", exist_ok=True)
+
+        # configs that share a comparison folder share one index update
+        comparison_folder_id = config['comparison_folder_id']
+        if comparison_folder_id not in key_index_futures:
+            key_index_futures[comparison_folder_id] = task(update_key_index).submit(storage, config)
 
         tables = identify_request_models(
             prefix=config['prefix'], 
             models_to_include=config['included_models']
         )
 
-        for table in tables: # TODO : Change the design to single table
-            logger.info(table)
-
-            df = download_data(
-                table, 
-                download_path=DOWNLOAD_PATH,
-                file_name=OUTPUT_FILE,
-                order_by='date_filed, case_number',
-                capitalize=True
-            )
-        
-            # Remove previously delivered data
-            remove_previous(user_client, config, df)
-        
-        files_to_upload = [{
-                'folder_id': config['folder_id'],
-                'file_name': [f'{DOWNLOAD_PATH}/{OUTPUT_FILE}.csv']
-            }]
-
-        upload_files(files_to_upload)
-
-        logger.info('Removing local download path')
-        shutil.rmtree(f'{DOWNLOAD_PATH}')
\ No newline at end of file
+        # each table is zipped and uploaded as soon as it is ready
+        table_futures.append([
+            package_table.submit(storage, config, table, prepare_table.submit(config, table, key_index_futures[comparison_folder_id]))
+            for table in tables
+        ])
+
+    # each config's sidecar is uploaded once all of its parts are
+    package_futures = [
+        package_delivery.submit(storage, config, futures)
+        for config, futures in zip(model_configs, table_futures)
+    ]
+    for future in package_futures:
+        future.result()
+
+    logger.info('Removing local download path')
+    shutil.rmtree(f'{DOWNLOAD_PATH}')
@@ -0,0 +1,314 @@
+# flows/data_request/test_flow.py
+
+import gzip
+import io
+import json
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import flow
+from dependencies.c2dp.aws.athena.unload_data import LocalUnload
+from dependencies.utils.box import storage
+from dependencies.utils.box.storage import BoxStorage, LocalFolderStorage, file_fingerprint, read_table_content
+
+
+def make_table(rows: int, seed: int = 0):
+    '''
+    This function makes a table shaped like a request model, in no particular order.
+    '''
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'surrogate_key': [f'key_{i:06d}' for i in rng.permutation(rows)],
+        'date_filed': pd.Timestamp('2023-01-02') + pd.to_timedelta(rng.integers(0, 60, rows), unit = 'D'),
+        'case_number': [f'23-CV-{i:06d}' for i in rng.permutation(rows)],
+        'party_name': rng.choice(['Jane Doe', 'John Smith, Jr.', 'Acme "Apartments" LLC'], rows)
+    })
+
+
+class RecordingStorage(LocalFolderStorage):
+    '''
+    LocalFolderStorage that records the files read.
+    '''
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.read_files = []
+
+    def read_table(self, file_id, usecols=None):
+        self.read_files.append(file_id)
+        return super().read_table(file_id, usecols = usecols)
+
+
+def write_delivery_file(path, keys):
+    '''
+    This function writes a zipped delivery file holding the surrogate keys.
+    '''
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr('delivery.csv', pd.DataFrame({'Surrogate Key': keys, 'Party Name': 'Jane Doe'}).to_csv(index = False))
+
+
+@pytest.mark.parametrize('file_name', ['delivery.csv', 'delivery.csv.gz', 'delivery.parquet', 'delivery.zip'])
+def test_read_table_content(file_name):
+    '''
+    This tests that read_table_content detects the format of a delivery file from its content and reads only the
+    Surrogate Key column, as strings.
+    '''
+    df = pd.DataFrame({'Surrogate Key': ['1', '2', '3'], 'Party Name': ['a', 'b', 'c']})
+
+    if file_name.endswith('.parquet'):
+        content = df.to_parquet(index = False)
+    elif file_name.endswith('.zip'):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as z:
+            z.writestr('part_1.csv', df[:2].to_csv(index = False))
+            z.writestr('part_2.csv', df[2:].to_csv(index = False))
+        content = buffer.getvalue()
+    else:
+        content = df.to_csv(index = False).encode()
+        content = gzip.compress(content) if file_name.endswith('.gz') else content
+
+    assert read_table_content(content, usecols = ['Surrogate Key'])['Surrogate Key'].tolist() == ['1', '2', '3']
+
+
+def test_local_upload_resumes_partial(tmp_path):
+    '''
+    This tests that an interrupted upload to a LocalFolderStorage resumes after the parts in its .partial file,
+    and that the unfinished upload isn't listed.
+    '''
+    file_name = tmp_path / 'delivery_part_table.zip'
+    file_name.write_bytes(os.urandom(100000))
+    folder = tmp_path / 'box' / 'staging'
+    folder.mkdir(parents = True)
+    (folder / 'delivery_part_table.zip.partial').write_bytes(file_name.read_bytes()[:30000])
+    (folder / 'delivery_part_table.zip.partial.json').write_text(json.dumps(file_fingerprint(str(file_name))))
+
+    local_storage = LocalFolderStorage(str(tmp_path / 'box'))
+    assert local_storage.list_files('staging') == {}
+
+    local_storage.upload_file('staging', str(file_name), part_size = 4096)
+
+    assert (folder / 'delivery_part_table.zip').read_bytes() == file_name.read_bytes()
+    assert not (folder / 'delivery_part_table.zip.partial').exists()
+    assert local_storage.list_files('staging') == {'delivery_part_table.zip': 'delivery_part_table.zip'}
+
+
+@pytest.mark.parametrize('partial', ['other_file', 'larger_than_file'])
+def test_local_upload_discards_other_partial(tmp_path, partial):
+    '''
+    This tests that a LocalFolderStorage upload starts over instead of resuming a .partial file left by an upload of
+    a different file with the same name, or one larger than the file.
+    '''
+    file_name = tmp_path / 'delivery_part_table.zip'
+    folder = tmp_path / 'box' / 'staging'
+    folder.mkdir(parents = True)
+
+    if partial == 'other_file':
+        # an interrupted upload of the same day's delivery, before the flow was rerun with different data
+        file_name.write_bytes(os.urandom(100000))
+        (folder / 'delivery_part_table.zip.partial').write_bytes(file_name.read_bytes()[:30000])
+        (folder / 'delivery_part_table.zip.partial.json').write_text(json.dumps(file_fingerprint(str(file_name))))
+        file_name.write_bytes(os.urandom(120000))
+    else:
+        file_name.write_bytes(os.urandom(100000))
+        (folder / 'delivery_part_table.zip.partial').write_bytes(os.urandom(150000))
+        (folder / 'delivery_part_table.zip.partial.json').write_text(json.dumps(file_fingerprint(str(file_name))))
+
+    LocalFolderStorage(str(tmp_path / 'box')).upload_file('staging', str(file_name), part_size = 4096)
+
+    assert (folder / 'delivery_part_table.zip').read_bytes() == file_name.read_bytes()
+    assert sorted(os.listdir(folder)) == ['delivery_part_table.zip']
+
+
+def test_local_upload_retries_failure(tmp_path, monkeypatch):
+    '''
+    This tests that a LocalFolderStorage upload that fails after copying its parts is retried without copying them again.
+    '''
+    file_name = tmp_path / 'delivery_part_table.zip'
+    file_name.write_bytes(os.urandom(50000))
+    replace = os.replace
+    failures = []
+
+    def failing_replace(source, destination):
+        if not failures:
+            failures.append(source)
+            raise OSError('connection reset')
+        replace(source, destination)
+
+    monkeypatch.setattr(storage.os, 'replace', failing_replace)
+    LocalFolderStorage(str(tmp_path / 'box')).upload_file('staging', str(file_name), part_size = 4096)
+
+    assert len(failures) == 1
+    assert (tmp_path / 'box' / 'staging' / 'delivery_part_table.zip').read_bytes() == file_name.read_bytes()
+
+
+def test_box_upload_resumes_chunked_upload(tmp_path, monkeypatch):
+    '''
+    This tests that a large Box upload whose first attempt fails is resumed with the chunked uploader rather than started again.
+    '''
+    file_name = tmp_path / 'delivery_part_table.zip'
+    file_name.write_bytes(os.urandom(1000))
+    calls = []
+
+    class FakeUploader():
+        def start(self):
+            calls.append('start')
+            raise ConnectionError('connection reset')
+
+        def resume(self):
+            calls.append('resume')
+
+    class FakeFolder():
+        def get_chunked_uploader(self, file_path):
+            return FakeUploader()
+
+    class FakeClient():
+        def folder(self, folder_id):
+            return FakeFolder()
+
+    monkeypatch.setattr(storage, 'CHUNKED_UPLOAD_BYTES', 100)
+    monkeypatch.setattr(storage.time, 'sleep', lambda seconds: None)
+    BoxStorage(FakeClient()).upload_file('0123456789', str(file_name))
+
+    assert calls == ['start', 'resume']
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_unload_matches_stream_table(tmp_path, monkeypatch, output_format):
+    '''
+    This tests that a table unloaded in shuffled parts by LocalUnload is delivered with the same rows, in the same order,
+    as the same table streamed from Athena by stream_table, once previously delivered rows are removed.
+    '''
+    table = 'fake_prefix_included_model'
+    source = make_table(rows = 5000)
+    source.to_parquet(tmp_path / f'{table}.parquet', index = False)
+    previous_surrogate_keys = np.unique(flow.hash_keys(source['surrogate_key'][::3]))
+
+    def read_sql_query(sql, database, ctas_approach, chunksize):
+        ordered = source.sort_values(flow.ORDER_BY, kind = 'stable').reset_index(drop = True)
+        return (ordered[start:start + chunksize] for start in range(0, len(ordered), chunksize))
+
+    monkeypatch.setattr(flow.wr.athena, 'read_sql_query', read_sql_query)
+    extension = flow.OUTPUT_FORMATS[output_format]
+    streamed_keys = flow.remove_previous_chunked(
+        previous_surrogate_keys, flow.stream_table(table, chunksize = 700), str(tmp_path / f'streamed{extension}'), output_format)
+
+    unload = LocalUnload(str(tmp_path), part_rows = 400, shuffle_parts = True)
+    part_files = unload(table, str(tmp_path / 'unload'), order_by = ', '.join(flow.ORDER_BY))
+    unloaded_keys = flow.remove_previous_unloaded(
+        previous_surrogate_keys, part_files, str(tmp_path / f'unloaded{extension}'), output_format)
+
+    if output_format == 'parquet':
+        streamed = pd.read_parquet(tmp_path / 'streamed.parquet')
+        unloaded = pd.read_parquet(tmp_path / 'unloaded.parquet')
+    else:
+        streamed = pd.read_csv(tmp_path / 'streamed.csv', dtype = 'str')
+        unloaded = pd.read_csv(tmp_path / 'unloaded.csv', dtype = 'str')
+
+    assert len(unloaded) == len(source) - len(previous_surrogate_keys)
+    pd.testing.assert_frame_equal(unloaded, streamed, check_dtype = False)
+    assert unloaded_keys.tolist() == streamed_keys.tolist()
+
+
+def test_key_index_reads_only_new_files(tmp_path, monkeypatch):
+    '''
+    This tests that the first update_key_index builds the delivered-keys index from every previous delivery file,
+    and that the next one only reads the files added since, using the index manifest.
+    '''
+    monkeypatch.setattr(flow, 'KEY_INDEX_PATH', str(tmp_path / 'key_index'))
+    folder = tmp_path / 'box' / 'comparison'
+    folder.mkdir(parents = True)
+    config = {'comparison_folder_id': 'comparison', 'fetch_workers': 2}
+    write_delivery_file(folder / '2023-01-02_fake_prefix.zip', ['1', '2', '3'])
+    write_delivery_file(folder / '2023-01-09_fake_prefix.zip', ['3', '4'])
+
+    storage = RecordingStorage(str(tmp_path / 'box'))
+    keys = flow.update_key_index(storage, config)
+
+    assert sorted(storage.read_files) == ['2023-01-02_fake_prefix.zip', '2023-01-09_fake_prefix.zip']
+    assert keys.tolist() == np.unique(flow.hash_keys(['1', '2', '3', '4'])).tolist()
+    assert json.loads((tmp_path / 'key_index' / 'comparison.json').read_text()) == sorted(storage.read_files)
+
+    write_delivery_file(folder / '2023-01-16_fake_prefix.zip', ['4', '5'])
+    storage = RecordingStorage(str(tmp_path / 'box'))
+    keys = flow.update_key_index(storage, config)
+
+    assert storage.read_files == ['2023-01-16_fake_prefix.zip']
+    assert keys.tolist() == np.unique(flow.hash_keys(['1', '2', '3', '4', '5'])).tolist()
+
+    storage = RecordingStorage(str(tmp_path / 'box'))
+    assert flow.update_key_index(storage, config).tolist() == keys.tolist()
+    assert storage.read_files == []
+
+
+@pytest.mark.parametrize('prefix', ['fake_prefix', 'fake.prefix', 'fake_part_prefix'])
+def test_key_index_reads_sidecar_instead_of_parts(tmp_path, monkeypatch, prefix):
+    '''
+    This tests that update_key_index reads the keys sidecar of a delivery instead of its parts, whatever its prefix,
+    and still reads the parts of a delivery without a sidecar.
+    '''
+    monkeypatch.setattr(flow, 'KEY_INDEX_PATH', str(tmp_path / 'key_index'))
+    folder = tmp_path / 'box' / 'comparison'
+    folder.mkdir(parents = True)
+
+    delivery_name = flow.get_delivery_name({'prefix': prefix})
+    for table, keys in [('first_model', ['1', '2']), ('second_model', ['3'])]:
+        write_delivery_file(folder / flow.get_part_name(delivery_name, table), keys)
+    pd.DataFrame({'Surrogate Key': ['1', '2', '3']}).to_csv(folder / flow.get_sidecar_name(delivery_name), index = False)
+    # an older delivery, uploaded before sidecars were
+    write_delivery_file(folder / flow.get_part_name(f'2022-12-26_{prefix}', 'first_model'), ['0'])
+
+    storage = RecordingStorage(str(tmp_path / 'box'))
+    keys = flow.update_key_index(storage, {'comparison_folder_id': 'comparison'})
+
+    assert sorted(storage.read_files) == sorted([
+        flow.get_sidecar_name(delivery_name), flow.get_part_name(f'2022-12-26_{prefix}', 'first_model')])
+    assert keys.tolist() == np.unique(flow.hash_keys(['0', '1', '2', '3'])).tolist()
+
+
+def test_remove_previous_drops_indexed_keys(tmp_path, monkeypatch):
+    '''
+    This tests that remove_previous drops the rows whose surrogate keys are in the delivered-keys index, including keys
+    that were read as floats from a previous delivery, and keeps the rest in order.
+    '''
+    monkeypatch.setattr(flow, 'KEY_INDEX_PATH', str(tmp_path / 'key_index'))
+    folder = tmp_path / 'box' / 'comparison'
+    folder.mkdir(parents = True)
+    # a key column with missing values is read back as floats
+    pd.DataFrame({'Surrogate Key': [1.0, None, 3.0]}).to_parquet(folder / '2023-01-02_fake_prefix.parquet', index = False)
+
+    keys = flow.update_key_index(LocalFolderStorage(str(tmp_path / 'box')), {'comparison_folder_id': 'comparison'})
+    df = pd.DataFrame({'Surrogate Key': ['4', '3', '2', '1'], 'Party Name': ['a', 'b', 'c', 'd']})
+    delivered_keys = flow.remove_previous(keys, df, str(tmp_path / 'delivery.csv'))
+
+    assert delivered_keys.tolist() == ['4', '2']
+    assert pd.read_csv(tmp_path / 'delivery.csv', dtype = 'str')['Party Name'].tolist() == ['a', 'c']
+
+
+@pytest.mark.parametrize('error', [ConnectionResetError('connection reset'), ValueError('Usecols do not match columns')])
+def test_fetch_keys_retries_only_transient_errors(monkeypatch, error):
+    '''
+    This tests that fetch_keys retries a previous delivery file that failed to download, but raises a file that
+    can't be parsed right away.
+    '''
+    reads = []
+
+    class FlakyStorage():
+        def read_table(self, file_id, usecols=None):
+            reads.append(file_id)
+            if len(reads) == 1:
+                raise error
+            return pd.DataFrame({'Surrogate Key': ['1', '2']})
+
+    monkeypatch.setattr(flow.time, 'sleep', lambda seconds: None)
+
+    if isinstance(error, OSError):
+        assert flow.fetch_keys(FlakyStorage(), 'delivery.zip').tolist() == flow.hash_keys(['1', '2']).tolist()
+        assert len(reads) == 2
+    else:
+        with pytest.raises(ValueError):
+            flow.fetch_keys(FlakyStorage(), 'delivery.zip')
+        assert len(reads) == 1
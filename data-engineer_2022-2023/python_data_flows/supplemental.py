@@ -0,0 +1,206 @@
+# dependencies/utils/box/storage.py
+
+import io
+import json
+import os
+import shutil
+import time
+import zipfile
+
+import pandas as pd
+from boxsdk.exception import BoxAPIException, BoxNetworkException
+from loguru import logger
+
+from dependencies.utils.box.read_file import list_folder_items, upload_files
+
+'''
+The delivery flows only need four things from our cloud storage: list the files in a folder,
+read a delivery file, upload files to a folder, and upload one large file in resumable parts.
+
+BoxStorage does these against Box. LocalFolderStorage does the same against a local directory,
+where each folder id is a subdirectory, so the flows can be run and tested without Box credentials.
+'''
+
+# Box only accepts chunked uploads of files of at least 20 MB. Smaller files are uploaded in one request.
+CHUNKED_UPLOAD_BYTES = 20 * 1024 * 1024
+
+# Size of each part copied by LocalFolderStorage.upload_file
+PART_BYTES = 8 * 1024 * 1024
+
+UPLOAD_RETRIES = 3
+
+
+def read_table_content(content, usecols=None):
+    '''
+    Parses the content of a delivery file: a CSV, a gzip or zstd compressed CSV, or a Parquet file.
+    The format is detected from the first bytes of the content rather than the file name.
+
+    Zipped deliveries are read by concatenating every table in the archive.
+    '''
+    if zipfile.is_zipfile(io.BytesIO(content)):
+        with zipfile.ZipFile(io.BytesIO(content)) as z:
+            return pd.concat([
+                read_table_content(z.read(name), usecols = usecols)
+                for name in z.namelist() if not name.endswith('/')
+            ], ignore_index = True)
+
+    if content[:4] == b'PAR1':
+        return pd.read_parquet(io.BytesIO(content), columns = usecols).astype('str')
+
+    if content[:2] == b'\x1f\x8b':
+        compression = 'gzip'
+    elif content[:4] == b'\x28\xb5\x2f\xfd':
+        compression = 'zstd'
+    else:
+        compression = None
+
+    return pd.read_csv(io.BytesIO(content), usecols = usecols, dtype = 'str', compression = compression)
+
+
+def is_transient_error(error):
+    '''
+    Returns whether a failed read or upload is worth retrying: a local I/O or network error, or an error on Box's side
+    (a 5xx response or a rate limit). Errors in the file itself, like a missing column or an unreadable format, are not.
+    '''
+    if isinstance(error, BoxAPIException):
+        return error.status >= 500 or error.status == 429
+    return isinstance(error, (OSError, BoxNetworkException))
+
+
+def file_fingerprint(file_name):
+    '''
+    Returns the size and modification time of a local file, which change whenever the file is written again.
+    '''
+    stat = os.stat(file_name)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class BoxStorage():
+    '''
+    Storage client for Box folders.
+    '''
+
+    def __init__(self, client):
+        self.client = client
+
+    def list_files(self, folder_id):
+        '''
+        Returns a dict of file id to file name for the files in a Box folder.
+        '''
+        items = list_folder_items(client = self.client, folder_id = folder_id)
+        return {str(getattr(item, 'object_id', item)): getattr(item, 'name', str(item)) for item in items}
+
+    def read_table(self, file_id, usecols=None):
+        '''
+        Downloads a delivery file from Box and parses only the columns in usecols.
+        '''
+        content = self.client.file(file_id = file_id).content()
+        return read_table_content(content, usecols = usecols)
+
+    def upload(self, folder_id, file_names):
+        '''
+        Uploads local files to a Box folder.
+        '''
+        upload_files([{'folder_id': folder_id, 'file_name': file_names}])
+
+    def upload_file(self, folder_id, file_name, retries=UPLOAD_RETRIES):
+        '''
+        Uploads one local file to a Box folder. Files of at least CHUNKED_UPLOAD_BYTES are uploaded in parts with
+        Box's chunked upload API. If a part fails, the upload is resumed from the last part Box received rather
+        than started again, up to retries times.
+        '''
+        if os.path.getsize(file_name) < CHUNKED_UPLOAD_BYTES:
+            self.upload(folder_id, [file_name])
+            return
+
+        uploader = self.client.folder(folder_id = folder_id).get_chunked_uploader(file_path = file_name)
+        for attempt in range(1, retries + 1):
+            try:
+                uploader.start() if attempt == 1 else uploader.resume()
+                return
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                logger.warning(f'Attempt {attempt} to upload {file_name} failed, resuming: {e}')
+                time.sleep(2 ** attempt)
+
+
+class LocalFolderStorage():
+    '''
+    Storage client backed by a local directory. Folder ids are subdirectories of root
+    and file ids are file names.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def list_files(self, folder_id):
+        '''
+        Returns a dict of file id to file name for the files in a folder. Both are the file name.
+        '''
+        folder = f'{self.root}/{folder_id}'
+        if not os.path.exists(folder):
+            return {}
+        return {
+            f: f for f in sorted(os.listdir(folder))
+            if os.path.isfile(f'{folder}/{f}') and not f.endswith(('.partial', '.partial.json')) # skip unfinished uploads
+        }
+
+    def read_table(self, file_id, usecols=None):
+        '''
+        Parses only the columns in usecols of a file in any folder under root.
+        '''
+        for folder_id in os.listdir(self.root):
+            path = f'{self.root}/{folder_id}/{file_id}'
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    return read_table_content(f.read(), usecols = usecols)
+        raise FileNotFoundError(f'{file_id} not found in {self.root}')
+
+    def upload(self, folder_id, file_names):
+        '''
+        Copies local files into a folder.
+        '''
+        os.makedirs(f'{self.root}/{folder_id}', exist_ok = True)
+        for file_name in file_names:
+            shutil.copy(file_name, f'{self.root}/{folder_id}/')
+
+    def upload_file(self, folder_id, file_name, retries=UPLOAD_RETRIES, part_size=PART_BYTES):
+        '''
+        Copies one local file into a folder in parts of part_size bytes, like a chunked upload. The parts are
+        appended to a .partial file, which is renamed once complete. If a copy fails, or an earlier upload of the
+        same file was interrupted, it resumes after the parts already copied.
+
+        The fingerprint of the file (see file_fingerprint) is saved next to the .partial file. A .partial file left by an
+        upload of a different file with the same name (e.g. a rerun of the flow on the same day), or larger than the
+        file, is discarded and the upload starts over.
+        '''
+        os.makedirs(f'{self.root}/{folder_id}', exist_ok = True)
+        destination = f'{self.root}/{folder_id}/{os.path.basename(file_name)}'
+        partial_file, fingerprint_file = f'{destination}.partial', f'{destination}.partial.json'
+
+        fingerprint = file_fingerprint(file_name)
+        previous_fingerprint = None
+        if os.path.exists(fingerprint_file):
+            with open(fingerprint_file) as f:
+                previous_fingerprint = json.load(f)
+        if os.path.exists(partial_file) and (
+                previous_fingerprint != fingerprint or os.path.getsize(partial_file) > fingerprint['size']):
+            logger.info(f'{partial_file} is not a part of {file_name}, starting the upload over')
+            os.remove(partial_file)
+        with open(fingerprint_file, 'w') as f:
+            json.dump(fingerprint, f)
+
+        for attempt in range(1, retries + 1):
+            try:
+                with open(file_name, 'rb') as source, open(partial_file, 'ab') as partial:
+                    source.seek(partial.tell())
+                    for part in iter(lambda: source.read(part_size), b''):
+                        partial.write(part)
+                os.replace(partial_file, destination)
+                os.remove(fingerprint_file)
+                return
+            except OSError as e:
+                if attempt == retries:
+                    raise
+                logger.warning(f'Attempt {attempt} to upload {file_name} failed, resuming: {e}')
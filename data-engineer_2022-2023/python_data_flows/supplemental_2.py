@@ -0,0 +1,100 @@
+# dependencies/c2dp/aws/athena/unload_data.py
+
+import glob
+import os
+import random
+import time
+import uuid
+
+import awswrangler as wr
+import pyarrow as pa
+import pyarrow.parquet as pq
+from loguru import logger
+
+'''
+unload_data exports an Athena table with UNLOAD, which writes the query results straight to S3 as Parquet files
+instead of as one CSV, and downloads the Parquet parts. With an ORDER BY, each part is sorted, but Athena writes
+the parts in parallel, so the rows are not in order across parts.
+
+LocalUnload does the same from local Parquet files, where each table is a file or folder of files named after the table,
+so the flows can be run and tested without querying Athena.
+'''
+
+# Maximum number of rows in each part written by LocalUnload
+LOCAL_PART_ROWS = 100000
+
+
+def unload_data(table, download_path, s3_path, database, order_by=None, boto3_session=None):
+    '''
+    Unloads an Athena table, ordered by the columns in order_by (e.g. 'date_filed, case_number') if given,
+    to Parquet files under s3_path and downloads them to download_path.
+    The S3 files are deleted once they are downloaded.
+
+    Returns the paths of the downloaded parts, sorted by name.
+    '''
+    start_time = time.time()
+
+    # UNLOAD fails if the destination already has files in it, so every unload gets its own prefix
+    unload_path = f"{s3_path.rstrip('/')}/{table}/{uuid.uuid4().hex}/"
+    wr.athena.unload(
+        sql = f'SELECT * FROM {table}' + (f' ORDER BY {order_by}' if order_by else ''),
+        path = unload_path,
+        database = database,
+        file_format = 'PARQUET',
+        compression = 'SNAPPY',
+        boto3_session = boto3_session
+    )
+
+    os.makedirs(download_path, exist_ok = True)
+    part_files = []
+    for i, part in enumerate(sorted(wr.s3.list_objects(unload_path, boto3_session = boto3_session))):
+        part_file = f'{download_path}/part-{i:05d}.parquet'
+        wr.s3.download(path = part, local_file = part_file, boto3_session = boto3_session)
+        part_files.append(part_file)
+    wr.s3.delete_objects(unload_path, boto3_session = boto3_session)
+
+    logger.info(f'Unloaded {table} into {len(part_files)} parts in {time.time() - start_time:.1f} seconds')
+    return part_files
+
+
+class LocalUnload():
+    '''
+    File-based stand-in for unload_data, reading tables from a local directory.
+    '''
+
+    def __init__(self, root, part_rows=LOCAL_PART_ROWS, shuffle_parts=False):
+        self.root = root
+        self.part_rows = part_rows
+        self.shuffle_parts = shuffle_parts
+        self.unloaded_tables = []
+
+    def __call__(self, table, download_path, s3_path=None, database=None, order_by=None, boto3_session=None):
+        '''
+        Splits the table {root}/{table}.parquet (or the Parquet files in {root}/{table}/), sorted by the columns in
+        order_by if given, into parts of at most part_rows rows in download_path. Returns the paths of the parts,
+        sorted by name.
+
+        If shuffle_parts is set, the parts are numbered in a random order, like the parts of an Athena UNLOAD.
+        '''
+        if os.path.isdir(f'{self.root}/{table}'):
+            source_files = sorted(glob.glob(f'{self.root}/{table}/*.parquet'))
+        else:
+            source_files = [f'{self.root}/{table}.parquet']
+
+        source = pa.concat_tables([pq.read_table(source_file) for source_file in source_files])
+        if order_by:
+            source = source.sort_by([(column.strip(), 'ascending') for column in order_by.split(',')])
+
+        batches = source.to_batches(max_chunksize = self.part_rows)
+        if self.shuffle_parts:
+            random.shuffle(batches)
+
+        os.makedirs(download_path, exist_ok = True)
+        part_files = []
+        for i, batch in enumerate(batches):
+            part_files.append(f'{download_path}/part-{i:05d}.parquet')
+            pq.write_table(pa.Table.from_batches([batch]), part_files[-1])
+
+        self.unloaded_tables.append(table)
+        return part_files
+
@@ -1,40 +1,401 @@
 # utils/aws_lambda/functions/create_athena_table/schema_error_handling.py
 
+import codecs
+import io
+import json
+import threading
+
 import awswrangler as wr
 import boto3
+import pandas as pd
+from botocore.exceptions import ClientError
 from loguru import logger
 
-sess = boto3.Session(region_name='us-east-1')
-s3_client = boto3.client('s3', region_name='us-east-1')
+AWS_REGION = 'us-east-1'
 
+# The boto3 session and S3 client are created on first use (see get_session and get_s3_client) rather than at import,
+# and are then reused by every module and across warm invocations of the lambda.
+sess = None
+s3_client = None
+client_lock = threading.Lock()
 
-def try_read_csv(path):
+HEADER_BYTES = 64 * 1024 # size of the first ranged GET when reading a CSV header
+CHUNK_ROWS = 50000 # rows held in memory at once when rewriting a CSV
+PART_BYTES = 8 * 1024 * 1024 # size of each part of a multipart upload (S3's minimum is 5 MB)
+
+# Schema registries are kept outside the data directories so Glue and Athena never read them as data
+SCHEMA_REGISTRY_PREFIX = '_schema_registry'
+
+# Encodings tried in order by detect_encoding. latin-1 can decode any bytes, so it is also the fallback
+# when bytes past the sample don't decode with the detected encoding.
+ENCODINGS = ['utf-8', 'cp1252', 'latin-1']
+FALLBACK_ENCODING = 'latin-1'
+
+# Listings cached by list_s3_objects, keyed by (bucket, prefix). Cleared at the start of every lambda invocation.
+listing_cache = {}
+
+
+def get_session():
+    '''
+    This method returns the shared boto3 session, creating it on first use.
     '''
-    Sometimes a UnicodeDecodeError arises when we read_csv. This error seems related to the existence of quotation marks in
-    string-heavy CSVs. According to https://stackoverflow.com/questions/61264795/pandas-unicodedecodeerror-utf-8-codec-cant-decode-bytes-in-position-0-1-in
-    adding the pandas.read_csv() argument encoding='unicode_escape' may prevent UnicodeDecodeErrors from arising.
+    global sess
+    if sess is None:
+        with client_lock:
+            if sess is None:
+                sess = boto3.Session(region_name = AWS_REGION)
+    return sess
 
-    According to the Python docs, the unicode_escape encoding means the following:
-    "Encoding suitable as the contents of a Unicode literal in ASCII-encoded Python source code, except that quotes are not escaped.
-    Decode from Latin-1 source code. Beware that Python source code actually uses UTF-8 by default."
+
+def get_s3_client():
+    '''
+    This method returns the shared S3 client, creating it on first use. boto3 clients are thread safe,
+    so the one client is used by every thread.
     '''
+    global s3_client
+    if s3_client is None:
+        with client_lock:
+            if s3_client is None:
+                s3_client = boto3.client('s3', region_name = AWS_REGION)
+    return s3_client
+
+
+def detect_encoding(content: bytes):
+    '''
+    This method returns the first encoding in ENCODINGS that can decode content, a sample from the start of a file.
+    The sample may end partway through a UTF-8 character, so an incomplete character at the end is not an error.
+    '''
+    for encoding in ENCODINGS:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(content, final = False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+
+
+def sample_encoding(path, sample_bytes=HEADER_BYTES):
+    '''
+    This method detects the encoding of a CSV object (see detect_encoding) from its first sample_bytes,
+    fetched with a ranged GET.
+    '''
+    bucket, key = path.replace('s3://', '').split('/', 1)
+    try:
+        response = get_s3_client().get_object(Bucket = bucket, Key = key, Range = f'bytes=0-{sample_bytes - 1}')
+        return detect_encoding(response['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidRange': # empty objects can't satisfy any range
+            raise
+        return ENCODINGS[0]
+
+
+def try_read_csv(path):
+    '''
+    Sometimes a UnicodeDecodeError arises when we read_csv, because the CSV was saved in a Windows or Latin-1 encoding
+    rather than UTF-8. The encoding is detected from a sample at the start of the file (see sample_encoding), so the
+    file is only downloaded once. If bytes later in the file don't decode with the detected encoding, it is read again with
+    FALLBACK_ENCODING, which can decode anything.
+    '''
+    encoding = sample_encoding(path)
     try:
-        df = wr.s3.read_csv(path, dtype='str')
+        df = wr.s3.read_csv(path, dtype='str', encoding=encoding)
         return df
     except UnicodeDecodeError:
-        df = wr.s3.read_csv(path, dtype='str', encoding='unicode_escape')
+        logger.info(f'{path} is not {encoding}, reading as {FALLBACK_ENCODING}')
+        df = wr.s3.read_csv(path, dtype='str', encoding=FALLBACK_ENCODING)
         return df
 
 
+def find_header_end(content: bytes):
+    '''
+    Returns the position just past the line break ending the first record (the header) of CSV content,
+    or -1 if the content has no complete first record.
+
+    A line break inside a quoted field doesn't end the record: the record ends at the first line break with an even
+    number of quotes before it (an escaped quote "" counts twice). Only the quotes in the header are counted, so
+    quoted fields in the rows after it don't matter.
+    '''
+    start, quotes = 0, 0
+    while True:
+        line_break = content.find(b'\n', start)
+        if line_break == -1:
+            return -1
+        quotes += content.count(b'"', start, line_break)
+        if quotes % 2 == 0:
+            return line_break + 1
+        start = line_break + 1
+
+
+def read_csv_header(path, header_bytes=HEADER_BYTES):
+    '''
+    Returns the column names of a CSV object without downloading the whole object.
+
+    We fetch the first header_bytes of the object with a ranged GET and parse only its first record (see find_header_end).
+    If the header is longer than that, we fetch twice as many bytes until the header is complete or we
+    have read the whole object. The header is decoded with the encoding detected from its bytes (see detect_encoding).
+    '''
+    bucket, key = path.replace('s3://', '').split('/', 1)
+
+    while True:
+        try:
+            response = get_s3_client().get_object(Bucket = bucket, Key = key, Range = f'bytes=0-{header_bytes - 1}')
+            content = response['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidRange': # empty objects can't satisfy any range
+                raise
+            content = b''
+
+        whole_object = len(content) < header_bytes
+        header_end = find_header_end(content)
+
+        # with no complete header, read more
+        if header_end == -1 and not whole_object:
+            header_bytes *= 2
+            continue
+
+        header = content if header_end == -1 else content[:header_end]
+        df = pd.read_csv(io.BytesIO(header), dtype='str', nrows=0, encoding=detect_encoding(header))
+        return list(df.columns)
+
+
+def iter_s3_objects(bucket: str, prefix: str):
+    '''
+    This method lists every object under a prefix, following pagination, one page at a time.
+
+    It yields the Key, LastModified, Size, and ETag of each object.
+    '''
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket = bucket, Prefix = prefix):
+        for object in page.get('Contents', []):
+            yield {
+                'Key': object['Key'],
+                'LastModified': object['LastModified'],
+                'Size': object['Size'],
+                'ETag': object['ETag']
+            }
+
+
+def list_s3_objects(bucket: str, prefix: str):
+    '''
+    This method returns the full listing of a prefix (see iter_s3_objects).
+
+    The listing is cached, so a prefix is only listed once per lambda invocation or audit run.
+    Call clear_listing_cache when the prefix changes or a new invocation starts.
+    '''
+    if (bucket, prefix) not in listing_cache:
+        listing_cache[(bucket, prefix)] = list(iter_s3_objects(bucket, prefix))
+    return listing_cache[(bucket, prefix)]
+
+
+def clear_listing_cache(bucket: str = None, prefix: str = ''):
+    '''
+    This method drops the cached listings of every prefix under prefix in bucket, or all cached listings if no bucket is given.
+    '''
+    for cached_bucket, cached_prefix in list(listing_cache):
+        if bucket is None or (cached_bucket == bucket and cached_prefix.startswith(prefix)):
+            listing_cache.pop((cached_bucket, cached_prefix), None)
+
+
+def get_oldest_object(bucket: str, prefix: str, suffix: str = '.csv', cache: bool = True):
+    '''
+    This method returns the object under a prefix with the oldest last_modified date whose key ends with suffix,
+    or None if there is none.
+
+    With cache = True, it uses (and fills) the cached listing. With cache = False, it keeps only the oldest object
+    seen so far while paging through the listing, so huge prefixes are never held in memory.
+    '''
+    objects = list_s3_objects(bucket, prefix) if cache else iter_s3_objects(bucket, prefix)
+    return min(
+        (object for object in objects if object['Key'].endswith(suffix)),
+        key = lambda x: x['LastModified'],
+        default = None)
+
+
 def replace_line_breaks(df):
     '''
     We replace new line characters ("\n") with spaces because new line characters were causing
-    issues with how Athena interpreted new lines, including splitting data across multiple rows
+    issues with how Athena interpreted new lines, including splitting data across multiple rows.
+    Carriage returns ("\r") are removed, so "\r\n" also becomes a single space.
+
+    Only columns that contain line breaks are rewritten. Returns the data and the number of
+    line break characters replaced.
     '''
-    out = df.apply(lambda s: s.str.replace('\n', ' ').replace('\r', ''))
-    check_output = out.apply(lambda s: s.str.contains(r'\n'))
-    assert all(check_output.eq(False)) # check that there are no new line characters in the data after replacement
-    return out
+    out = df.copy()
+    replacements = 0
+    for column in out.columns:
+        counts = out[column].str.count(r'[\r\n]')
+        column_replacements = int(counts.sum())
+        if column_replacements:
+            out[column] = out[column].str.translate({ord('\n'): ' ', ord('\r'): None})
+            replacements += column_replacements
+    return out, replacements
+
+
+class S3MultipartWriter():
+    '''
+    Writes bytes to an S3 object with a multipart upload, so the object never has to be held in memory.
+
+    Data is buffered until there is a full part of PART_BYTES to upload. If the block inside `with` raises,
+    the upload is aborted and no object is created.
+    '''
+
+    def __init__(self, path, part_bytes=PART_BYTES):
+        self.bucket, self.key = path.replace('s3://', '').split('/', 1)
+        self.part_bytes = part_bytes
+        self.buffer = io.BytesIO()
+        self.parts = []
+        self.upload_id = get_s3_client().create_multipart_upload(Bucket = self.bucket, Key = self.key)['UploadId']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            get_s3_client().abort_multipart_upload(Bucket = self.bucket, Key = self.key, UploadId = self.upload_id)
+
+    def write(self, data: bytes):
+        self.buffer.write(data)
+        if self.buffer.tell() >= self.part_bytes:
+            self.upload_part()
+
+    def upload_part(self):
+        part_number = len(self.parts) + 1
+        response = get_s3_client().upload_part(
+            Bucket = self.bucket,
+            Key = self.key,
+            UploadId = self.upload_id,
+            PartNumber = part_number,
+            Body = self.buffer.getvalue())
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self.buffer = io.BytesIO()
+
+    def close(self):
+        # the last part may be smaller than 5 MB, and an empty object still needs one part
+        if self.buffer.tell() > 0 or not self.parts:
+            self.upload_part()
+        get_s3_client().complete_multipart_upload(
+            Bucket = self.bucket,
+            Key = self.key,
+            UploadId = self.upload_id,
+            MultipartUpload = {'Parts': self.parts})
+
+
+def stream_sanitized_csv(source_path, dest_path, chunksize=CHUNK_ROWS):
+    '''
+    This method copies a CSV from source_path to dest_path chunk by chunk, sanitizing it on the way:
+    line breaks inside fields are replaced (see replace_line_breaks) and column names are cleaned
+    (see replace_spaces_with_underscores). At most chunksize rows are held in memory.
+
+    As in try_read_csv, the encoding is detected from a sample and a UnicodeDecodeError is retried with
+    FALLBACK_ENCODING. The prod copy is always written as UTF-8.
+
+    Returns the sanitized column names and the number of line break characters replaced.
+    '''
+    try:
+        return _stream_sanitized_csv(source_path, dest_path, chunksize, encoding=sample_encoding(source_path))
+    except UnicodeDecodeError:
+        return _stream_sanitized_csv(source_path, dest_path, chunksize, encoding=FALLBACK_ENCODING)
+
+
+def is_clean_csv(path):
+    '''
+    This method streams a CSV object and checks if it can be copied to the prod directory without being rewritten:
+    it must be valid UTF-8, contain no carriage returns, and have no new line characters inside quoted fields.
+
+    A new line character is inside a quoted field if an odd number of quotation marks come before it on its line.
+    The quotation mark count is carried from one chunk to the next, so only one chunk is held in memory.
+    '''
+    bucket, key = path.replace('s3://', '').split('/', 1)
+    body = get_s3_client().get_object(Bucket = bucket, Key = key)['Body']
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    in_quotes = False
+
+    for chunk in body.iter_chunks(chunk_size = PART_BYTES):
+        try:
+            decoder.decode(chunk)
+        except UnicodeDecodeError:
+            return False
+
+        if b'\r' in chunk:
+            return False
+
+        *lines, partial_line = chunk.split(b'\n')
+        for line in lines:
+            in_quotes ^= line.count(b'"') % 2 == 1
+            if in_quotes:
+                return False
+        in_quotes ^= partial_line.count(b'"') % 2 == 1
+
+    try:
+        decoder.decode(b'', final = True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def copy_csv(source_path, dest_path, columns):
+    '''
+    This method copies a clean CSV (see is_clean_csv) from source_path to dest_path.
+
+    If the header is already written as columns, the object is copied server-side and never leaves S3.
+    Otherwise only the header line is rewritten, and the rest of the object is streamed through unchanged.
+    '''
+    source_bucket, source_key = source_path.replace('s3://', '').split('/', 1)
+    dest_bucket, dest_key = dest_path.replace('s3://', '').split('/', 1)
+
+    if read_csv_header(source_path) == columns:
+        logger.info(f'copying {source_path} server-side')
+        get_s3_client().copy({'Bucket': source_bucket, 'Key': source_key}, dest_bucket, dest_key)
+        return
+
+    logger.info(f'rewriting the header of {source_path}')
+    body = get_s3_client().get_object(Bucket = source_bucket, Key = source_key)['Body']
+    with S3MultipartWriter(dest_path) as writer:
+        writer.write(pd.DataFrame(columns=columns).to_csv(index=False).encode('utf-8'))
+
+        header_skipped = False
+        for chunk in body.iter_chunks(chunk_size = PART_BYTES):
+            if not header_skipped:
+                # the header line can't contain a new line character, because the file is clean
+                if b'\n' not in chunk:
+                    continue
+                chunk = chunk[chunk.index(b'\n') + 1:]
+                header_skipped = True
+            writer.write(chunk)
+
+
+def iter_sanitized_chunks(source_path, chunksize=CHUNK_ROWS, encoding=None):
+    '''
+    This method reads a CSV in chunks of chunksize rows and yields each chunk with line breaks inside fields
+    replaced (see replace_line_breaks) and column names cleaned (see replace_spaces_with_underscores), along with
+    the number of line break characters replaced in it.
+    '''
+    for chunk in wr.s3.read_csv(source_path, dtype='str', chunksize=chunksize, encoding=encoding):
+        chunk, replacements = replace_line_breaks(chunk)
+        chunk = replace_spaces_with_underscores(chunk)
+        yield chunk, replacements
+
+
+def _stream_sanitized_csv(source_path, dest_path, chunksize, encoding=None):
+    columns = None
+    replacements = 0
+
+    with S3MultipartWriter(dest_path) as writer:
+        for chunk, chunk_replacements in iter_sanitized_chunks(source_path, chunksize, encoding):
+            replacements += chunk_replacements
+
+            writer.write(chunk.to_csv(index=False, header=columns is None).encode('utf-8'))
+            columns = list(chunk.columns)
+
+        # a file with only a header yields no chunks, so we copy the header on its own
+        if columns is None:
+            chunk = replace_spaces_with_underscores(pd.DataFrame(columns=read_csv_header(source_path)))
+            writer.write(chunk.to_csv(index=False).encode('utf-8'))
+            columns = list(chunk.columns)
+
+    return columns, replacements
 
 
 def replace_spaces_with_underscores(df):
@@ -49,31 +410,104 @@ def replace_spaces_with_underscores(df):
     return df
 
 
-def get_oldest_schema(bucket: str, path: str):
+def load_schema_registry(bucket: str, path: str):
+    '''
+    This method loads the schema registry of a directory, or returns an empty registry if there is none yet.
+
+    The registry is a JSON object saved at _schema_registry/{path}.json in the same bucket. It records the
+    column names, ETag, and last_modified date of every CSV object in the directory, and the column names of
+    the oldest CSV object (the schema every other object is compared to).
+    '''
+    try:
+        response = get_s3_client().get_object(Bucket = bucket, Key = f'{SCHEMA_REGISTRY_PREFIX}/{path}.json')
+        return json.loads(response['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return {'schema': None, 'objects': {}}
+
+
+def save_schema_registry(bucket: str, path: str, registry: dict):
+    '''
+    This method saves the schema registry of a directory.
+    '''
+    get_s3_client().put_object(
+        Bucket = bucket,
+        Key = f'{SCHEMA_REGISTRY_PREFIX}/{path}.json',
+        Body = json.dumps(registry).encode('utf-8'),
+        ContentType = 'application/json')
+
+
+def get_schema_registry(bucket: str, path: str, repair: bool = False):
+    '''
+    This method returns the schema registry of a directory, brought up to date with the objects in it.
+
+    The directory is listed and the listing is compared to the registry. Only CSV objects that are new or whose
+    ETag changed have their header read. Objects that no longer exist are dropped. This way each object's header
+    is read once, instead of every object being read every time a new file arrives.
+
+    If the registry changed, it is saved. Concurrent invocations may overwrite each other's registry, which only
+    means the overwritten objects are read again next time.
+
+    With repair = True, the saved registry is ignored and every object is read again.
+    '''
+    registry = {'schema': None, 'objects': {}} if repair else load_schema_registry(bucket, path)
+
+    csv_objects = {
+        object['Key']: object
+        for object in list_s3_objects(bucket, path + '/')
+        if object['Key'].endswith('.csv')
+    }
+
+    objects = {}
+    for key, object in csv_objects.items():
+        registered = registry['objects'].get(key)
+        if registered and registered['etag'] == object['ETag']:
+            objects[key] = registered
+        else:
+            logger.info(f'Reading header of s3://{bucket}/{key}')
+            objects[key] = {
+                'etag': object['ETag'],
+                'last_modified': object['LastModified'].isoformat(),
+                'columns': read_csv_header(f's3://{bucket}/{key}')
+            }
+
+    if objects != registry['objects']:
+        registry['objects'] = objects
+        if objects:
+            oldest_key = min(objects, key = lambda x: objects[x]['last_modified'])
+            registry['schema'] = objects[oldest_key]['columns']
+        else:
+            registry['schema'] = None
+        save_schema_registry(bucket, path, registry)
+
+    return registry
+
+
+def get_oldest_schema(bucket: str, path: str, cache: bool = True):
     '''
     This method identifies the CSV file with the oldest last_modified date in a directory.
 
-    It returns the list of column names of that CSV file.
+    It returns the list of column names of that CSV file. If the directory's schema registry has the file with
+    the same ETag, the column names come from the registry. Otherwise the file's header is read.
+
+    cache is passed to get_oldest_object.
     '''
     prefix = path + '/'
     logger.info(prefix)
 
-    list_objects_response = s3_client.list_objects(
-        Bucket = bucket,
-        Prefix = prefix)
+    oldest_csv_object = get_oldest_object(bucket, prefix, cache = cache)
 
     # If no files exist in the directory, we can break because there's no schema to compare to
-    if 'Contents' not in list_objects_response:
+    if oldest_csv_object is None:
         return 'No existing files'
 
-    objects_list = list_objects_response['Contents']
-
-    csv_objects_list = [object for object in objects_list if object['Key'].endswith('.csv')]
-    oldest_csv_object = min(csv_objects_list, key = lambda x: x['LastModified'])
     oldest_csv_name = oldest_csv_object['Key']
+    registered = load_schema_registry(bucket, path)['objects'].get(oldest_csv_name)
+    if registered and registered['etag'] == oldest_csv_object['ETag']:
+        return registered['columns']
 
-    oldest_csv_df = try_read_csv(f's3://{bucket}/{oldest_csv_name}')
-    oldest_csv_schema = list(oldest_csv_df.columns)
+    oldest_csv_schema = read_csv_header(f's3://{bucket}/{oldest_csv_name}')
     return oldest_csv_schema
 
 
@@ -102,7 +536,7 @@ def compare_input_schema(new_schema: list, new_object: str, bucket: str, path: s
     return 'Success: new object schema matches existing schema'
 
 
-def compare_existing_schema(bucket: str, path: str, new_object: str = ''):
+def compare_existing_schema(bucket: str, path: str, new_object: str = '', repair: bool = False):
     '''
     This method compares the column names of the existing CSV objects in an S3 directory to the column names of
     the oldest CSV object in the S3 directory.
@@ -111,24 +545,22 @@ def compare_existing_schema(bucket: str, path: str, new_object: str = ''):
     raises an error.
 
     The error names all the CSV objects
+
+    The column names of each object come from the directory's schema registry (see get_schema_registry).
+    With repair = True, the registry is rebuilt by reading every object in the directory.
     '''
-    oldest_schema = get_oldest_schema(bucket, path)
+    registry = get_schema_registry(bucket, path, repair = repair)
 
-    if oldest_schema == 'No existing files':
+    if not registry['objects']:
         return 'No previous schema to compare to'
 
-    objects_list = wr.s3.list_objects(f's3://{bucket}/{path}/*.csv', boto3_session = sess)
-
+    oldest_schema = registry['schema']
     deviant_objects = []
 
-    assert all(obj.endswith('.csv') for obj in objects_list), f'Object(s) in {path} are not CSV files'
-
-    for object in objects_list:
-        if object != f's3://{bucket}/{path}/{new_object}':
-            df = wr.s3.read_csv(object, dtype='str')
-            column_names = list(df.columns)
-            if oldest_schema != column_names:
-                deviant_objects.append(object)
+    for key, registered in registry['objects'].items():
+        if key != f'{path}/{new_object}':
+            if oldest_schema != registered['columns']:
+                deviant_objects.append(f's3://{bucket}/{key}')
 
     assert len(deviant_objects) == 0, f'Column names of existing objects {deviant_objects} do not match oldest schema in {bucket}/{path}'
     return 'Success: consistent existing schema'
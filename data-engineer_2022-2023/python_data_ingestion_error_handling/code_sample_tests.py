@@ -1,9 +1,20 @@
 # utils/aws_lambda/functions/create_athena_table/tests/test_schema_error_handling.py
 
+import io
+
 import pytest
 
+from utils.aws_lambda.functions.create_athena_table import schema_error_handling
 from utils.aws_lambda.functions.create_athena_table.schema_error_handling import (
-    compare_existing_schema, compare_input_schema, get_oldest_schema, try_read_csv)
+    compare_existing_schema, compare_input_schema, get_oldest_schema, is_clean_csv, read_csv_header, try_read_csv)
+from utils.aws_lambda.functions.create_athena_table.tests.local_aws import (
+    FIXTURE_COLUMNS, cold_start_benchmark, local_aws, make_csv, make_directory, make_event)
+
+
+@pytest.fixture
+def local_s3():
+    with local_aws() as s3:
+        yield s3
 
 
 def test_get_oldest_schema():
@@ -15,6 +26,81 @@ def test_get_oldest_schema():
     assert oldest_schema == ['year', 'county', 'case_category', 'case_type', 'case_type_code', 'variable', 'value']
 
 
+def test_read_csv_header():
+    '''
+    This tests that read_csv_header returns the same column names as reading the whole file.
+    '''
+    path = 's3://court-data-management/test_files/misaligned_schema/fake_data_misaligned_schema.csv'
+
+    assert read_csv_header(path) == list(try_read_csv(path).columns)
+
+
+def test_read_csv_header_long_header(monkeypatch):
+    '''
+    This tests read_csv_header with a header longer than the first ranged GET, including a quoted
+    column name containing a comma and a new line character.
+    '''
+    content = b'year,county,"case, category\ntype",value\n' + b'2020,Shelby,eviction,1\n' * 100
+
+    class FakeS3Client():
+        def get_object(self, Bucket, Key, Range):
+            end = int(Range.split('-')[1])
+            return {'Body': io.BytesIO(content[:end + 1])}
+
+    monkeypatch.setattr(schema_error_handling, 's3_client', FakeS3Client())
+
+    column_names = read_csv_header('s3://court-data-management/test_files/long_header.csv', header_bytes = 8)
+
+    assert column_names == ['year', 'county', 'case, category\ntype', 'value']
+
+
+def test_read_csv_header_quoted_rows(monkeypatch):
+    '''
+    This tests that read_csv_header stops at a complete header even when a quoted field in a later row has a new line
+    character and an odd number of quotes falls in the first ranged GET.
+    '''
+    content = b'year,county,value\n2020,"Shelby\nTN",1\n' + b'2020,Shelby,1\n' * 100
+    ranges = []
+
+    class FakeS3Client():
+        def get_object(self, Bucket, Key, Range):
+            ranges.append(Range)
+            end = int(Range.split('-')[1])
+            return {'Body': io.BytesIO(content[:end + 1])}
+
+    monkeypatch.setattr(schema_error_handling, 's3_client', FakeS3Client())
+
+    column_names = read_csv_header('s3://court-data-management/test_files/quoted_rows.csv', header_bytes = 30)
+
+    assert column_names == ['year', 'county', 'value']
+    assert ranges == ['bytes=0-29']
+
+
+@pytest.mark.parametrize('content, clean', [
+    (b'year,county\n2020,"Shelby, TN"\n', True),
+    (b'year,county\n2020,"Shelby\nTN"\n', False),
+    (b'year,county\r\n2020,Shelby\r\n', False),
+    ('year,county\n2020,Do\u00f1a Ana\n'.encode('latin-1'), False),
+])
+def test_is_clean_csv(monkeypatch, content, clean):
+    '''
+    This tests is_clean_csv with files that can and can't be copied to the prod directory without being rewritten.
+    The chunks are smaller than a line so quotation marks are counted across chunks.
+    '''
+    class FakeBody(io.BytesIO):
+        def iter_chunks(self, chunk_size):
+            return iter(lambda: self.read(chunk_size), b'')
+
+    class FakeS3Client():
+        def get_object(self, Bucket, Key):
+            return {'Body': FakeBody(content)}
+
+    monkeypatch.setattr(schema_error_handling, 's3_client', FakeS3Client())
+    monkeypatch.setattr(schema_error_handling, 'PART_BYTES', 4)
+
+    assert is_clean_csv('s3://court-data-management/test_files/clean.csv') == clean
+
+
 def test_compare_input_schema_warning():
     '''
     This tests compare_input_schema with inputs that should result in a warning being raised.
@@ -96,4 +182,181 @@ def test_compare_existing_schema_no_warning():
         path = path
     )
 
-    assert success_message == 'Success: consistent existing schema'
\ No newline at end of file
+    assert success_message == 'Success: consistent existing schema'
+
+
+@pytest.mark.parametrize('misaligned', [0, 1])
+def test_compare_existing_schema_local(local_s3, misaligned):
+    '''
+    This tests compare_existing_schema offline, with a directory of more objects than fit in one page of a listing.
+    '''
+    bucket = 'court-data-management'
+    path = 'test_files/large_directory'
+    keys = make_directory(local_s3, bucket, path, objects = 1001, misaligned = misaligned)
+
+    if misaligned:
+        with pytest.raises(AssertionError) as record:
+            compare_existing_schema(bucket = bucket, path = path)
+        assert str(record.value) == f"Column names of existing objects ['s3://{bucket}/{keys[-1]}'] do not match oldest schema in {bucket}/{path}"
+    else:
+        assert compare_existing_schema(bucket = bucket, path = path) == 'Success: consistent existing schema'
+
+
+def test_lambda_handler_local(local_s3):
+    '''
+    This tests that the lambda handler copies a new file with aligned schema to the prod directory
+    and creates its Glue table, offline.
+    '''
+    from utils.aws_lambda.functions.create_athena_table import lambda_function
+
+    bucket = 'court-data-management'
+    path = 'test_files/aligned_schema'
+    make_directory(local_s3, bucket, path, objects = 3)
+    local_s3.put_object(Bucket = bucket, Key = f'{path}/new_file.csv', Body = make_csv(FIXTURE_COLUMNS, rows = 5))
+
+    result = lambda_function.lambda_handler(make_event(bucket, f'{path}/new_file.csv'), None)
+
+    assert result == {'result': 'success'}
+    assert read_csv_header(f's3://{bucket}/{lambda_function.dest_csv_path}/{path}/new_file.csv') == FIXTURE_COLUMNS
+    assert lambda_function.wr.get_table_types(lambda_function.GLUE_DATABASE, 'src_new_file') == {
+        column: 'string' for column in FIXTURE_COLUMNS}
+
+
+def test_lambda_handler_batch_reports_failure_local(local_s3, monkeypatch):
+    '''
+    This tests that in an SQS batch, a file with inconsistent schema is returned for retry and reported to Sentry,
+    while the file in the other directory is still processed, offline.
+    '''
+    import json
+    import os
+
+    from utils.aws_lambda.functions.create_athena_table import lambda_function
+
+    reported = []
+    monkeypatch.setattr(lambda_function.sentry_sdk, 'capture_exception', reported.append)
+    bucket = 'court-data-management'
+    objects = ['test_files/aligned_schema/new_file.csv', 'test_files/misaligned_schema/bad_file.csv']
+    for object, columns in zip(objects, [FIXTURE_COLUMNS, FIXTURE_COLUMNS[::-1]]):
+        make_directory(local_s3, bucket, os.path.dirname(object), objects = 3)
+        local_s3.put_object(Bucket = bucket, Key = object, Body = make_csv(columns, rows = 5))
+    event = {'Records': [{'messageId': object, 'body': json.dumps(make_event(bucket, object))} for object in objects]}
+
+    result = lambda_function.lambda_handler(event, None)
+
+    assert [r['result'] for r in result['results']] == ['success', 'failure']
+    assert result['batchItemFailures'] == [{'itemIdentifier': objects[1]}]
+    assert len(reported) == 1 and isinstance(reported[0], AssertionError)
+
+
+def test_lambda_cold_start_local():
+    '''
+    This tests that importing the lambda in a new process creates no AWS clients and makes no requests, offline.
+    '''
+    result = cold_start_benchmark(repeats = 1).iloc[0]
+
+    assert result['import_clients'] == 0
+    assert result['import_s3_requests'] == 0
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_generate_table_unchanged_local(local_s3, monkeypatch, output_format):
+    '''
+    This tests that processing the same file again leaves its Glue table definition alone, offline.
+    A Parquet table only has the file's partition added, once.
+    '''
+    from utils.aws_lambda.functions.create_athena_table import lambda_function
+
+    monkeypatch.setattr(lambda_function, 'OUTPUT_FORMAT', output_format)
+    bucket = 'court-data-management'
+    path = 'test_files/aligned_schema'
+    make_directory(local_s3, bucket, path, objects = 3)
+
+    table_updates = []
+    for _ in range(2):
+        local_s3.put_object(Bucket = bucket, Key = f'{path}/new_file.csv', Body = make_csv(FIXTURE_COLUMNS, rows = 5))
+        local_s3.calls.clear()
+        assert lambda_function.lambda_handler(make_event(bucket, f'{path}/new_file.csv'), None) == {'result': 'success'}
+        table_updates.append(local_s3.calls['glue_update_table'])
+
+    assert table_updates == [1, 0]
+    if output_format == 'parquet':
+        assert len(lambda_function.wr.load_table(lambda_function.GLUE_DATABASE, 'src_new_file')['partitions']) == 1
+
+
+def test_cast_columns_types():
+    '''
+    This tests that cast_columns_types keeps every digit of large integers next to empty values, and that a date
+    matching the date pattern but not existing makes its column fall back to string instead of raising an error.
+    '''
+    import pandas as pd
+    from utils.aws_lambda.functions.create_athena_table.lambda_function import cast_columns_types
+
+    df = pd.DataFrame({'case_id': ['12345678901234567', None], 'date_filed': ['2022-02-30', '2022-03-01']}, dtype = 'object')
+
+    cast_df, failed_columns = cast_columns_types(df, {'case_id': 'bigint', 'date_filed': 'date'})
+
+    assert cast_df['case_id'].tolist()[0] == 12345678901234567
+    assert cast_df['case_id'].isna().tolist() == [False, True]
+    assert failed_columns == ['date_filed']
+
+
+def test_parquet_tables_cover_directory_local(local_s3, monkeypatch):
+    '''
+    This tests that in parquet mode every src_ table of a directory has the partitions of every file in it, and that
+    a new file is checked against the columns of the Parquet dataset, offline.
+    '''
+    from utils.aws_lambda.functions.create_athena_table import lambda_function
+
+    monkeypatch.setattr(lambda_function, 'OUTPUT_FORMAT', 'parquet')
+    bucket = 'court-data-management'
+    path = 'test_files/parquet_directory'
+
+    for object in ['first_file.csv', 'second_file.csv']:
+        local_s3.put_object(Bucket = bucket, Key = f'{path}/{object}', Body = make_csv(FIXTURE_COLUMNS, rows = 5))
+        assert lambda_function.lambda_handler(make_event(bucket, f'{path}/{object}'), None) == {'result': 'success'}
+
+    for table in ['src_first_file', 'src_second_file']:
+        partitions = lambda_function.wr.load_table(lambda_function.GLUE_DATABASE, table)['partitions']
+        assert sorted(values for _, values in partitions) == [['first_file'], ['second_file']]
+
+    # remove the staging files so only the Parquet dataset has the old columns
+    for object in ['first_file.csv', 'second_file.csv']:
+        local_s3.delete_object(Bucket = bucket, Key = f'{path}/{object}')
+    local_s3.put_object(Bucket = bucket, Key = f'{path}/third_file.csv', Body = make_csv(FIXTURE_COLUMNS[::-1], rows = 5))
+
+    with pytest.raises(AssertionError) as record:
+        lambda_function.lambda_handler(make_event(bucket, f'{path}/third_file.csv'), None)
+    assert str(record.value) == f'Column names of third_file.csv do not match existing schema in {bucket}/{lambda_function.dest_parquet_path}/{path}'
+
+
+def test_clean_bucket_resume_local(local_s3, tmp_path):
+    '''
+    This tests that the bucket audit flags an inconsistent directory, and that a resumed audit skips the directories
+    in its checkpoint file (including none from a checkpoint cut short) and produces the same report, offline.
+    '''
+    from utils.aws_lambda.functions.create_athena_table.utils.clean_bucket import main
+
+    bucket = 'court-data-management'
+    keys = {
+        directory: make_directory(local_s3, bucket, f'verification/{directory}', objects = 5, misaligned = misaligned)
+        for directory, misaligned in [('county_a', 0), ('county_b', 2), ('state/county_c', 0)]
+    }
+
+    report = main('report.json', bucket, directory = 'verification', max_workers = 2, report_dir = str(tmp_path))
+
+    assert list(report['inconsistent_directories']) == ['verification/county_b']
+    assert report['inconsistent_directories']['verification/county_b']['deviant_objects'] == keys['county_b'][-2:]
+    assert sorted(report['checked_directories']) == ['verification/county_a', 'verification/county_b', 'verification/state/county_c']
+
+    # keep one checkpoint and cut the next one short, as if the audit was interrupted
+    with open(tmp_path / 'report.json.jsonl') as f:
+        lines = f.readlines()
+    with open(tmp_path / 'report.json.jsonl', 'w') as f:
+        f.write(lines[0] + lines[1][:10])
+    local_s3.calls.clear()
+
+    resumed_report = main('report.json', bucket, directory = 'verification', max_workers = 2, resume = True, report_dir = str(tmp_path))
+
+    assert local_s3.calls['get_object'] == 10
+    assert resumed_report['inconsistent_directories'] == report['inconsistent_directories']
+    assert sorted(resumed_report['checked_directories']) == sorted(report['checked_directories'])
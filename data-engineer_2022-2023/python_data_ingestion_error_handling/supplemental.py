@@ -1,31 +1,55 @@
 # utils/aws_lambda/functions/create_athena_table/lambda_function.py
 
+import json
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
 
 import awswrangler as wr
-import boto3
 import pandas as pd
+import pyarrow as pa
+import sentry_sdk
 from loguru import logger
 
 from c2dp.monitoring.sentry import AD_HOC_DATA_INGESTION_DSN, load_sentry
 from utils.aws_lambda.functions.create_athena_table.schema_error_handling import (
-    compare_existing_schema, compare_input_schema, replace_line_breaks,
-    try_read_csv, replace_spaces_with_underscores)
-
-load_sentry(sentry_dsn = AD_HOC_DATA_INGESTION_DSN)
+    FALLBACK_ENCODING, clear_listing_cache, compare_existing_schema, compare_input_schema, copy_csv, get_session,
+    is_clean_csv, iter_s3_objects, iter_sanitized_chunks, read_csv_header, replace_spaces_with_underscores,
+    sample_encoding, stream_sanitized_csv)
 
 dest_csv_path = os.getenv('DEST_CSV_PATH', default='athena') # default for testing individual methods
 GLUE_DATABASE = os.getenv('GLUE_DATABASE', default='c2dp') # default for testing individual methods
 
-client = boto3.client('sts') # aws security token service
-sess = boto3.Session(region_name='us-east-1')
+# 'csv' copies new files to dest_csv_path as CSVs. 'parquet' writes them to dest_parquet_path as typed Parquet instead.
+OUTPUT_FORMAT = os.getenv('OUTPUT_FORMAT', default='csv')
+dest_parquet_path = os.getenv('DEST_PARQUET_PATH', default='athena_parquet')
+SAMPLE_ROWS = 10000 # rows used to infer column types
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', default='8')) # directories processed at once in a batch
+
+# Values that may be typed. Integers with leading zeros (zip codes, FIPS codes, etc.) are kept as strings.
+TYPE_PATTERNS = {
+    'bigint': re.compile(r'^-?(0|[1-9][0-9]{0,17})$'),
+    'double': re.compile(r'^-?(0|[1-9][0-9]*)?\.[0-9]+$|^-?(0|[1-9][0-9]*)$'),
+    'boolean': re.compile(r'^(true|false)$', re.IGNORECASE),
+    'date': re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2}$'),
+    'timestamp': re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2}[ T][0-9]{2}:[0-9]{2}:[0-9]{2}(\.[0-9]+)?$')
+}
+
+# Nothing at import makes a network call or creates an AWS client, so a cold start only pays for the imports.
+# The boto3 session and S3 client are shared with schema_error_handling (see get_session) and Sentry is loaded
+# by the first invocation (see load_monitoring); all three are then reused across warm invocations.
+sentry_loaded = False
 
-s3_client = boto3.client('s3', region_name='us-east-1')
-athena_client = boto3.client('athena', region_name='us-east-1')
 
-caller_id = client.get_caller_identity()
-account_id = caller_id['Account']
-region = os.environ['AWS_REGION']
+def load_monitoring():
+    '''
+    This function loads Sentry on the first invocation of the lambda.
+    '''
+    global sentry_loaded
+    if not sentry_loaded:
+        load_sentry(sentry_dsn = AD_HOC_DATA_INGESTION_DSN)
+        sentry_loaded = True
 
 
 @logger.catch(reraise=True)
@@ -40,6 +64,122 @@ def generate_columns_types(df: pd.DataFrame):
     return columns_types
 
 
+@logger.catch(reraise=True)
+def infer_columns_types(df: pd.DataFrame):
+    """
+    generate the column types dictionary for wr.s3.to_parquet() from a sample of string data.
+    A column gets the first type in TYPE_PATTERNS that every non-empty value in the sample matches.
+    Columns with no values, or values matching no pattern, are cast as strings.
+
+    """
+    columns_types = {}
+    for _name in df.columns:
+        values = df[_name].dropna()
+        columns_types[_name] = 'string'
+        if len(values) == 0:
+            continue
+        for _type, pattern in TYPE_PATTERNS.items():
+            if values.str.match(pattern).all():
+                columns_types[_name] = _type
+                break
+    return columns_types
+
+
+def cast_columns_types(df: pd.DataFrame, columns_types: dict):
+    '''
+    Casts string data to the types in columns_types. Empty values stay empty.
+
+    Returns the cast data and the list of columns that had values which could not be cast, including dates and
+    timestamps that match their pattern but don't exist (e.g. 2022-02-30).
+    '''
+    out = df.copy()
+    failed_columns = []
+    for _name, _type in columns_types.items():
+        values = df[_name]
+        if _type != 'string' and not values.dropna().str.match(TYPE_PATTERNS[_type]).all():
+            failed_columns.append(_name)
+        elif _type == 'bigint':
+            # the strings are cast straight to int64, since going through float64 rounds integers past 2**53
+            integers = pa.array(values, type=pa.string()).cast(pa.int64())
+            out[_name] = pd.arrays.IntegerArray(
+                integers.fill_null(0).to_numpy(), integers.is_null().to_numpy(zero_copy_only=False))
+        elif _type == 'double':
+            out[_name] = pd.to_numeric(values).astype('float64')
+        elif _type == 'boolean':
+            out[_name] = values.str.lower().map({'true': True, 'false': False}).astype('boolean')
+        elif _type in ('date', 'timestamp'):
+            dates = pd.to_datetime(values, format='%Y-%m-%d' if _type == 'date' else 'ISO8601', errors='coerce')
+            if (dates.isna() & values.notna()).any():
+                failed_columns.append(_name)
+            else:
+                out[_name] = dates.dt.date if _type == 'date' else dates
+    return out, failed_columns
+
+
+@logger.catch(reraise=True)
+def write_parquet_table(bucket, object, database, table):
+    '''
+    This function writes a new file to the prod directory as Parquet and registers it in a Glue table.
+
+    Each source file is written to its own source_file partition, and the partition is overwritten if the same
+    file is uploaded again. The Glue table is then created or updated only if its definition changed, and every
+    partition of the directory is added to it (see generate_parquet_table).
+
+    If the directory already has Parquet data, the new file is cast to its column types, and values that don't fit
+    raise an error. Otherwise the column types are inferred from the first SAMPLE_ROWS rows, and any column with a
+    later value that doesn't fit its inferred type falls back to string and the file is written again.
+    As in try_read_csv, the encoding is detected from a sample and a UnicodeDecodeError is retried with FALLBACK_ENCODING.
+    '''
+    source_path = f's3://{bucket}/{object}'
+    dataset_prefix = f'{dest_parquet_path}/{os.path.dirname(object)}/'
+    dataset_path = f's3://{bucket}/{dataset_prefix}'
+    source_file = os.path.basename(object).replace('.csv', '')
+    parquet_keys = [o['Key'] for o in iter_s3_objects(bucket, dataset_prefix) if o['Key'].endswith('.parquet')]
+    source_files = sorted({re.search(r'/source_file=([^/]+)/', key).group(1) for key in parquet_keys} | {source_file})
+    has_existing_data = len(parquet_keys) > 0
+    if has_existing_data:
+        columns_types, _ = wr.s3.read_parquet_metadata(path=dataset_path, dataset=True, boto3_session=get_session())
+        columns_types.pop('source_file', None)
+    else:
+        columns_types = None
+
+    encoding = sample_encoding(source_path)
+    while True:
+        try:
+            mode = 'overwrite_partitions'
+            for chunk, _ in iter_sanitized_chunks(source_path, chunksize=SAMPLE_ROWS, encoding=encoding):
+                if columns_types is None:
+                    columns_types = infer_columns_types(chunk)
+                    logger.info(f'inferred columns types: {columns_types}')
+
+                chunk, failed_columns = cast_columns_types(chunk, columns_types)
+                assert not (failed_columns and has_existing_data), \
+                    f'Values of {failed_columns} in {object} do not match the column types in {dataset_path}'
+                if failed_columns:
+                    logger.info(f'casting {failed_columns} as strings and rewriting {object}')
+                    columns_types.update({_name: 'string' for _name in failed_columns})
+                    break
+
+                chunk['source_file'] = source_file
+                wr.s3.to_parquet(
+                    chunk,
+                    path=dataset_path,
+                    dataset=True,
+                    partition_cols=['source_file'],
+                    mode=mode,
+                    dtype=columns_types,
+                    boto3_session=get_session()
+                )
+                mode = 'append'
+            else:
+                generate_parquet_table(database, table, columns_types, dataset_path, source_file, source_files)
+                return columns_types
+        except UnicodeDecodeError:
+            if encoding == FALLBACK_ENCODING:
+                raise
+            encoding = FALLBACK_ENCODING
+
+
 @logger.catch(reraise=True)
 def check_schemas(df, bucket, object):
     '''
@@ -68,20 +208,62 @@ def check_schemas(df, bucket, object):
     logger.info(new_schema)
 
     # Compare column names of new object and existing objects in destination directory
+    if OUTPUT_FORMAT == 'parquet':
+        compare_parquet_schema(new_schema = new_schema, new_object = object_name, bucket = bucket, path = f'{dest_parquet_path}/{path_name}')
+        return df
     destination_path_name = f'{dest_csv_path}/{path_name}'
     compare_input_schema(new_schema = new_schema, new_object = object_name, bucket = bucket, path = destination_path_name, staging = False)
     compare_existing_schema(new_object = object_name, bucket = bucket, path = destination_path_name)
     return df
 
 
+def compare_parquet_schema(new_schema: list, new_object: str, bucket: str, path: str):
+    '''
+    This function compares the column names of the new file to the column names of a Parquet dataset in the prod
+    directory, which is where new files go when OUTPUT_FORMAT is 'parquet'. The source_file partition column is
+    not compared.
+
+    The columns come from the dataset's Parquet metadata, and awswrangler raises an error if the files in the
+    dataset don't share a schema, so this covers both checks made on a CSV directory.
+    '''
+    if not any(o['Key'].endswith('.parquet') for o in iter_s3_objects(bucket, f'{path}/')):
+        return 'No previous schema to compare to'
+
+    columns_types, _ = wr.s3.read_parquet_metadata(path=f's3://{bucket}/{path}/', dataset=True, boto3_session=get_session())
+    existing_schema = [_name for _name in columns_types if _name != 'source_file']
+
+    assert new_schema == existing_schema, f'Column names of {new_object} do not match existing schema in {bucket}/{path}'
+    return 'Success: new object schema matches existing schema'
+
+
+def get_table_definition(database, table):
+    '''
+    This function returns the column names and types (including partition columns, in order) and the location of
+    a Glue table, or None if the table doesn't exist. It only reads the table, so it is much cheaper than rewriting it.
+    '''
+    columns_types = wr.catalog.get_table_types(database=database, table=table, boto3_session=get_session())
+    if columns_types is None:
+        return None
+    location = wr.catalog.get_table_location(database=database, table=table, boto3_session=get_session())
+    return list(columns_types.items()), location.rstrip('/')
+
+
 @logger.catch(reraise=True)
 def generate_table(database, table, schema, path):
     '''
-    Creates a csv table in AWS Glue
+    Creates a csv table in AWS Glue, or replaces its definition if its columns or location changed.
+
+    Every file in a directory shares the directory's column names, so usually the table already exists exactly as it
+    would be written and the catalog is left alone. Column order is compared too, since OpenCSVSerde reads columns by
+    position. Returns True if the table was written.
     '''
     
     _table = f"src_{table}".replace('-', '_')
 
+    if get_table_definition(database, _table) == (list(schema.items()), path.rstrip('/')):
+        logger.info(f'table {database}.{_table} is unchanged')
+        return False
+
     logger.info(f'creating or updating table: {database}.{_table}')
 
     wr.catalog.create_csv_table(
@@ -89,11 +271,64 @@ def generate_table(database, table, schema, path):
         table=_table,
         path=path,
         columns_types=schema,
-        boto3_session=sess,
+        boto3_session=get_session(),
         skip_header_line_count=1,
         mode='overwrite',
         serde_library = 'org.apache.hadoop.hive.serde2.OpenCSVSerde'
     )
+    return True
+
+
+@logger.catch(reraise=True)
+def generate_parquet_table(database, table, columns_types, path, source_file, source_files=None):
+    '''
+    Creates or updates a Parquet table in AWS Glue if its columns or location changed, then adds the partitions
+    of source_files (every file in the directory, default just source_file).
+
+    Like a csv table, which reads every file in its directory, each src_ table of a directory covers every file in
+    it: the new table gets every partition, and the new file's partition is added to the tables of the other files.
+
+    The table is updated in place rather than overwritten, so its existing partitions are kept. Adding a partition
+    that already exists (the same file uploaded again) leaves it as is. Returns True if the table definition was written.
+    '''
+    _table = f"src_{table}".replace('-', '_')
+    partitions_types = {'source_file': 'string'}
+    source_files = source_files or [source_file]
+    dataset_path = path.rstrip('/')
+
+    updated = get_table_definition(database, _table) != (list({**columns_types, **partitions_types}.items()), path.rstrip('/'))
+    if updated:
+        logger.info(f'creating or updating table: {database}.{_table}')
+        wr.catalog.create_parquet_table(
+            database=database,
+            table=_table,
+            path=path,
+            columns_types=columns_types,
+            partitions_types=partitions_types,
+            mode='update',
+            boto3_session=get_session()
+        )
+
+    logger.info(f'adding {len(source_files)} source_file partitions to {database}.{_table}')
+    wr.catalog.add_parquet_partitions(
+        database=database,
+        table=_table,
+        partitions_values={f'{dataset_path}/source_file={_source_file}/': [_source_file] for _source_file in source_files},
+        boto3_session=get_session()
+    )
+
+    for _source_file in source_files:
+        _other_table = f"src_{_source_file}".replace('-', '_')
+        if _other_table == _table or not wr.catalog.does_table_exist(database=database, table=_other_table, boto3_session=get_session()):
+            continue
+        logger.info(f'adding partition source_file={source_file} to {database}.{_other_table}')
+        wr.catalog.add_parquet_partitions(
+            database=database,
+            table=_other_table,
+            partitions_values={f'{dataset_path}/source_file={source_file}/': [source_file]},
+            boto3_session=get_session()
+        )
+    return updated
 
 
 @logger.catch(reraise=True)
@@ -101,8 +336,12 @@ def make_table(bucket, object, database=GLUE_DATABASE):
     '''
     This function completes all three main steps that happen when processing a new file.
     1. check_schemas: Ensures that the column names of the new file match the existing column names.
-    2. wr.s3.to_csv: Copies the CSV from the staging directory to the prod directory.
+    2. stream_sanitized_csv: Copies the CSV from the staging directory to the prod directory chunk by chunk,
+        replacing line breaks inside fields. If the CSV has no line breaks inside fields, copy_csv copies it
+        server-side instead (rewriting only the header line if its column names changed).
     3. generate_table: Creates or updates an AWS Glue table.
+
+    The schema checks only need the column names, so they run on a header-only dataframe.
     '''
 
     if object.endswith('/'): # skip over folders
@@ -112,17 +351,28 @@ def make_table(bucket, object, database=GLUE_DATABASE):
     # We work exclusively with CSVs for ad hoc data
     assert object.endswith('.csv'), f'New object {object} is not a CSV file'
 
-    df = try_read_csv(f's3://{bucket}/{object}')
-    df = replace_line_breaks(df) # new line characters can cause issues in Athena tables
+    original_columns = read_csv_header(f's3://{bucket}/{object}')
+    df = pd.DataFrame(columns=original_columns)
 
     # All checks happen when the object arrives in the staging directory,
     # before it is moved to the prod directory and added to the Glue table
     df = check_schemas(df, bucket, object)
 
+    if OUTPUT_FORMAT == 'parquet':
+        logger.info(f'writing to s3 as parquet: {bucket}/{dest_parquet_path}/{object}')
+        write_parquet_table(bucket, object, database, table=os.path.basename(object).replace('.csv', ''))
+        return {'result': 'success'}
+
     new_file = f's3://{bucket}/{dest_csv_path}/{object}'
     logger.info(f'writing to s3: {new_file}')
-    # Copy object into prod directory
-    wr.s3.to_csv(df, path=new_file, index=False)
+    # Copy object into prod directory, replacing new line characters which can cause issues in Athena tables.
+    # A clean file whose header only needed renaming (not dropping columns) skips the rewrite.
+    if len(df.columns) == len(original_columns) and is_clean_csv(f's3://{bucket}/{object}'):
+        copy_csv(f's3://{bucket}/{object}', new_file, list(df.columns))
+    else:
+        _, replacements = stream_sanitized_csv(f's3://{bucket}/{object}', new_file)
+        logger.info(f'replaced {replacements} line break characters')
+    clear_listing_cache(bucket, f'{dest_csv_path}/{os.path.dirname(object)}/')
     
     # create a table based on the new file
     _columns_types = generate_columns_types(df)
@@ -131,23 +381,98 @@ def make_table(bucket, object, database=GLUE_DATABASE):
         database=database,
         table=os.path.basename(new_file).replace('.csv', ''),
         schema=_columns_types,
-        path=os.path.dirname(new_file),
-        project='c2dp'
+        path=os.path.dirname(new_file)
     )
 
     return {'result': 'success'}
 
 
+def get_event_records(event):
+    '''
+    This function returns the new objects in an event as a list of (record_id, bucket, object) tuples.
+
+    It accepts a single EventBridge event (as sent by the S3 trigger), a batch of EventBridge events or S3 notifications
+    (as sent by SQS, where each record's body is the event), or a list of EventBridge events (e.g. an archive replay).
+    record_id is the SQS messageId when there is one, so failed records can be returned for retry.
+    '''
+    if isinstance(event, list):
+        return [record for _event in event for record in get_event_records(_event)]
+
+    if 'detail' in event:
+        return [(event.get('id'), event['detail']['bucket']['name'], event['detail']['object']['key'])]
+
+    records = []
+    for record in event.get('Records', []):
+        if 's3' in record:
+            # S3 notifications URL encode object keys
+            records.append((record.get('messageId'), record['s3']['bucket']['name'], unquote_plus(record['s3']['object']['key'])))
+        else:
+            for _, _bucket, _object in get_event_records(json.loads(record['body'])):
+                records.append((record['messageId'], _bucket, _object))
+    return records
+
+
+def make_tables(bucket, objects):
+    '''
+    This function runs make_table for each new object in one directory, in order, and returns a dict of
+    object to result. A failing object does not stop the others: its result is 'failure' with the error, and the error
+    is logged with its traceback and reported to Sentry, since it isn't raised to the handler.
+
+    Objects in one directory share the schema registry and S3 listings, so they are processed one at a time
+    and the listings are only made once (see list_s3_objects).
+    '''
+    results = {}
+    for object in objects:
+        try:
+            results[object] = make_table(bucket, object)
+        except Exception as e:
+            logger.exception(f'Error processing {bucket}/{object}')
+            sentry_sdk.capture_exception(e)
+            results[object] = {'result': 'failure', 'error': f'{type(e).__name__}: {e}'}
+    return results
+
+
 @logger.catch(reraise=True)
 def lambda_handler(event, context):
     """
-    when a new csv arrives in a staging directory on S3, this handler duplicates the csv
+    when new csvs arrive in staging directories on S3, this handler duplicates each csv
     in the respective prod directory and then creates a table in AWS Glue
+
+    a batch of new csvs is grouped by directory and the directories are processed concurrently.
+    a single event raises any error as before; a batch returns the result for each object and,
+    for SQS, the failed messages in batchItemFailures so only those are retried
     """
+    load_monitoring()
     logger.info(f'event: {event}')
-    for record in [event]:
-        logger.info(f'record: {record}')
-        _bucket = record['detail']['bucket']['name']
-        _object = record['detail']['object']['key']
 
-        make_table(_bucket, _object) # main function
\ No newline at end of file
+    # S3 listings are only cached for the duration of one invocation
+    clear_listing_cache()
+
+    records = get_event_records(event)
+    if len(records) == 1 and 'detail' in event:
+        _, _bucket, _object = records[0]
+        return make_table(_bucket, _object) # main function
+
+    directories = {}
+    for _, _bucket, _object in records:
+        directories.setdefault((_bucket, os.path.dirname(_object)), []).append(_object)
+    logger.info(f'processing {len(records)} objects in {len(directories)} directories')
+
+    with ThreadPoolExecutor(max_workers = MAX_WORKERS) as executor:
+        futures = {
+            (_bucket, directory): executor.submit(make_tables, _bucket, list(dict.fromkeys(objects)))
+            for (_bucket, directory), objects in directories.items()
+        }
+        results = {(_bucket, directory): future.result() for (_bucket, directory), future in futures.items()}
+
+    response = {'results': [], 'batchItemFailures': []}
+    failed_ids = set()
+    for record_id, _bucket, _object in records:
+        result = results[(_bucket, os.path.dirname(_object))][_object]
+        response['results'].append({'bucket': _bucket, 'object': _object, **result})
+        if result['result'] == 'failure' and record_id and record_id not in failed_ids:
+            failed_ids.add(record_id)
+            response['batchItemFailures'].append({'itemIdentifier': record_id})
+
+    logger.info(f"{len(response['batchItemFailures'])} failed records")
+    return response
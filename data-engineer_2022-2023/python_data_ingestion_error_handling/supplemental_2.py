@@ -1,14 +1,13 @@
 # utils/aws_lambda/functions/create_athena_table/utils/clean_bucket.py
 
+import json
 import os
-import awswrangler as wr
-import logging
-from loguru import logger
-import boto3
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-from utils.aws_lambda.functions.create_athena_table.schema_error_handling import compare_existing_schema
+from loguru import logger
 
-sess = boto3.Session(region_name='us-east-1')
+from utils.aws_lambda.functions.create_athena_table.schema_error_handling import (
+    SCHEMA_REGISTRY_PREFIX, get_s3_client, iter_s3_objects, read_csv_header)
 
 '''
 This script is designed to identify inconsistent schema in directories in the court-data-management AWS S3 bucket.
@@ -18,61 +17,216 @@ so each CSV needs to have identical schema (column names) for the Glue table to
 which feed into it.
 
 This script crawls over all the directories in court-data-management (excluding the /test_files directory) to the lowest
-level directories. It then uses the schema_error_handling methods to identify directories containing inconsistent schema.
+level directories. It lists the top-level prefixes of the bucket concurrently, then reads the header of every CSV concurrently (see
+schema_error_handling.read_csv_header) and compares the column names of each CSV to those of the oldest CSV in its directory.
+Only a bounded number of header reads are queued at once, so memory use doesn't grow with the size of the bucket.
+
+The results are saved as a JSON report listing:
+- non_csv_objects: objects that are not CSVs
+- mixed_directories: directories containing both CSVs and directories
+- inconsistent_directories: for each directory with inconsistent schema, the oldest schema and the objects that deviate from it
+- unreadable_objects: for each CSV whose header could not be read, the error
+- checked_directories: the directories that have been fully checked
+
+As each directory is checked, its results are appended as one JSON line to a checkpoint file next to the report, so an
+interrupted run can be resumed with resume=True. The report is saved once all directories are checked.
 
 With this information, we can quickly go through these inconsistent directories and decide how to handle the inconsistencies.
 '''
 
 
-def main(output_file: str, bucket, directory: str = None, ignore_prefix_list: list = None):
+def list_prefixes(bucket: str, prefix: str):
+    '''
+    This function lists one level of a prefix, following pagination. It returns the objects directly under the prefix
+    (as from iter_s3_objects) and the prefixes of its subdirectories.
+    '''
+    objects, subdirectory_prefixes = [], []
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket = bucket, Prefix = prefix, Delimiter = '/'):
+        objects.extend({'Key': o['Key'], 'LastModified': o['LastModified']} for o in page.get('Contents', []))
+        subdirectory_prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+    return objects, subdirectory_prefixes
+
+
+def list_objects(bucket: str, directory: str = None, ignore_prefix_list: list = None, max_workers: int = 32):
+    '''
+    This function lists every object under a directory and returns a dict of key to last_modified date.
+    Objects under any prefix in ignore_prefix_list are left out.
+
+    The directory's subdirectories are listed concurrently by up to max_workers threads, each following its own pagination.
+    '''
+    prefix = f'{directory}/' if directory else ''
+    ignore_prefixes = tuple(ignore_prefix_list or [])
+
+    objects, subdirectory_prefixes = list_prefixes(bucket, prefix)
+    subdirectory_prefixes = [p for p in subdirectory_prefixes if not p.startswith(ignore_prefixes)]
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        for subdirectory_objects in executor.map(lambda p: list(iter_s3_objects(bucket, p)), subdirectory_prefixes):
+            objects.extend(subdirectory_objects)
+
+    return {
+        object['Key']: object['LastModified']
+        for object in objects
+        if not object['Key'].startswith(ignore_prefixes)
+    }
+
+
+def save_report(report_file: str, report: dict):
+    '''
+    This function saves the report, replacing the previous one only once the new one is fully written.
+    '''
+    with open(f'{report_file}.tmp', 'w') as f:
+        f.write(json.dumps(report, indent=2))
+    os.replace(f'{report_file}.tmp', report_file)
+
+
+def load_checkpoints(checkpoint_file: str):
+    '''
+    This function returns the checkpoints of the directories already checked, one dict per directory.
+    A last line cut short by an interrupted run is skipped, so its directory is checked again.
+    '''
+    if not os.path.exists(checkpoint_file):
+        return []
+
+    checkpoints = []
+    with open(checkpoint_file) as f:
+        for line in f:
+            try:
+                checkpoints.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.info(f'Skipping incomplete checkpoint: {line[:100]}')
+    return checkpoints
+
+
+def check_directory(directory: str, schemas: dict, last_modified: dict):
     '''
-    This function passes each directory containing objects through compare_existing_schema.
-    If the directory contains other directories, we call this function on each contained directory.
-    If the directory contains CSVs, we call schema_error_handling.compare_existing_schema()
-    on the directory.
+    This function compares the column names of every readable CSV in a directory to those of the oldest readable CSV.
+    It returns the oldest schema and the objects that deviate from it, or None if none deviate.
     '''
-    dir_name = os.path.dirname(__file__)
-    try:
-        os.remove(f'{dir_name}/tmp/{output_file}')
-    except:
-        pass
-    logging.basicConfig(level=logging.ERROR, filename=f'{dir_name}/tmp/{output_file}')
-
-    if directory:
-        path = f's3://{bucket}/{directory}/'
-    else:
-        path = f's3://{bucket}/'
-    
-    object_list = wr.s3.list_objects(path = path, boto3_session = sess)
-    
-    if ignore_prefix_list:
-        for ignore_prefix in ignore_prefix_list:
-            ignore_path = f's3://{bucket}/{ignore_prefix}'
-            ignore_object_list = wr.s3.list_objects(path = ignore_path, boto3_session = sess)
-            object_list = list(set(object_list) - set(ignore_object_list))
-    
-    non_csv_objects = []
-    if not all(obj.endswith('.csv') for obj in object_list):
-        non_csv_objects.extend([non_csv_object for non_csv_object in object_list if not non_csv_object.endswith('.csv')])
-        logging.exception(f'All files should be CSVs. {non_csv_objects} are not.')
-    
-    directories_containing_objects = [*set([os.path.dirname(obj) for obj in object_list])]
-    
-    for directory in directories_containing_objects:
-        logger.info(f'Checking {directory}')
-        contained_directories = wr.s3.list_directories(path = f'{directory}/', boto3_session = sess)
-        if len(contained_directories) > 0:
-            logger.info(f'Identified mixed object types in {directory}')
-            logging.exception(f'{directory} contains CSVs and directories')
-        dir_name = directory.replace(f's3://{bucket}/', '')
-        try:
-            compare_existing_schema(bucket = bucket, path = dir_name)
-        except AssertionError:
-            logger.info('Identified inconsistent schema')
-            logging.exception(f'Inconsistent schema in {path}')
-        except UnicodeDecodeError:
-            logger.info(f'Error reading CSV in {path}')
-            logging.exception(f'Error reading CSV in {path}')
+    if not schemas:
+        return None
+
+    oldest_key = min(schemas, key = lambda x: last_modified[x])
+    oldest_schema = schemas[oldest_key]
+    deviant_objects = [key for key, schema in schemas.items() if schema != oldest_schema]
+
+    if not deviant_objects:
+        return None
+
+    logger.info(f'Identified inconsistent schema in {directory}')
+    return {
+        'oldest_schema': oldest_schema,
+        'deviant_objects': sorted(deviant_objects)
+    }
+
+
+def main(output_file: str, bucket, directory: str = None, ignore_prefix_list: list = None,
+         max_workers: int = 32, resume: bool = False, report_dir: str = None):
+    '''
+    This function checks every directory containing CSVs and saves the results as a JSON report in report_dir/output_file
+    (default tmp/output_file next to this script).
+
+    Headers are read by up to max_workers threads at once, directory by directory, with at most 4 * max_workers reads
+    queued. A directory is checked as soon as the headers of all its CSVs have been read, and its results are appended
+    to the checkpoint file {output_file}.jsonl. If resume is True, directories in the checkpoint file are skipped and their
+    results are added to the report.
+    '''
+    report_dir = report_dir or f'{os.path.dirname(__file__)}/tmp'
+    os.makedirs(report_dir, exist_ok = True)
+    report_file = f'{report_dir}/{output_file}'
+    checkpoint_file = f'{report_file}.jsonl'
+
+    checkpoints = load_checkpoints(checkpoint_file) if resume else []
+    if resume:
+        logger.info(f'Resuming, {len(checkpoints)} directories already checked')
+
+    # start the checkpoint file over with only the complete checkpoints, so new lines aren't appended to a cut short one
+    with open(f'{checkpoint_file}.tmp', 'w') as f:
+        f.writelines(json.dumps(checkpoint) + '\n' for checkpoint in checkpoints)
+    os.replace(f'{checkpoint_file}.tmp', checkpoint_file)
+
+    report = {
+        'bucket': bucket,
+        'directory': directory,
+        'non_csv_objects': [],
+        'mixed_directories': [],
+        'inconsistent_directories': {},
+        'unreadable_objects': {},
+        'checked_directories': []
+    }
+
+    # the schema registries are not data
+    ignore_prefix_list = (ignore_prefix_list or []) + [SCHEMA_REGISTRY_PREFIX]
+    last_modified = list_objects(bucket, directory, ignore_prefix_list, max_workers = max_workers)
+    logger.info(f'Listed {len(last_modified)} objects')
+
+    report['non_csv_objects'] = sorted(key for key in last_modified if not key.endswith('.csv'))
+
+    # A directory is mixed if it contains objects and also has objects in a subdirectory
+    directories_containing_objects = {os.path.dirname(key) for key in last_modified}
+    parent_directories = set()
+    for object_directory in directories_containing_objects:
+        while object_directory:
+            object_directory = os.path.dirname(object_directory)
+            parent_directories.add(object_directory)
+    report['mixed_directories'] = sorted(directories_containing_objects & parent_directories)
+
+    checked_directories = {checkpoint['directory'] for checkpoint in checkpoints}
+    csv_keys = {}
+    for key in last_modified:
+        object_directory = os.path.dirname(key)
+        if key.endswith('.csv') and object_directory not in checked_directories:
+            csv_keys.setdefault(object_directory, []).append(key)
+
+    logger.info(f'Checking {len(csv_keys)} directories')
+
+    pending_keys = (key for keys in csv_keys.values() for key in keys)
+    remaining = {object_directory: len(keys) for object_directory, keys in csv_keys.items()}
+    schemas = {object_directory: {} for object_directory in csv_keys}
+    unreadable = {object_directory: {} for object_directory in csv_keys}
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor, open(checkpoint_file, 'a') as f:
+        futures = {}
+        while True:
+            # keep the queue of header reads topped up, without queueing the whole bucket at once
+            for key in pending_keys:
+                futures[executor.submit(read_csv_header, f's3://{bucket}/{key}')] = key
+                if len(futures) >= 4 * max_workers:
+                    break
+            if not futures:
+                break
+
+            done, _ = wait(futures, return_when = FIRST_COMPLETED)
+            for future in done:
+                key = futures.pop(future)
+                object_directory = os.path.dirname(key)
+
+                try:
+                    schemas[object_directory][key] = future.result()
+                except Exception as e:
+                    logger.info(f'Error reading CSV {key}')
+                    unreadable[object_directory][key] = f'{type(e).__name__}: {e}'
+
+                remaining[object_directory] -= 1
+                if remaining[object_directory] == 0:
+                    checkpoint = {
+                        'directory': object_directory,
+                        'inconsistent': check_directory(object_directory, schemas.pop(object_directory), last_modified),
+                        'unreadable_objects': unreadable.pop(object_directory)
+                    }
+                    f.write(json.dumps(checkpoint) + '\n')
+                    f.flush()
+                    checkpoints.append(checkpoint)
+
+    for checkpoint in checkpoints:
+        report['checked_directories'].append(checkpoint['directory'])
+        report['unreadable_objects'].update(checkpoint['unreadable_objects'])
+        if checkpoint['inconsistent']:
+            report['inconsistent_directories'][checkpoint['directory']] = checkpoint['inconsistent']
+    save_report(report_file, report)
+
+    logger.info(f"Found {len(report['inconsistent_directories'])} directories with inconsistent schema")
+    return report
 
 if __name__ == '__main__':
-    main(output_file = 'schema_errors_verification.log', bucket = 'court-data-management', directory = 'verification')
\ No newline at end of file
+    main(output_file = 'schema_errors_verification.json', bucket = 'court-data-management', directory = 'verification')
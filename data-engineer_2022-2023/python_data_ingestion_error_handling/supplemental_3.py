@@ -0,0 +1,503 @@
+# utils/aws_lambda/functions/create_athena_table/tests/local_aws.py
+
+import contextlib
+import datetime
+import hashlib
+import importlib
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from unittest import mock
+
+import boto3
+import pandas as pd
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+from loguru import logger
+
+'''
+This module runs schema_error_handling and lambda_function without AWS.
+
+LocalS3 stands in for the boto3 S3 client and LocalWrangler for the awswrangler calls, both backed by a local
+directory: each bucket is a subdirectory of the root, each object a file, and each Glue table a JSON file under _glue.
+local_aws() swaps them into both modules, so the schema checks and the lambda handler can be tested and timed
+offline, with no network or credentials.
+
+make_directory() generates directories of aligned or misaligned CSVs at any scale, and benchmark() times the lambda
+handler against directory size. cold_start_benchmark() times the import and first invocation of the lambda in new
+processes, as in a new lambda container. Run this file to print both benchmarks.
+'''
+
+MODULES = [
+    'utils.aws_lambda.functions.create_athena_table.schema_error_handling',
+    'utils.aws_lambda.functions.create_athena_table.lambda_function'
+]
+
+LOCAL_AWS_MODULE = 'utils.aws_lambda.functions.create_athena_table.tests.local_aws'
+
+# Column names of the fake data in court-data-management/test_files
+FIXTURE_COLUMNS = ['year', 'county', 'case_category', 'case_type', 'case_type_code', 'variable', 'value']
+
+PAGE_SIZE = 1000 # objects per list_objects_v2 page, as in S3
+
+GLUE_TYPES = {'int64': 'bigint', 'double': 'double', 'bool': 'boolean', 'date32[day]': 'date', 'string': 'string'}
+
+
+def client_error(code: str, operation: str):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class LocalBody(io.BytesIO):
+    '''
+    Stand-in for the StreamingBody returned by get_object.
+    '''
+
+    def iter_chunks(self, chunk_size=1024):
+        return iter(lambda: self.read(chunk_size), b'')
+
+
+class LocalPaginator():
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, **kwargs):
+        '''
+        Like S3, with a Delimiter the keys with another Delimiter after the prefix are grouped into CommonPrefixes.
+        '''
+        self.s3.calls['list_objects_v2'] += 1
+        bucket_root = f'{self.s3.root}/{Bucket}'
+        keys, common_prefixes = [], set()
+        for directory, _, files in os.walk(bucket_root):
+            for file in files:
+                key = os.path.relpath(f'{directory}/{file}', bucket_root).replace(os.sep, '/')
+                if not key.startswith(Prefix):
+                    continue
+                if Delimiter and Delimiter in key[len(Prefix):]:
+                    common_prefixes.add(key[:key.index(Delimiter, len(Prefix)) + len(Delimiter)])
+                else:
+                    keys.append(key)
+        keys.sort()
+
+        for start in range(0, max(len(keys), 1), PAGE_SIZE):
+            page_keys = keys[start:start + PAGE_SIZE]
+            contents = [self.s3.describe(Bucket, key) for key in page_keys]
+            page = {'Contents': contents, 'KeyCount': len(contents)} if contents else {'KeyCount': 0}
+            if start == 0 and common_prefixes:
+                page['CommonPrefixes'] = [{'Prefix': prefix} for prefix in sorted(common_prefixes)]
+            yield page
+
+
+class LocalS3():
+    '''
+    Stand-in for boto3.client('s3') backed by the directory root.
+
+    ETags are derived from each file's size and modification time rather than its content, so listing thousands of
+    objects doesn't read them. Like S3, they change whenever an object is written. calls counts requests by operation.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.uploads = {}
+        self.calls = Counter()
+
+    def path(self, bucket, key):
+        return f'{self.root}/{bucket}/{key}'
+
+    def describe(self, bucket, key):
+        stat = os.stat(self.path(bucket, key))
+        return {
+            'Key': key,
+            'LastModified': datetime.datetime.fromtimestamp(stat.st_mtime, tz = datetime.timezone.utc),
+            'Size': stat.st_size,
+            'ETag': '"' + hashlib.md5(f'{stat.st_size}-{stat.st_mtime_ns}'.encode()).hexdigest() + '"'
+        }
+
+    def write(self, bucket, key, data: bytes):
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(f'{path}.{uuid.uuid4().hex}.tmp', 'wb') as f:
+            f.write(data)
+            tmp_path = f.name
+        os.replace(tmp_path, path)
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self.calls['get_object'] += 1
+        path = self.path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise client_error('NoSuchKey', 'GetObject')
+
+        with open(path, 'rb') as f:
+            if Range is None:
+                data = f.read()
+            else:
+                start, end = (int(x) for x in Range.replace('bytes=', '').split('-'))
+                if start >= os.path.getsize(path):
+                    raise client_error('InvalidRange', 'GetObject')
+                f.seek(start)
+                data = f.read(end - start + 1)
+        return {'Body': LocalBody(data), 'ContentLength': len(data), **self.describe(Bucket, Key)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.calls['head_object'] += 1
+        if not os.path.isfile(self.path(Bucket, Key)):
+            raise client_error('404', 'HeadObject')
+        description = self.describe(Bucket, Key)
+        return {'ContentLength': description['Size'], 'ETag': description['ETag'], 'LastModified': description['LastModified']}
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        self.calls['put_object'] += 1
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif hasattr(Body, 'read'):
+            Body = Body.read()
+        self.write(Bucket, Key, Body)
+        return {'ETag': self.describe(Bucket, Key)['ETag']}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.calls['delete_object'] += 1
+        if os.path.isfile(self.path(Bucket, Key)):
+            os.remove(self.path(Bucket, Key))
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'list_objects_v2', f'{operation_name} is not supported'
+        return LocalPaginator(self)
+
+    def copy(self, CopySource, Bucket, Key, **kwargs):
+        self.calls['copy'] += 1
+        source_path = self.path(CopySource['Bucket'], CopySource['Key'])
+        if not os.path.isfile(source_path):
+            raise client_error('NoSuchKey', 'CopyObject')
+        os.makedirs(os.path.dirname(self.path(Bucket, Key)), exist_ok = True)
+        shutil.copyfile(source_path, self.path(Bucket, Key))
+
+    def copy_object(self, CopySource, Bucket, Key, **kwargs):
+        self.copy(CopySource, Bucket, Key)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.calls['create_multipart_upload'] += 1
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self.calls['upload_part'] += 1
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': '"' + hashlib.md5(Body).hexdigest() + '"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self.calls['complete_multipart_upload'] += 1
+        parts = self.uploads.pop(UploadId)
+        self.write(Bucket, Key, b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts']))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.calls['abort_multipart_upload'] += 1
+        self.uploads.pop(UploadId, None)
+
+
+class LocalSTS():
+    '''
+    Stand-in for boto3.client('sts').
+    '''
+
+    def get_caller_identity(self):
+        return {'Account': '000000000000'}
+
+
+class LocalWrangler():
+    '''
+    Stand-in for the awswrangler functions the lambda uses, reading and writing through a LocalS3.
+    Glue tables are saved as JSON files under _glue/{database}/{table}.json.
+    '''
+
+    def __init__(self, s3: LocalS3):
+        self.local_s3 = s3
+        self.s3 = self.catalog = self
+        self.glue_root = f'{s3.root}/_glue'
+
+    def local_path(self, path):
+        bucket, key = path.replace('s3://', '').split('/', 1)
+        return self.local_s3.path(bucket, key)
+
+    def read_csv(self, path, boto3_session=None, **kwargs):
+        self.local_s3.calls['get_object'] += 1
+        if not os.path.isfile(self.local_path(path)):
+            raise client_error('NoSuchKey', 'GetObject')
+        return pd.read_csv(self.local_path(path), **kwargs)
+
+    def to_parquet(self, df, path, dataset=False, partition_cols=None, mode='append', database=None, table=None,
+                   dtype=None, boto3_session=None, **kwargs):
+        partition_cols = partition_cols or []
+        dataset_root = self.local_path(path).rstrip('/')
+        groups = df.groupby(partition_cols, dropna = False) if partition_cols else [((), df)]
+
+        for values, group in groups:
+            values = values if isinstance(values, tuple) else (values,)
+            partition = '/'.join(f'{col}={value}' for col, value in zip(partition_cols, values))
+            partition_path = f'{dataset_root}/{partition}' if partition else dataset_root
+            if mode == 'overwrite_partitions' and os.path.exists(partition_path):
+                shutil.rmtree(partition_path)
+            os.makedirs(partition_path, exist_ok = True)
+            self.local_s3.calls['put_object'] += 1
+            group.drop(columns = partition_cols).to_parquet(f'{partition_path}/{uuid.uuid4().hex}.snappy.parquet', index = False)
+
+        if database and table:
+            columns_types = dict(dtype or {})
+            columns_types.update({col: 'string' for col in df.columns if col not in columns_types and col not in partition_cols})
+            self.save_table(database, table, path, columns_types, {col: 'string' for col in partition_cols}, 'parquet')
+        return {'paths': [], 'partitions_values': {}}
+
+    def read_parquet_metadata(self, path, dataset=False, boto3_session=None, **kwargs):
+        dataset_root = self.local_path(path).rstrip('/')
+        files = sorted(
+            f'{directory}/{file}' for directory, _, names in os.walk(dataset_root) for file in names if file.endswith('.parquet'))
+        assert files, f'No Parquet files found in {path}'
+        schema = pq.read_schema(files[0])
+        columns_types = {
+            field.name: 'timestamp' if str(field.type).startswith('timestamp') else GLUE_TYPES.get(str(field.type), 'string')
+            for field in schema
+        }
+        partitions_types = {
+            part.split('=')[0]: 'string' for part in os.path.relpath(os.path.dirname(files[0]), dataset_root).split(os.sep) if '=' in part
+        }
+        columns_types.update(partitions_types)
+        return columns_types, partitions_types
+
+    def create_csv_table(self, database, table, path, columns_types, boto3_session=None, **kwargs):
+        self.save_table(database, table, path, columns_types, {}, 'csv', kwargs)
+
+    def create_parquet_table(self, database, table, path, columns_types, partitions_types=None, mode='overwrite',
+                             boto3_session=None, **kwargs):
+        self.save_table(database, table, path, columns_types, partitions_types or {}, 'parquet', kwargs,
+                        keep_partitions = mode == 'update')
+
+    def add_parquet_partitions(self, database, table, partitions_values, boto3_session=None, **kwargs):
+        self.local_s3.calls['glue_batch_create_partition'] += 1
+        stored = self.load_table(database, table)
+        for location, values in partitions_values.items():
+            if [location, values] not in stored['partitions']:
+                stored['partitions'].append([location, values])
+        self.write_table(database, table, stored)
+
+    def save_table(self, database, table, path, columns_types, partitions_types, table_type, parameters=None,
+                   keep_partitions=False):
+        '''
+        Like Glue, a table keeps its partitions when it is updated and loses them when it is overwritten.
+        '''
+        self.local_s3.calls['glue_update_table'] += 1
+        exists = os.path.isfile(f'{self.glue_root}/{database}/{table}.json')
+        self.write_table(database, table, {
+            'path': path if path.endswith('/') else f'{path}/',
+            'table_type': table_type,
+            'columns_types': columns_types,
+            'partitions_types': partitions_types,
+            'parameters': {key: str(value) for key, value in (parameters or {}).items()},
+            'partitions': self.load_table(database, table)['partitions'] if keep_partitions and exists else []
+        })
+
+    def write_table(self, database, table, stored):
+        os.makedirs(f'{self.glue_root}/{database}', exist_ok = True)
+        with open(f'{self.glue_root}/{database}/{table}.json', 'w') as f:
+            f.write(json.dumps(stored, indent = 2))
+
+    def load_table(self, database, table):
+        with open(f'{self.glue_root}/{database}/{table}.json') as f:
+            return json.loads(f.read())
+
+    def does_table_exist(self, database, table, boto3_session=None, **kwargs):
+        self.local_s3.calls['glue_get_table'] += 1
+        return os.path.isfile(f'{self.glue_root}/{database}/{table}.json')
+
+    def get_table_types(self, database, table, boto3_session=None, **kwargs):
+        self.local_s3.calls['glue_get_table'] += 1
+        if not os.path.isfile(f'{self.glue_root}/{database}/{table}.json'):
+            return None
+        table = self.load_table(database, table)
+        return {**table['columns_types'], **table['partitions_types']}
+
+    def get_table_location(self, database, table, boto3_session=None, **kwargs):
+        self.local_s3.calls['glue_get_table'] += 1
+        if not os.path.isfile(f'{self.glue_root}/{database}/{table}.json'):
+            raise client_error('EntityNotFoundException', 'GetTable')
+        return self.load_table(database, table)['path']
+
+
+@contextlib.contextmanager
+def local_aws(root: str = None):
+    '''
+    This context manager swaps the S3, STS, and awswrangler clients of schema_error_handling and lambda_function for
+    stand-ins backed by root (a new temporary directory if root is None, removed on exit). It yields the LocalS3.
+
+    boto3.client is patched too, so no real client is ever created. Each client created is counted in the LocalS3's
+    calls as 'client:{service_name}'.
+    '''
+    temporary = root is None
+    root = root or tempfile.mkdtemp(prefix = 'local_aws_')
+    s3 = LocalS3(root)
+    wrangler = LocalWrangler(s3)
+    clients = {'s3': s3, 'sts': LocalSTS()}
+
+    def create_client(service_name, *args, **kwargs):
+        s3.calls[f'client:{service_name}'] += 1
+        return clients.get(service_name)
+
+    try:
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(mock.patch.object(boto3, 'client', create_client))
+            stack.enter_context(mock.patch.dict(os.environ, {'AWS_REGION': os.environ.get('AWS_REGION', 'us-east-1')}))
+            modules = [importlib.import_module(name) for name in MODULES]
+
+            for module in modules:
+                for attribute, value in (('s3_client', s3), ('client', clients['sts']), ('wr', wrangler)):
+                    if hasattr(module, attribute):
+                        stack.enter_context(mock.patch.object(module, attribute, value))
+
+            modules[0].clear_listing_cache()
+            yield s3
+            modules[0].clear_listing_cache()
+    finally:
+        if temporary:
+            shutil.rmtree(root, ignore_errors = True)
+
+
+def make_csv(columns: list, rows: int, seed: int = 0):
+    '''
+    This function returns the content of a CSV of fake court data with the given column names.
+    '''
+    data = {
+        column: [f'{column}_{(seed + i) % 97}' if i % 5 else f'"{column}, {i}"' for i in range(rows)]
+        for column in columns
+    }
+    return pd.DataFrame(data, columns = columns).to_csv(index = False).encode('utf-8')
+
+
+def make_directory(s3: LocalS3, bucket: str, path: str, objects: int, rows: int = 10, misaligned: int = 0,
+                   columns: list = FIXTURE_COLUMNS, start: datetime.datetime = None):
+    '''
+    This function fills the directory path with objects CSVs, one minute apart in last_modified order starting at start.
+
+    The newest misaligned CSVs have one column renamed, so their schema doesn't match the oldest CSV in the directory.
+    It returns the keys of the CSVs, oldest first.
+    '''
+    start = start or datetime.datetime(2022, 1, 1, tzinfo = datetime.timezone.utc)
+    aligned_content = make_csv(columns, rows)
+    misaligned_content = make_csv(columns[:-1] + [f'{columns[-1]}_renamed'], rows)
+
+    keys = []
+    for i in range(objects):
+        key = f'{path}/fake_data_{i:06d}.csv'
+        s3.write(bucket, key, misaligned_content if i >= objects - misaligned else aligned_content)
+        timestamp = (start + datetime.timedelta(minutes = i)).timestamp()
+        os.utime(s3.path(bucket, key), (timestamp, timestamp))
+        keys.append(key)
+    return keys
+
+
+def make_event(bucket: str, object: str):
+    '''
+    This function returns the EventBridge event sent to the lambda when object is uploaded.
+    '''
+    return {'id': str(uuid.uuid4()), 'detail': {'bucket': {'name': bucket}, 'object': {'key': object}}}
+
+
+def benchmark(sizes: list = (10, 100, 1000, 5000), repeats: int = 3, rows: int = 10, bucket: str = 'court-data-management'):
+    '''
+    This function times lambda_handler on a new CSV in directories of each size, with the staging and prod directories
+    already holding that many aligned CSVs.
+
+    The first run of each size starts with no schema registry (cold). The CSV is then uploaded again and processed
+    repeats more times (warm), so only its own header needs to be read. Returns a dataframe of the timings and the
+    S3 requests made by the cold run.
+    '''
+    results = []
+    for size in sizes:
+        with local_aws() as s3:
+            lambda_function = importlib.import_module(MODULES[1])
+            path = f'benchmark/directory_{size}'
+            for key in make_directory(s3, bucket, path, size, rows = rows):
+                s3.copy({'Bucket': bucket, 'Key': key}, bucket, f'{lambda_function.dest_csv_path}/{key}')
+
+            new_object = f'{path}/new_file.csv'
+            timings = []
+            for run in range(repeats + 1):
+                s3.write(bucket, new_object, make_csv(FIXTURE_COLUMNS, rows, seed = run))
+                s3.calls.clear()
+                start = time.perf_counter()
+                lambda_function.lambda_handler(make_event(bucket, new_object), None)
+                timings.append(time.perf_counter() - start)
+                if run == 0:
+                    cold_calls = dict(s3.calls)
+
+            results.append({
+                'objects': size,
+                'cold_seconds': round(timings[0], 4),
+                'warm_seconds': round(statistics.median(timings[1:]), 4) if repeats else None,
+                'cold_get_object': cold_calls.get('get_object', 0),
+                'cold_list_objects_v2': cold_calls.get('list_objects_v2', 0)
+            })
+            logger.info(results[-1])
+
+    return pd.DataFrame(results)
+
+
+def cold_start(bucket: str = 'court-data-management', rows: int = 10):
+    '''
+    This function imports lambda_function and handles two events, timing each step. Run in a new process, it measures
+    a cold start: the first event pays for anything created lazily, and the second is a warm invocation.
+
+    This module has already imported pandas, boto3 and awswrangler's dependencies, so import_seconds is the time
+    lambda_function and schema_error_handling themselves take to import. Returns the timings and the number of AWS
+    clients created and S3 requests made by the import.
+    '''
+    start = time.perf_counter()
+    with local_aws() as s3:
+        imported = time.perf_counter()
+        import_calls = dict(s3.calls)
+        lambda_function = importlib.import_module(MODULES[1])
+
+        path = 'benchmark/cold_start'
+        make_directory(s3, bucket, path, 3, rows = rows)
+        timings = []
+        for run in range(2):
+            s3.write(bucket, f'{path}/new_file.csv', make_csv(FIXTURE_COLUMNS, rows, seed = run))
+            invocation_start = time.perf_counter()
+            lambda_function.lambda_handler(make_event(bucket, f'{path}/new_file.csv'), None)
+            timings.append(time.perf_counter() - invocation_start)
+
+    return {
+        'import_seconds': round(imported - start, 4),
+        'first_event_seconds': round(timings[0], 4),
+        'warm_event_seconds': round(timings[1], 4),
+        'import_clients': sum(count for call, count in import_calls.items() if call.startswith('client:')),
+        'import_s3_requests': sum(count for call, count in import_calls.items() if not call.startswith('client:'))
+    }
+
+
+def cold_start_benchmark(repeats: int = 5):
+    '''
+    This function runs cold_start in repeats new processes and returns a dataframe of the results.
+    Processes are started from the current directory, which must be the root of the repository.
+    '''
+    results = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, '-c', f'import json; from {LOCAL_AWS_MODULE} import cold_start; print(json.dumps(cold_start()))'],
+            capture_output = True, text = True, check = True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+        logger.info(results[-1])
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    print(benchmark().to_string(index = False))
+    print(cold_start_benchmark().to_string(index = False))
@@ -0,0 +1,190 @@
+# dbt/scripts/local_query.py
+
+import argparse
+import glob
+import hashlib
+import os
+import re
+import time
+
+from loguru import logger
+
+EXTRACT_PATH = 'extracts'
+EXTRACT_CHUNKSIZE = 500000
+
+# Presto functions with a DuckDB equivalent taking the same arguments
+FUNCTION_RENAMES = {
+    'CARDINALITY': 'len',
+    'ELEMENT_AT': 'list_extract',
+    'TRANSFORM': 'list_transform',
+    'CONTAINS': 'list_contains',
+    'ARRAY_JOIN': 'array_to_string',
+    'REGEXP_LIKE': 'regexp_matches',
+    'TO_UNIXTIME': 'epoch',
+}
+
+
+def render(sql):
+    '''
+    This function replaces the DBT Jinja in a model with plain table names: {{ ref('model') }} becomes model and
+    {{ source('schema', 'table') }} becomes table. {{ config(...) }} blocks are removed.
+    '''
+    sql = re.sub(r'\{\{\s*config\(.*?\)\s*\}\}', '', sql, flags=re.S)
+    sql = re.sub(r'\{\{\s*ref\(\s*[\'"](\w+)[\'"]\s*\)\s*\}\}', r'\1', sql)
+    return re.sub(r'\{\{\s*source\(\s*[\'"]\w+[\'"]\s*,\s*[\'"](\w+)[\'"]\s*\)\s*\}\}', r'\1', sql)
+
+
+def to_duckdb(sql):
+    '''
+    This function translates the Presto (Athena) functions used in our models to DuckDB.
+
+    Most Presto functions (IF, YEAR, TRY_CAST, ARRAY_AGG with ORDER BY, lambdas like r -> r < .9, and struct fields like
+    judgment_information.attorney_fees) work in DuckDB as they are. The rest are renamed using FUNCTION_RENAMES. The Presto
+    array FILTER(array, lambda) becomes list_filter, while an aggregate FILTER (WHERE ...) clause is left alone.
+    '''
+    sql = re.sub(r'\bFILTER\s*\((?!\s*WHERE\b)', 'list_filter(', sql, flags=re.I)
+    for presto, duckdb in FUNCTION_RENAMES.items():
+        sql = re.sub(rf'\b{presto}\s*\(', f'{duckdb}(', sql, flags=re.I)
+    return sql
+
+
+def split_ctes(sql):
+    '''
+    This function splits a query into its top-level CTEs and its final statement.
+    Returns a list of (name, query) tuples, in the order they are defined, and the final statement.
+    '''
+    sql = re.sub(r'--[^\n]*', '', sql).strip().rstrip(';')
+    match = re.match(r'WITH\s+', sql, flags=re.I)
+    if not match:
+        return [], sql
+
+    ctes = []
+    position = match.end()
+    while True:
+        match = re.compile(r'(\w+)\s+AS\s*\(', flags=re.I).match(sql, position)
+        assert match, f'Could not parse the CTE at: {sql[position:position + 50]}'
+
+        # find the parenthesis closing the CTE, skipping over any in strings
+        depth, start, quote = 1, match.end(), None
+        for position in range(start, len(sql)):
+            character = sql[position]
+            if quote:
+                quote = None if character == quote else quote
+            elif character in '\'"':
+                quote = character
+            elif character == '(':
+                depth += 1
+            elif character == ')':
+                depth -= 1
+                if depth == 0:
+                    break
+        assert depth == 0, f'Unbalanced parentheses in CTE {match.group(1)}'
+        ctes.append((match.group(1), sql[start:position].strip()))
+
+        comma = re.compile(r'\s*,\s*').match(sql, position + 1)
+        if not comma:
+            return ctes, sql[position + 1:].strip()
+        position = comma.end()
+
+
+def fingerprint_files(path):
+    '''
+    This function fingerprints the Parquet files of an extract by their names, sizes, and modification times,
+    so a new or re-extracted file changes the fingerprint without the files being read.
+    '''
+    files = sorted(glob.glob(os.path.join(path, '*.parquet')))
+    assert files, f'No Parquet files found in {path}'
+    stats = [f'{os.path.basename(f)}:{os.path.getsize(f)}:{os.stat(f).st_mtime_ns}' for f in files]
+    return hashlib.sha256('\n'.join(stats).encode()).hexdigest()
+
+
+def extract_models(models, database, extract_path = EXTRACT_PATH, boto3_session = None):
+    '''
+    This function saves a local Parquet extract of each model in the Athena database, one folder per model.
+    Each model is read in chunks and every chunk is saved as a part file, so the table never has to fit in memory.
+    '''
+    import awswrangler as wr
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    for model in models:
+        start_time = time.time()
+        path = os.path.join(extract_path, model)
+        os.makedirs(path, exist_ok = True)
+        for f in glob.glob(os.path.join(path, '*.parquet')):
+            os.remove(f)
+
+        chunks = wr.athena.read_sql_table(model, database, ctas_approach = True, chunksize = EXTRACT_CHUNKSIZE,
+                                          boto3_session = boto3_session)
+        for i, chunk in enumerate(chunks):
+            pq.write_table(pa.Table.from_pandas(chunk, preserve_index = False), os.path.join(path, f'part-{i:05d}.parquet'))
+        logger.info(f'Extracted {model} to {path} in {time.time() - start_time:.1f} seconds')
+
+
+def run_query(sql, extract_path = EXTRACT_PATH, cache_path = None, connection = None):
+    '''
+    This function runs a DBT model locally with DuckDB against the Parquet extracts made by extract_models(),
+    and returns the result as a DataFrame.
+
+    Each model referenced with ref() or source() is read from the folder of the same name in extract_path.
+    Every CTE is saved as a Parquet file in cache_path, named by a fingerprint of its SQL and of everything it reads
+    (the extract files and earlier CTEs). When a query is rerun, CTEs whose SQL and inputs have not changed are read
+    from the cache instead of being rerun, so editing the last step of a model only reruns that step.
+    '''
+    import duckdb
+
+    cache_path = cache_path or os.path.join(extract_path, '_cache')
+    os.makedirs(cache_path, exist_ok = True)
+    connection = connection or duckdb.connect()
+
+    sql = to_duckdb(render(sql))
+    ctes, final_query = split_ctes(sql)
+
+    # name -> fingerprint of every table the query can read
+    fingerprints = {}
+    for model in sorted(set(re.findall(r'\b(?:FROM|JOIN)\s+(\w+)', sql, flags=re.I))):
+        model_path = os.path.join(extract_path, model)
+        if model in dict(ctes) or not os.path.isdir(model_path):
+            continue
+        fingerprints[model] = fingerprint_files(model_path)
+        files = os.path.join(model_path, '*.parquet').replace("'", "''")
+        connection.execute(f"CREATE OR REPLACE VIEW {model} AS SELECT * FROM read_parquet('{files}', union_by_name = true)")
+
+    for name, query in ctes:
+        inputs = [f'{table}:{fingerprints[table]}' for table in sorted(fingerprints) if re.search(rf'\b{table}\b', query)]
+        fingerprints[name] = hashlib.sha256('\n'.join([query] + inputs).encode()).hexdigest()
+
+        cache_file = os.path.join(cache_path, f'{name}_{fingerprints[name][:16]}.parquet')
+        quoted_file = cache_file.replace("'", "''")
+        if os.path.exists(cache_file):
+            logger.info(f'Reading CTE {name} from the cache')
+        else:
+            start_time = time.time()
+            connection.execute(f"COPY ({query}) TO '{quoted_file}.tmp' (FORMAT PARQUET)")
+            os.replace(f'{cache_file}.tmp', cache_file)
+            logger.info(f'Ran CTE {name} in {time.time() - start_time:.2f} seconds')
+        connection.execute(f"CREATE OR REPLACE VIEW {name} AS SELECT * FROM read_parquet('{quoted_file}')")
+
+    return connection.sql(final_query).df()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Runs a DBT model locally against Parquet extracts of its models.')
+    parser.add_argument('sql_filename')
+    parser.add_argument('--extract-path', default = EXTRACT_PATH)
+    parser.add_argument('--extract', metavar = 'DATABASE', help = 'extract the models from this Athena database first')
+    parser.add_argument('--output', help = 'save the result to this CSV')
+    args = parser.parse_args()
+
+    with open(args.sql_filename) as f:
+        sql = f.read()
+    if args.extract:
+        extract_models(sorted(set(re.findall(r'ref\(\s*[\'"](\w+)', sql))), args.extract, args.extract_path)
+
+    start_time = time.time()
+    result = run_query(sql, extract_path = args.extract_path)
+    logger.info(f'Query returned {len(result)} rows in {time.time() - start_time:.2f} seconds')
+    if args.output:
+        result.to_csv(args.output, index = False)
+    else:
+        print(result)
@@ -0,0 +1,4 @@
+'''
+Address Parsing
+AddressParser is in address_parsing.py.
+'''
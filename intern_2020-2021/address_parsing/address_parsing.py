@@ -18,31 +18,65 @@ It takes the results from parsing the address and puts them into the
 columns the Census geocoder wants. It exports that table as a .csv.
 Finally, it sends this batch of addresses to the Census geocoder API
 and saves the Census geocoder's results.
+
+usaddress and censusgeocode are only imported when addresses are parsed or geocoded.
+AddressParser.run() parses and geocodes the address file, and the court-jobs command runs it
+with its parse-addresses subcommand.
 '''
 
 # Import packages
 import pandas as pd
-import usaddress
 import re
-import censusgeocode as cg
+
+from court_csv import read_court_csv
 
 class AddressParser():
 
-    def __init__(self, filename, cities_db_filename, column_name='address', batch_filename='census_batch.csv', census_results_filename='census_results.csv'):
+    def __init__(self, filename, cities_db_filename, column_name='address', batch_filename='census_batch.csv', census_results_filename='census_results.csv', max_addresses=1000):
+        '''
+        Nothing is read until run() or load_cities_db() is called.
+        '''
         self.filename = filename
+        self.cities_db_filename = cities_db_filename
+        self.column_name = column_name
         self.batch_filename = batch_filename
         self.census_results_filename = census_results_filename
+        self.max_addresses = max_addresses
+        self.cities_db = None
+    
+    @classmethod
+    def from_cities_db(cls, cities_db_filename):
+        '''
+        This function creates an AddressParser that only loads the cities_db table, so that parse_address can be
+        used on its own without reading an address file or sending a batch to the Census geocoder.
+        '''
+        parser = cls(None, cities_db_filename)
+        parser.load_cities_db()
+        return parser
+    
+    def load_cities_db(self):
+        '''
+        This function loads the cities_db table used by get_city_name, if it isn't loaded already.
+        '''
+        if self.cities_db is None:
+            self.cities_db = read_court_csv(self.cities_db_filename, categories=[])
+    
+    def run(self):
+        '''
+        This function reads the first max_addresses addresses in the address file, parses them, sends them to the
+        Census geocoder, and saves the batch and the results (see get_census_batch). The object is returned.
+        '''
+        self.load_cities_db()
 
-        self.cities_db = pd.read_csv(cities_db_filename)
-
-        dataset = pd.read_csv(filename)
-        dataset = dataset.dropna(axis=0, subset=[column_name])
-        self.addresses = dataset[column_name]
+        dataset = read_court_csv(self.filename, usecols=[self.column_name], dtype={self.column_name: 'str'})
+        dataset = dataset.dropna(axis=0, subset=[self.column_name])
+        self.addresses = dataset[self.column_name]
 
-        if len(self.addresses) > 1000:
-            self.addresses = self.addresses[:1000]
+        if len(self.addresses) > self.max_addresses:
+            self.addresses = self.addresses[:self.max_addresses]
 
         self.get_census_batch(self.addresses)
+        return self
     
     def get_city_name(self, parsed_address, state):
         '''
@@ -95,6 +129,8 @@ class AddressParser():
         - Finally, we combine the street number and name into one street address.
         We return the street address, city, state, and zip code.
         '''
+        import usaddress
+        
         street_address, city, state, zip_code = '', '', '', ''
         
         parsed = usaddress.parse(address)
@@ -129,23 +165,25 @@ class AddressParser():
         
         return street_address, city, state, zip_code
     
+    def parse_addresses(self, addresses):
+        '''
+        This function parses addresses one at a time as they are read, yielding the street address, city, state,
+        and zip code of each (see parse_address), so any number of addresses can be parsed without holding them all.
+        '''
+        self.load_cities_db()
+        for address in addresses:
+            yield self.parse_address(address)
+    
     def get_census_batch(self, addresses):
         '''
         This function sends the input addresses through the address parser and returns them
         in the format the Census geocoder wants.
         '''
-        address_column, city_column, state_column, zip_column = [], [], [], []
-        for address in addresses:
-            street_address, city, state, zip_code = self.parse_address(address)
-            address_column.append(street_address)
-            city_column.append(city)
-            state_column.append(state)
-            zip_column.append(zip_code)
-        census_batch = pd.DataFrame(list(zip(address_column, city_column, state_column, zip_column)))
+        import censusgeocode as cg
+        
+        census_batch = pd.DataFrame(list(self.parse_addresses(addresses)))
         census_batch.to_csv(self.batch_filename, header=None)
         results = cg.addressbatch(self.batch_filename)
         results_df = pd.DataFrame.from_dict(results)
         results_df.to_csv(self.census_results_filename)
 
-
-AddressParser('Downloads/tn_shelby_no_geo.csv', 'Downloads/cities_db.csv', column_name='address', batch_filename='census_batch.csv', census_results_filename='Downloads/census_results_102220.csv')
@@ -0,0 +1,107 @@
+'''
+Reading Court Data CSVs
+This module is shared by the court_data_processing, court_party_fuzzy_matching,
+and address_parsing projects to load their input CSVs. The notebooks keep the original
+pd.read_csv calls.
+
+Court data CSVs are often large, and some were saved with a Windows encoding rather
+than UTF-8. read_court_csv() detects the encoding once from a sample at the start
+of the file, then reads the file with pyarrow's multithreaded CSV reader, which is much
+faster than pandas' default reader. Files are memory mapped rather than copied into
+memory before parsing.
+
+Only the columns a project needs are read, and columns with few distinct values
+(county, state, case type) are loaded as categoricals to save memory.
+'''
+
+import codecs
+
+import pyarrow as pa
+import pyarrow.csv as pv
+
+# Encodings tried in order when detecting a file's encoding. latin-1 can decode any bytes.
+ENCODINGS = ['utf-8', 'cp1252', 'latin-1']
+
+SAMPLE_BYTES = 1024 * 1024
+
+CATEGORY_COLUMNS = ['county', 'state', 'case_type']
+
+PYARROW_TYPES = {
+    'str': pa.string(),
+    'category': pa.dictionary(pa.int32(), pa.string()),
+    'int': pa.int64(),
+    'float': pa.float64()
+}
+
+
+def detect_encoding(filename, sample_bytes=SAMPLE_BYTES):
+    '''
+    This function returns the first encoding in ENCODINGS that can decode the first sample_bytes of a file.
+    The sample may end partway through a UTF-8 character, so an incomplete character at the end is not an error.
+    '''
+    with open(filename, 'rb') as f:
+        sample = f.read(sample_bytes)
+
+    for encoding in ENCODINGS:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+
+
+def to_numbers(column):
+    '''
+    This function converts a column of strings to integers, or to floats if any value isn't an integer.
+    The strings are returned unchanged if any value isn't a number.
+    '''
+    for number_type in (pa.int64(), pa.float64()):
+        try:
+            return column.cast(number_type)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            continue
+    return column
+
+
+def read_court_csv(filename, usecols=None, dtype=None, categories=CATEGORY_COLUMNS, encoding=None, memory_map=True):
+    '''
+    This function reads a CSV into a pandas DataFrame.
+
+    Parameters:
+    - filename: the filename and path of the CSV.
+    - usecols (default None): the columns to read. All columns are read if None.
+    - dtype (default None): a dict of column name to 'str', 'category', 'int', or 'float'. Other columns are read as numbers
+        if every value in them is a number and as strings otherwise, as pd.read_csv does.
+    - categories (default CATEGORY_COLUMNS): columns read as categoricals if they are in the file.
+    - encoding (default None): the file's encoding. It is detected with detect_encoding if None.
+    - memory_map (default True): if True, the file is memory mapped.
+
+    pyarrow infers column types from the first rows of a file and fails if a later value doesn't fit, so every column is
+    parsed as strings and converted to numbers afterwards. Empty fields are read as missing values, and the unnamed
+    index column written by DataFrame.to_csv is named 'Unnamed: 0', as with pd.read_csv.
+    '''
+    encoding = encoding or detect_encoding(filename)
+    dtype = dtype or {}
+
+    read_options = pv.ReadOptions(encoding=encoding)
+    parse_options = pv.ParseOptions(newlines_in_values=True)
+
+    # open_csv only parses the first block of the file to get the column names
+    column_names = pv.open_csv(filename, read_options=read_options, parse_options=parse_options).schema.names
+    usecols = usecols or column_names
+
+    column_types = {column: pa.string() for column in usecols}
+    column_types.update({column: PYARROW_TYPES['category'] for column in categories if column in column_types})
+    column_types.update({column: PYARROW_TYPES[column_type] for column, column_type in dtype.items()})
+
+    convert_options = pv.ConvertOptions(include_columns=usecols, column_types=column_types, strings_can_be_null=True)
+
+    source = pa.memory_map(filename) if memory_map else filename
+    table = pv.read_csv(source, read_options=read_options, parse_options=parse_options, convert_options=convert_options)
+
+    columns = [
+        column if name in categories or name in dtype else to_numbers(column)
+        for name, column in zip(table.column_names, table.columns)
+    ]
+    names = [name if name else f'Unnamed: {i}' for i, name in enumerate(table.column_names)]
+    return pa.table(columns, names=names).to_pandas()
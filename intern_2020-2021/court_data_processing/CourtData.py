@@ -11,11 +11,16 @@ and cumulative monthly.
 
 The CSVs outputted by this code should be ready for direct upload to Tableau for
 visualization.
+
+The court data is loaded and counted by CourtData.run(), which the court-jobs command
+runs with its court-data subcommand.
 '''
 
 import pandas as pd
 from datetime import date, timedelta
 
+from court_csv import read_court_csv
+
 class CourtData():
     '''
     This class is designed to process court data from various states to obtain counts of specific case types over time.
@@ -26,6 +31,8 @@ class CourtData():
     
     In the future, functionality may be added for additional states.
     
+    run() loads the court data and counts the cases, and must be called before the callable methods.
+    
     This class contains seven methods. Three of them are involved in data preprocessing. Three of them are callable
     to return different data outputs. The last one supports the callable methods.
     Preprocessing
@@ -45,8 +52,19 @@ class CourtData():
     - join_counts(self, old_table, new_table, column_name)
     '''
     def __init__(self, filename, state, date_cutoff = None):
-        self.data = pd.read_csv(filename)
+        self.filename = filename
+        self.state = state
         self.date_cutoff = date_cutoff
+    
+    def run(self):
+        '''
+        This method loads the court data, keeps the eviction cases, and counts them by date. The counts are saved in
+        count_data, and the object is returned.
+        '''
+        # Only the date columns and the column describing each case are used
+        case_columns = {'DE': 'case_description', 'SC': 'case_information'}
+        usecols = ['year', 'month', 'day', case_columns[self.state]] if self.state in case_columns else None
+        self.data = read_court_csv(self.filename, usecols=usecols)
         
         # Get the years included in the dataset
         self.year_ints = list(self.data.year.unique()) # what years are we working with?
@@ -58,7 +76,7 @@ class CourtData():
         # This section dictates how the court data will be processed depending on the state.
         # Filter only the cases we want. The process here depends on how each state organizes its court data.
         # Delaware
-        if state == 'DE':
+        if self.state == 'DE':
             # Filter cases in New Castle County
             # These cases are identifiable by the Justice of the Peace number, which should be 13 or 9
             self.data = self.data[self.data.apply(lambda x: x['case_description'][10:14] == 'JP13' or x['case_description'][10:13] == 'JP9', axis=1)]
@@ -66,7 +84,7 @@ class CourtData():
             parameters = ['case_id=', 'case_description', '61 - JP LANDLORD TENANT']
             self.eviction_data = self.get_info(self.data, parameters)
         # South Carolina
-        elif state == 'SC':
+        elif self.state == 'SC':
             parameters = ['case_number=', 'case_information', 'Rule to Vacate']
             self.eviction_data = self.get_info(self.data, parameters)
         
@@ -87,6 +105,8 @@ class CourtData():
         self.count_data['date'] = self.date_list
         self.count_data.set_index(['date'], inplace=True)
         
+        return self
+        
     def get_info(self, data, parameters):
         '''
         This method parses court data to identify eviction cases. It records Case IDs but as of 12/01/2020, these
@@ -201,13 +221,3 @@ class CourtData():
             cumulative_data['cumulative_counts'] = cumulative_data['count'].cumsum()
             cumulative_data = cumulative_data.drop('count')
         return cumulative_data
-
-greenville = CourtData('Downloads/LSC Work/Data Visualizations/Greenville County/greenville_court_data.csv', 'SC')
-
-greenville_monthly = greenville.get_monthly_counts(renter_households=[65891, 63234, 62260, 60220, 62001.9, 62901.25])
-
-greenville_monthly.to_csv('Downloads/LSC Work/Data Visualizations/Most Recent Data/greenville_monthly.csv')
-
-greenville_cumulative = greenville.get_cumulative()
-
-greenville_cumulative.to_csv('Downloads/LSC Work/Data Visualizations/Most Recent Data/greenville_cumulative.csv')
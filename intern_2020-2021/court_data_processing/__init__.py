@@ -0,0 +1,4 @@
+'''
+Preparing Eviction Data for Visualization in Tableau
+CourtData is in CourtData.py.
+'''
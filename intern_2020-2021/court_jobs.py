@@ -0,0 +1,134 @@
+'''
+Running Court Data Jobs from the Command Line
+This script runs the fuzzy matching, court data processing, and address parsing projects as command line jobs.
+
+Installing the projects (pip install . in this directory) adds a court-jobs command, with each job as a subcommand:
+    court-jobs fuzzy-match party_counts.csv party_groups.csv --algorithm levenshtein
+    court-jobs court-data greenville_court_data.csv SC --renter-households 65891 63234 62260 60220 62001.9 62901.25
+        --monthly-output greenville_monthly.csv --cumulative-output greenville_cumulative.csv
+    court-jobs parse-addresses tn_shelby_no_geo.csv cities_db.csv --census-results-filename census_results.csv
+
+The batch subcommand runs many jobs in one process. Each line of the jobs file is the arguments of one job, e.g.
+'fuzzy-match shelby.csv shelby_groups.csv'. Each project, and the pandas, pyarrow, and other libraries it needs, is
+only imported by the first job that uses it, so later jobs start without importing anything.
+'''
+
+import argparse
+import shlex
+import time
+
+
+def fuzzy_match(args):
+    '''
+    This function groups the parties in a party counts CSV (see RemoveRepetitiveNames) and saves the groups as a CSV.
+    '''
+    from court_party_fuzzy_matching.FuzzyMatching import RemoveRepetitiveNames, abbreviations, stopwords
+
+    party_classifier = None
+    if args.party_classifier:
+        from court_party_fuzzy_matching.party_classifier import PartyClassifier
+        party_classifier = PartyClassifier.load(args.party_classifier)
+
+    matcher = RemoveRepetitiveNames(args.filename, abbreviations=abbreviations, stopwords=stopwords, size=args.size,
+                                    algorithm=args.algorithm, remove_numbers=not args.keep_numbers, top_k=args.top_k,
+                                    block_size=args.block_size, n_jobs=args.n_jobs, blocking=args.blocking,
+                                    partition_column=args.partition_column, party_classifier=party_classifier,
+                                    threshold=args.threshold)
+    matcher.run().output_df.to_csv(args.output, index=False)
+
+
+def court_data(args):
+    '''
+    This function counts the eviction cases in a court data CSV (see CourtData) and saves the monthly and cumulative counts.
+    '''
+    from court_data_processing.CourtData import CourtData
+
+    data = CourtData(args.filename, args.state, date_cutoff=args.date_cutoff).run()
+    if args.monthly_output:
+        # one renter household count for one year of data, or one per year column
+        renter_households = args.renter_households if len(args.renter_households) > 1 else args.renter_households[0]
+        data.get_monthly_counts(renter_households=renter_households).to_csv(args.monthly_output)
+    if args.cumulative_output:
+        data.get_cumulative().to_csv(args.cumulative_output)
+
+
+def parse_addresses(args):
+    '''
+    This function parses the addresses in a CSV and geocodes them with the Census geocoder (see AddressParser).
+    '''
+    from address_parsing.address_parsing import AddressParser
+
+    AddressParser(args.filename, args.cities_db_filename, column_name=args.column_name, batch_filename=args.batch_filename,
+                  census_results_filename=args.census_results_filename, max_addresses=args.max_addresses).run()
+
+
+def batch(args):
+    '''
+    This function runs every job in a jobs file, one per line, in this process. Blank lines and lines starting with #
+    are skipped.
+    '''
+    with open(args.jobs_filename) as f:
+        jobs = [shlex.split(line) for line in f if line.strip() and not line.strip().startswith('#')]
+
+    for job in jobs:
+        start_time = time.time()
+        main(job)
+        print('finished job: ', ' '.join(job), time.time() - start_time)
+
+
+def get_parser():
+    '''
+    Returns the argument parser for every subcommand.
+    '''
+    parser = argparse.ArgumentParser(description='Runs court data jobs.')
+    subparsers = parser.add_subparsers(dest='job', required=True)
+
+    fuzzy = subparsers.add_parser('fuzzy-match', help='group duplicate parties in a party counts CSV')
+    fuzzy.add_argument('filename')
+    fuzzy.add_argument('output')
+    fuzzy.add_argument('--size', type=int, default=10000)
+    fuzzy.add_argument('--algorithm', default='seq', choices=['seq', 'levenshtein', 'tfidf'])
+    fuzzy.add_argument('--keep-numbers', action='store_true')
+    fuzzy.add_argument('--top-k', type=int, default=20)
+    fuzzy.add_argument('--block-size', type=int, default=1000)
+    fuzzy.add_argument('--n-jobs', type=int, default=1)
+    fuzzy.add_argument('--blocking', default='name', choices=['name', 'address'])
+    fuzzy.add_argument('--partition-column')
+    fuzzy.add_argument('--party-classifier', help='a PartyClassifier saved with save()')
+    fuzzy.add_argument('--threshold', type=float, help='the similarity ratio at which names match (default depends on --algorithm)')
+    fuzzy.set_defaults(function=fuzzy_match)
+
+    court = subparsers.add_parser('court-data', help='count eviction cases for Tableau')
+    court.add_argument('filename')
+    court.add_argument('state', choices=['DE', 'SC'])
+    court.add_argument('--date-cutoff')
+    court.add_argument('--renter-households', type=float, nargs='+')
+    court.add_argument('--monthly-output')
+    court.add_argument('--cumulative-output')
+    court.set_defaults(function=court_data)
+
+    addresses = subparsers.add_parser('parse-addresses', help='parse and geocode the addresses in a CSV')
+    addresses.add_argument('filename')
+    addresses.add_argument('cities_db_filename')
+    addresses.add_argument('--column-name', default='address')
+    addresses.add_argument('--batch-filename', default='census_batch.csv')
+    addresses.add_argument('--census-results-filename', default='census_results.csv')
+    addresses.add_argument('--max-addresses', type=int, default=1000)
+    addresses.set_defaults(function=parse_addresses)
+
+    jobs = subparsers.add_parser('batch', help='run every job in a jobs file in one process')
+    jobs.add_argument('jobs_filename')
+    jobs.set_defaults(function=batch)
+
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if args.job == 'court-data' and args.monthly_output and not args.renter_households:
+        get_parser().error('--monthly-output requires --renter-households')
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,12 +11,19 @@ party name for the same party can make aggregation extremely difficult.
 
 This code uses a combination of text preprocessing, simple regular expression 
 methods, and fuzzy matching to identify and group parties that the code believes to be the same, despite variations in the party name.
+
+fuzzywuzzy, scikit-learn and joblib are only imported by the algorithms that use them. The court-jobs command
+runs RemoveRepetitiveNames with its fuzzy-match subcommand.
 '''
 
+import os
+import re
+import numpy as np
 import pandas as pd
 from difflib import SequenceMatcher
 import time
-from fuzzywuzzy import fuzz
+
+from court_csv import read_court_csv
 
 abbreviations = {'apartment': 'apt',
                  'apartments': 'apt',
@@ -51,6 +58,46 @@ abbreviations = {'apartment': 'apt',
 
 stopwords = ['llc', 'inc', 'pllc']
 
+# cities table used by AddressParser to parse party addresses for address blocking
+cities_db_filename = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'address_parsing', 'cities_db.csv')
+
+# the default similarity ratio at which two party names match, for each algorithm. Cosine similarities of TF-IDF
+# n-grams run lower than the other ratios: on a hand-labeled sample of 50 variants of 15 parties and 30 similar but
+# different parties (e.g. 'jon smith' and 'jane smith'), .6 gave the best F1 for 'tfidf', while .8 missed pairs
+# like 'john smith' and 'jon smith' (.65) or 'acme apt' and 'acme apts' (.76).
+thresholds = {'seq': .8, 'levenshtein': .8, 'tfidf': .6}
+
+# the only columns of the party counts data that are used
+party_columns = ['party_name', 'party_type', 'party_address', 'case_type', 'year', 'party_count']
+
+def top_k_block(matrix, start, stop, top_k, threshold):
+    '''
+    Multiplies rows start to stop of a TF-IDF matrix by the whole matrix to get the cosine similarity of those
+    party names to every party name. Returns the (row, column, score) of the top_k scores of each row that are
+    at least threshold, leaving out each name's score with itself.
+    '''
+    scores = (matrix[start:stop] @ matrix.T).tocsr()
+    scores.data[scores.data < threshold] = 0
+    scores.eliminate_zeros()
+    
+    rows, columns, values = [], [], []
+    for i in range(stop - start):
+        row_columns = scores.indices[scores.indptr[i]:scores.indptr[i + 1]]
+        row_values = scores.data[scores.indptr[i]:scores.indptr[i + 1]]
+        keep = row_columns != start + i
+        row_columns, row_values = row_columns[keep], row_values[keep]
+        if len(row_values) > top_k:
+            top = np.argpartition(-row_values, top_k)[:top_k]
+            row_columns, row_values = row_columns[top], row_values[top]
+        rows.append(np.full(len(row_columns), start + i))
+        columns.append(row_columns)
+        values.append(row_values)
+    
+    if not rows:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+    return np.concatenate(rows), np.concatenate(columns), np.concatenate(values)
+
+
 class RemoveRepetitiveNames():
     '''
     This class is designed to remove repetitive instances of the same party from court data.
@@ -59,9 +106,14 @@ class RemoveRepetitiveNames():
     Second, it matches identical duplicates.
     Third, it uses fuzzy matching to estimate if similar party names are the same party.
     Repeated parties are then combined into the same party.
+    
+    run() loads the data and groups the parties, so one object can be created ahead of time and the same settings
+    run again.
     '''
     
-    def __init__(self, filename, abbreviations=None, stopwords=None, size=10000, algorithm='seq', remove_numbers=True):
+    def __init__(self, filename, abbreviations=None, stopwords=None, size=10000, algorithm='seq', remove_numbers=True,
+                 top_k=20, block_size=1000, n_jobs=1, blocking='name', cities_db_filename=cities_db_filename,
+                 partition_column=None, party_classifier=None, threshold=None):
         '''
         Parameters:
         - filename: the filename and path of the data file.
@@ -72,9 +124,31 @@ class RemoveRepetitiveNames():
             - Ratcliff/Obershelp ('seq'): Computes the doubled number of matching characters divided by the total number
                                           of characters in the two strings
             - Levenshtein ('levenshtein'): Computes the minimum number of edits needed to transform one string into the other
+            - TF-IDF ('tfidf'): Computes the cosine similarity of the TF-IDF weighted character n-grams of the two strings.
+                                Every party name is compared to every other, not just those of a similar 'position'.
+                                N-grams shared by many party names, like those of 'apartments', carry little weight.
         - remove_numbers (default True): if True, removes the numbers from party_name.
-        
-        Steps:
+        - top_k (default 20): for 'tfidf', only the top_k most similar party names to each party name are candidate matches.
+        - block_size (default 1000): for 'tfidf', the number of party names compared to all the others at once.
+        - n_jobs (default 1): the number of CPU cores to use. For 'tfidf', blocks of party names are compared on separate cores,
+            and with partition_column, partitions are grouped on separate cores. -1 uses every core.
+        - blocking (default 'name'): which party names are compared to each other:
+            - 'name': party names are compared based only on the names (see algorithm).
+            - 'address': party addresses are parsed, and a party with an address is only compared to parties with the same
+                         zip code or street address, or with no address. A party with no address is compared to all parties,
+                         as with 'name'.
+        - cities_db_filename (default address_parsing/cities_db.csv): the cities table used to parse party addresses.
+        - partition_column (default None): if the user wants parties grouped hierarchically, the column to partition
+            the parties by, such as 'county' or 'court'. Parties are first grouped within each partition, and then those
+            groups are merged across partitions (see match_hierarchical).
+        - party_classifier (default None): a trained PartyClassifier (see party_classifier.py). If given, every party is
+            labeled as a person or an entity before preprocessing, and people and entities are grouped separately, so a
+            person is never compared to an entity. The party_label and party_label_score columns are added to the data
+            and to the output.
+        - threshold (default None): the similarity ratio, from 0 to 1, at which two party names match. If None, the
+            default for the algorithm in thresholds is used (.8 for 'seq' and 'levenshtein', .6 for 'tfidf').
+        
+        Steps (see run):
         First, we import our data using the provided filename. We then select the first 10000 (based on 'size') rows.
         
         Next, we preprocess our data by adding a new column that is the same as the party_name column
@@ -82,17 +156,38 @@ class RemoveRepetitiveNames():
         
         
         '''
-        loaded_data = pd.read_csv(filename)
+        self.filename = filename
+        self.size = size
         self.abbreviations = abbreviations
         self.stopwords = stopwords
         self.algorithm = algorithm
         self.remove_numbers = remove_numbers
+        self.top_k = top_k
+        self.block_size = block_size
+        self.n_jobs = n_jobs
+        self.blocking = blocking
+        self.cities_db_filename = cities_db_filename
+        self.partition_column = partition_column
+        self.party_classifier = party_classifier
+        self.threshold = threshold if threshold is not None else thresholds.get(algorithm, thresholds['seq'])
+    
+    def run(self):
+        '''
+        This method loads the data, preprocesses the party names, removes identical duplicates, and groups the remaining
+        parties with fuzzy matching. The groups are saved in output_df, and the object is returned.
+        '''
+        usecols = party_columns + [self.partition_column] if self.partition_column else party_columns
+        loaded_data = read_court_csv(self.filename, usecols=usecols, dtype={'party_name': 'str', 'party_address': 'str'})
         
         # TIME CHECK MODULE
         start_time = time.time()
         print('timer started')
         
-        self.data = loaded_data[:size]
+        self.data = loaded_data[:self.size]
+        
+        # optionally label parties as people or entities, using the names before stopwords like llc are removed
+        if self.party_classifier:
+            self.data = self.data.join(self.party_classifier.predict(self.data['party_name'], n_jobs=self.n_jobs))
         
         # remove punctuation and optionally numbers
         self.data = self.remove_punc_num(self.data)
@@ -111,21 +206,77 @@ class RemoveRepetitiveNames():
         if self.abbreviations:
             self.data['party_name'] = self.data['party_name'].apply(lambda x: self.abbreviate(x))
         
-        # combine and then drop duplicates
-        self.data['party_count'] = self.data.groupby(['party_name'])['party_count'].transform('sum')
-        self.data.drop_duplicates(subset=['party_name'], inplace=True)
+        # combine and then drop duplicates (within each label and partition, if labeling and partitioning)
+        duplicate_columns = [column for column in ['party_label', self.partition_column] if column in self.data] + ['party_name']
+        self.data['party_count'] = self.data.groupby(duplicate_columns)['party_count'].transform('sum')
+        self.data.drop_duplicates(subset=duplicate_columns, inplace=True)
         
         # record how many identical party_names were identified, combined, and removed
         new_size, _ = self.data.shape
-        self.dropped_duplicates_count = size - new_size
+        self.dropped_duplicates_count = self.size - new_size
         
         # TIME CHECK MODULE
         first_interval = time.time()
         print('first interval: ', first_interval - start_time)
         
+        # people and entities are grouped separately
+        if self.party_classifier:
+            results = [self.match(label_data) for _, label_data in self.data.groupby('party_label')]
+            self.output_df = pd.concat([groups for groups, _ in results], ignore_index=True)
+            self.comparison_count = sum(counts[0] for _, counts in results)
+            self.fuzzy_match_count = sum(counts[1] for _, counts in results)
+        else:
+            self.output_df, (self.comparison_count, self.fuzzy_match_count) = self.match(self.data)
+        
+        # TIME CHECK MODULE
+        end_interval = time.time()
+        print('finished main function: ', end_interval - start_time)
+        print('number of comparisons: ', self.comparison_count)
+        print('number of matches: ', self.fuzzy_match_count)
+        
+        return self
+    
+    def __getstate__(self):
+        '''
+        Only the settings are needed to match a partition in another process (see match_hierarchical),
+        so the data is left out when this object is pickled.
+        '''
+        state = self.__dict__.copy()
+        state.pop('data', None)
+        return state
+    
+    def match(self, data):
+        '''
+        Groups the parties in data hierarchically if partitioning, and all at once otherwise.
+        '''
+        if self.partition_column:
+            return self.match_hierarchical(data)
+        return self.match_parties(data, self.blocking, self.n_jobs)
+    
+    def match_parties(self, data, blocking, n_jobs):
+        '''
+        This method uses fuzzy matching to group the parties in data, and returns one row per group along with the
+        number of pairs of party names compared and the number of matches.
+        
+        Each party that isn't already in a group starts a new group and is compared to the candidate parties that aren't
+        in a group yet (based on algorithm and blocking). Every candidate with a similarity ratio of at least threshold joins its group.
+        The first party is the group's party_name and the others are its aliases. The party types, addresses, case types,
+        years (and partitions, if partitioning) of the group are combined, and its party counts are added up.
+        
+        Any of these columns in data may already hold lists, as they do in groups from match_hierarchical,
+        in which case the lists are combined.
+        
+        If the parties are labeled (see party_classifier), every party in data has the same party_label, and a group's
+        party_label_score is the lowest score of its parties.
+        '''
+        labeled = 'party_label' in data
+        list_columns = ['party_type', 'party_address', 'case_type', 'year']
+        if self.partition_column:
+            list_columns.append(self.partition_column)
+        
         position = []
         
-        for index, row in self.data.iterrows():
+        for index, row in data.iterrows():
             word_length = len(row['party_name'])
             
             word_sum = self.sum_string(row['party_name'])
@@ -134,83 +285,153 @@ class RemoveRepetitiveNames():
             # 33 is the scalar factor between the length and the sum of letters based on a simple regression of the shelby data
             position.append(word_position)
         
-        self.data['position'] = position
+        data = data.assign(position=position)
         
-        # TIME CHECK MODULE
-        second_interval = time.time()
-        print('second interval: ', second_interval - first_interval)
+        # optionally group parties by address, so that parties at different addresses are never compared
+        if blocking == 'address':
+            address_keys, address_blocks, no_address = self.get_address_blocks(data['party_address'])
+            # parties with no address are candidates for every party, so rather than being added to every block they are
+            # kept apart, sorted by position, and only the ones within a party's position range are looked up
+            no_address_data = data.loc[list(no_address)].sort_values('position', kind='stable')
+            no_address_positions = no_address_data['position'].to_numpy()
+            row_numbers = pd.Series(np.arange(len(data)), index=data.index)
+        
+        # the tfidf algorithm scores all candidate pairs at once rather than by position
+        if self.algorithm == 'tfidf':
+            candidates = self.tfidf_candidates(data['party_name'], n_jobs)
         
         party_names = []
         aliases = []
-        party_types = []
-        addresses = []
-        case_types = []
-        years = []
+        grouped_columns = {column: [] for column in list_columns}
         party_counts = []
+        party_labels = []
+        party_label_scores = []
         
-        removed = []
+        removed = set()
         
         # TIME CHECK MODULE
         print('for loop starting')
         count = 0
         interval = time.time()
-        self.fuzzy_match_count = 0
+        fuzzy_match_count = 0
+        comparison_count = 0
         
-        for index, row in self.data.iterrows():
+        for index, row in data.iterrows():
             # TIME CHECK MODULE
             count += 1
             if count%1000 == 0:
                 print('finished thousand rows: ', time.time() - interval)
                 interval = time.time()
             if index not in removed:
-                removed.append(index)
+                removed.add(index)
+                
+                # the parties sharing an address key with this one, besides the parties with no address
+                if blocking == 'address' and index not in no_address:
+                    block = set().union(*(address_blocks[key] for key in address_keys[index]))
+                else:
+                    block = None
                 
-                position_lower = row['position'] * .8
-                position_upper = row['position'] * 1.2
-                test_set = self.data[(self.data['position']<=position_upper) & (self.data['position']>=position_lower)]
+                if self.algorithm == 'tfidf':
+                    test_set = data.loc[[i for i in candidates.get(index, {}) if block is None or i in block or i in no_address]]
+                else:
+                    position_lower = row['position'] * .8
+                    position_upper = row['position'] * 1.2
+                    if block is None:
+                        test_set = data[(data['position']<=position_upper) & (data['position']>=position_lower)]
+                    else:
+                        block_data = data.loc[list(block)]
+                        block_data = block_data[(block_data['position']<=position_upper) & (block_data['position']>=position_lower)]
+                        start = np.searchsorted(no_address_positions, position_lower, side='left')
+                        stop = np.searchsorted(no_address_positions, position_upper, side='right')
+                        test_set = pd.concat([block_data, no_address_data[start:stop]])
+                        # compare candidates in the order of data, as with name blocking
+                        test_set = test_set.iloc[np.argsort(row_numbers[test_set.index].to_numpy(), kind='stable')]
                 party_names.append(row['party_name'])
-                party_aliases = []
-                party_party_types = [row['party_type']]
-                party_addresses = [row['party_address']]
-                party_case_types = [row['case_type']]
-                party_years = [row['year']]
+                party_aliases = list(row['aliases']) if 'aliases' in row else []
+                party_groups = {column: self.as_list(row[column]) for column in list_columns}
                 party_party_counts = row['party_count']
+                party_label_score = row['party_label_score'] if labeled else None
 
                 for index_2, row_2 in test_set.iterrows():
                     if index_2 not in removed:
+                        comparison_count += 1
                         if self.algorithm == 'seq':
                             score = self.seq(row['party_name'], row_2['party_name'])
                         elif self.algorithm == 'levenshtein':
                             score = self.levenshtein(row['party_name'], row_2['party_name'])/100
+                        elif self.algorithm == 'tfidf':
+                            score = candidates[index][index_2]
                         else:
                             score = self.seq(row['party_name'], row_2['party_name'])
-                        if score >= .8:
-                            self.fuzzy_match_count += 1
-                            removed.append(index_2)
-                            if row_2['party_name'] not in party_aliases:
-                                party_aliases.append(row_2['party_name'])
-                            if row_2['party_type'] not in party_party_types:
-                                party_party_types.append(row_2['party_type'])
-                            if row_2['party_address'] not in party_addresses:
-                                party_addresses.append(row_2['party_address'])
-                            if row_2['case_type'] not in party_case_types:
-                                party_case_types.append(row_2['case_type'])
-                            if row_2['year'] not in party_years:
-                                party_years.append(row_2['year'])
+                        if score >= self.threshold:
+                            fuzzy_match_count += 1
+                            removed.add(index_2)
+                            for alias in [row_2['party_name']] + (list(row_2['aliases']) if 'aliases' in row_2 else []):
+                                if alias not in party_aliases and alias != row['party_name']:
+                                    party_aliases.append(alias)
+                            for column in list_columns:
+                                for value in self.as_list(row_2[column]):
+                                    if value not in party_groups[column]:
+                                        party_groups[column].append(value)
                             party_party_counts += row_2['party_count']
+                            if labeled:
+                                party_label_score = min(party_label_score, row_2['party_label_score'])
 
                 aliases.append(party_aliases)
-                party_types.append(party_party_types)
-                addresses.append(party_addresses)
-                case_types.append(party_case_types)
-                years.append(party_years)
+                for column in list_columns:
+                    grouped_columns[column].append(party_groups[column])
                 party_counts.append(party_party_counts)
+                if labeled:
+                    party_labels.append(row['party_label'])
+                    party_label_scores.append(party_label_score)
+        
+        output_df = pd.DataFrame({
+            'party_name': party_names,
+            'aliases': aliases,
+            'party_types': grouped_columns['party_type'],
+            'addresses': grouped_columns['party_address'],
+            'case_types': grouped_columns['case_type'],
+            'years': grouped_columns['year'],
+            'party_count': party_counts
+        })
+        if self.partition_column:
+            output_df.insert(len(output_df.columns) - 1, self.partition_column, grouped_columns[self.partition_column])
+        if labeled:
+            output_df.insert(len(output_df.columns) - 1, 'party_label', party_labels)
+            output_df.insert(len(output_df.columns) - 1, 'party_label_score', party_label_scores)
+        return output_df, (comparison_count, fuzzy_match_count)
+    
+    def match_hierarchical(self, data):
+        '''
+        This method groups parties in two levels, so that parties are never compared to every party in every partition.
         
-        # TIME CHECK MODULE
-        end_interval = time.time()
-        print('finished main function: ', end_interval - start_time)
-        print('number of matches: ', self.fuzzy_match_count)
-        self.output_df = pd.DataFrame(list(zip(party_names, aliases, party_types, addresses, case_types, years, party_counts)), columns = ['party_name', 'aliases', 'party_types', 'addresses', 'case_types', 'years', 'party_count'])
+        First, the parties in each partition (e.g. each county) are grouped separately with match_parties. Partitions are
+        independent, so n_jobs of them are grouped at once on separate CPU cores.
+        Second, the groups from every partition are grouped again with match_parties, comparing only each group's party_name,
+        to merge the same party across partitions. This pass uses name blocking, since a group may have many addresses.
+        
+        Aliases, party types, addresses, case types, years and partitions are combined, and party counts added up,
+        through both levels. Returns the groups along with the total number of comparisons and matches.
+        '''
+        from joblib import Parallel, delayed
+        
+        partitions = [partition for _, partition in data.groupby(self.partition_column, sort=False, observed=True)]
+        print('partitions: ', len(partitions))
+        
+        results = Parallel(n_jobs=self.n_jobs)(
+            delayed(self.match_parties)(partition, self.blocking, 1) for partition in partitions
+        )
+        partition_groups = pd.concat([groups for groups, _ in results], ignore_index=True)
+        print('partition groups: ', len(partition_groups))
+        
+        # match_parties expects the input column names
+        representatives = partition_groups.rename(columns={
+            'party_types': 'party_type', 'addresses': 'party_address', 'case_types': 'case_type', 'years': 'year'})
+        output_df, (comparison_count, fuzzy_match_count) = self.match_parties(representatives, 'name', self.n_jobs)
+        
+        comparison_count += sum(counts[0] for _, counts in results)
+        fuzzy_match_count += sum(counts[1] for _, counts in results)
+        return output_df, (comparison_count, fuzzy_match_count)
     
     def remove_punc_num(self, df):
         '''
@@ -283,7 +504,80 @@ class RemoveRepetitiveNames():
         '''
         Returns similarity ratio for two party names using the Levenshtein algorithm.
         '''
+        from fuzzywuzzy import fuzz
+        
         return fuzz.ratio(a, b)
+    
+    def get_address_blocks(self, party_addresses):
+        '''
+        Parses each distinct party address with AddressParser.parse_address and gives it up to two blocking keys:
+        its five digit zip code and its street address (street number and name). Parties sharing either key are in
+        the same address block.
+        
+        Returns a dict of index to the keys of that party's address, a dict of key to the indexes of the parties with
+        that key, and the set of indexes of parties whose address is missing or has no zip code or street address.
+        '''
+        # address_parsing needs usaddress and censusgeocode, so it is only imported when blocking by address
+        from address_parsing.address_parsing import AddressParser
+        parser = AddressParser.from_cities_db(self.cities_db_filename)
+        
+        keys_by_address = {}
+        for address in party_addresses.dropna().unique():
+            street_address, city, state, zip_code = parser.parse_address(address)
+            keys = set()
+            zip_match = re.match(r'\d{5}', zip_code)
+            if zip_match:
+                keys.add('zip ' + zip_match.group())
+            if street_address:
+                keys.add('street ' + ' '.join(street_address.lower().split()))
+            keys_by_address[address] = keys
+        
+        address_keys = {}
+        address_blocks = {}
+        no_address = set()
+        for index, address in party_addresses.items():
+            keys = keys_by_address.get(address) if not pd.isna(address) else None
+            if not keys:
+                no_address.add(index)
+                continue
+            address_keys[index] = keys
+            for key in keys:
+                address_blocks.setdefault(key, set()).add(index)
+        
+        return address_keys, address_blocks, no_address
+    
+    def as_list(self, value):
+        '''
+        Returns value as a list, so that single values and lists of values can be combined the same way.
+        '''
+        return list(value) if isinstance(value, (list, np.ndarray)) else [value]
+    
+    def tfidf_candidates(self, party_names, n_jobs):
+        '''
+        Finds candidate matches for every party name using the cosine similarity of TF-IDF weighted character n-grams.
+        
+        The party names are vectorized into a sparse matrix with one row per name. Each block of block_size rows is
+        multiplied by the whole matrix to score it against every name, and only the top_k scores of each name that are at
+        least the threshold are kept (see top_k_block), so the full name-by-name matrix is never held in memory.
+        Blocks are independent, so n_jobs of them are scored at once on separate cores.
+        
+        Returns a dict of index to a dict of candidate index to score.
+        '''
+        from joblib import Parallel, delayed
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        
+        vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=(2, 4), dtype=np.float32)
+        matrix = vectorizer.fit_transform(party_names).tocsr()
+        
+        blocks = Parallel(n_jobs=n_jobs)(
+            delayed(top_k_block)(matrix, start, min(start + self.block_size, matrix.shape[0]), self.top_k, self.threshold)
+            for start in range(0, matrix.shape[0], self.block_size)
+        )
+        
+        indexes = party_names.index
+        candidates = {}
+        for rows, columns, values in blocks:
+            for row, column, value in zip(rows, columns, values):
+                candidates.setdefault(indexes[row], {})[indexes[column]] = float(value)
+        return candidates
 
-
-cleaned_data = RemoveRepetitiveNames(filename='Downloads/2020-11-01_tn_shelby_party_counts.csv', abbreviations=abbreviations, stopwords = stopwords, size=10000, algorithm='levenshtein', remove_numbers=True)
\ No newline at end of file
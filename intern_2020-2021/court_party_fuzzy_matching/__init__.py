@@ -0,0 +1,4 @@
+'''
+Fuzzy Matching of Legal Parties
+RemoveRepetitiveNames is in FuzzyMatching.py and PartyClassifier in party_classifier.py.
+'''
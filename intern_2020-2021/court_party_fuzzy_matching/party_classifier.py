@@ -0,0 +1,138 @@
+'''
+Classifying Legal Parties as People or Entities
+This module labels party names as people (e.g. 'john smith') or entities (e.g. 'acme apartments llc').
+
+Our court data tables have party_label and party_label_score columns: party_label is 'person' or 'entity',
+and party_label_score is the certainty of that label, from .5 to 1. Cases are classified as commercial or
+non-commercial evictions based on these columns.
+
+PartyClassifier turns each party name into hashed word and character n-gram features, so no vocabulary has to be
+stored or built, and scores them with a linear model, which is one sparse matrix product for a whole batch of names.
+The model is only a weight per feature, so it is saved as a small numpy file.
+
+With no hand-labeled names, the model can be trained on weak labels: names containing a common entity term
+(the stopwords and abbreviated terms used in FuzzyMatching.py, plus others like 'bank' or 'authority') are labeled
+entities and the rest people. The model then learns other n-grams that come with those terms, so it also labels
+entities that contain none of them.
+'''
+
+import re
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy.sparse import hstack
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import SGDClassifier
+
+entity_terms = {'llc', 'inc', 'pllc', 'llp', 'lp', 'ltd', 'co', 'corp', 'corporation', 'company', 'incorporated',
+                'apartment', 'apartments', 'apt', 'apts', 'management', 'mgt', 'mgmt', 'property', 'properties', 'prop',
+                'realty', 'rlt', 'rental', 'rentals', 'rtl', 'homes', 'hms', 'housing', 'authority', 'association', 'assn',
+                'bank', 'bk', 'credit', 'cr', 'union', 'financial', 'fin', 'services', 'service', 'svc', 'acceptance', 'acc',
+                'recovery', 'rec', 'holdings', 'hld', 'bonding', 'bnd', 'collection', 'collections', 'col', 'group', 'grp',
+                'capital', 'cap', 'insurance', 'ins', 'acquisitions', 'acq', 'partners', 'partnership', 'investments',
+                'investors', 'ventures', 'enterprises', 'trust', 'furniture', 'fur', 'manor', 'mn', 'village', 'villas',
+                'commons', 'estates', 'church', 'ministries', 'hospital', 'medical', 'clinic', 'university', 'college',
+                'school', 'city', 'county', 'state', 'department', 'dept', 'commonwealth', 'na', 'fsb', 'pc', 'pa'}
+
+
+def weak_labels(party_names):
+    '''
+    This function labels party names as 'entity' if they contain any of the entity_terms, and as 'person' otherwise.
+    '''
+    tokens = party_names.fillna('').str.lower().str.findall(r'[a-z]+')
+    return np.where(tokens.apply(lambda x: not entity_terms.isdisjoint(x)), 'entity', 'person')
+
+
+class PartyClassifier():
+    '''
+    This class labels party names as people or entities with a linear model over hashed word and character n-gram features.
+
+    - fit(party_names, labels) trains the model on labeled names ('person' or 'entity').
+    - fit_weak_labels(party_names) trains the model on the labels from weak_labels.
+    - predict(party_names) returns the party_label and party_label_score of each name.
+    - save(filename) and PartyClassifier.load(filename) save and load the model weights.
+    '''
+
+    def __init__(self, n_features=2**18, coef=None, intercept=0.0):
+        '''
+        Parameters:
+        - n_features (default 2**18): the number of hashed features for words and for character n-grams each.
+        - coef, intercept (default None, 0.0): the weights of a trained model, as saved by save().
+        '''
+        self.n_features = n_features
+        self.coef = coef
+        self.intercept = intercept
+
+        self.word_vectorizer = HashingVectorizer(analyzer='word', ngram_range=(1, 2), n_features=n_features,
+                                                 alternate_sign=False, token_pattern=r'[a-z0-9]+', dtype=np.float32)
+        self.char_vectorizer = HashingVectorizer(analyzer='char_wb', ngram_range=(3, 4), n_features=n_features,
+                                                 alternate_sign=False, dtype=np.float32)
+
+    def features(self, party_names):
+        '''
+        Returns a sparse matrix of the hashed word and character n-gram features of the party names, one row per name.
+        Names are lowercased and punctuation other than '&' is dropped, so 'Acme, Inc.' and 'acme inc' have the same features.
+        '''
+        party_names = [re.sub(r'[^a-z0-9& ]+', ' ', str(name).lower()) for name in party_names]
+        return hstack([self.word_vectorizer.transform(party_names), self.char_vectorizer.transform(party_names)]).tocsr()
+
+    def fit(self, party_names, labels):
+        '''
+        Trains the model on party names labeled 'person' or 'entity', and returns the classifier.
+        '''
+        model = SGDClassifier(loss='log_loss', alpha=1e-5, max_iter=20, tol=1e-4, random_state=0)
+        model.fit(self.features(party_names), np.asarray(labels) == 'entity')
+        self.coef = model.coef_.ravel().astype(np.float32)
+        self.intercept = float(model.intercept_[0])
+        return self
+
+    def fit_weak_labels(self, party_names):
+        '''
+        Trains the model on party names labeled by weak_labels, and returns the classifier.
+        '''
+        party_names = pd.Series(party_names)
+        return self.fit(party_names, weak_labels(party_names))
+
+    def predict_batch(self, party_names):
+        '''
+        Returns the probability that each party name is an entity.
+        '''
+        scores = self.features(party_names) @ self.coef + self.intercept
+        return 1 / (1 + np.exp(-scores))
+
+    def predict(self, party_names, batch_size=100000, n_jobs=1):
+        '''
+        Labels each party name as 'entity' or 'person'. Returns a DataFrame with the same index as party_names and two columns:
+        - party_label: 'entity' or 'person'.
+        - party_label_score: the probability of that label, from .5 to 1.
+
+        Names are labeled in batches of batch_size, and n_jobs batches are labeled at once on separate CPU cores.
+        '''
+        assert self.coef is not None, 'PartyClassifier has not been trained or loaded'
+        party_names = pd.Series(party_names)
+
+        probabilities = Parallel(n_jobs=n_jobs)(
+            delayed(self.predict_batch)(party_names.iloc[start:start + batch_size].tolist())
+            for start in range(0, len(party_names), batch_size)
+        )
+        probabilities = np.concatenate(probabilities) if probabilities else np.array([])
+
+        return pd.DataFrame({
+            'party_label': np.where(probabilities >= .5, 'entity', 'person'),
+            'party_label_score': np.round(np.maximum(probabilities, 1 - probabilities), 4)
+        }, index=party_names.index)
+
+    def save(self, filename):
+        '''
+        Saves the model weights to a compressed numpy file.
+        '''
+        np.savez_compressed(filename, coef=self.coef, intercept=self.intercept, n_features=self.n_features)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Loads a classifier saved with save().
+        '''
+        weights = np.load(filename)
+        return cls(n_features=int(weights['n_features']), coef=weights['coef'], intercept=float(weights['intercept']))